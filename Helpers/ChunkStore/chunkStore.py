@@ -0,0 +1,466 @@
+import os
+import math
+import time
+import zlib
+import pickle
+import hashlib
+import threading
+import numpy as np
+from functools import lru_cache
+from typing import Callable
+from Helpers.band_stats import BandStats
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Side of a square chunk in pixels. All bands of a chunk are stored together.
+CHUNK_SIZE = int(os.getenv("chunk_size", 512))
+# zlib level. 1 is the fastest level and already removes most of the redundancy of raster tiles.
+CHUNK_COMPRESSION_LEVEL = int(os.getenv("chunk_compression_level", 1))
+# Decoded chunks kept in memory per process. Tiles and windows usually hit the same chunks again.
+CHUNK_CACHE_ENTRIES = int(os.getenv("chunk_cache_entries", 64))
+# Seconds between two background gc runs. Removals in between are collected by the next run.
+CHUNK_GC_INTERVAL = float(os.getenv("chunk_gc_interval", 30))
+# -------------------------------------------------------- #
+
+MANIFEST_EXT = ".chunks"
+# Chunks put by a writer that is not closed yet, one hash per line. Named `<id>.<pid>.<thread>.pending`
+PENDING_EXT = ".pending"
+
+
+class ChunkStore:
+    """Chunked, compressed and content addressed array store.
+    ---
+    1. An (H, W, D) array is split into fixed size chunks of `chunk_size x chunk_size x D`.
+    2. Each chunk is compressed and saved as `chunks/<hash[:2]>/<hash>` where hash is the hash of its content.
+    3. Chunks that are the same between arrays (unchanged regions of consecutive stack steps) are stored once.
+    4. An array is a manifest `<id>.chunks` listing its chunk hashes. Removing an array only removes its manifest, chunks are collected by `gc`.
+    5. A writer records every chunk it uses in a pending file before it puts the chunk, `gc` never collects them.
+    6. Totals of the manifests are kept running, a refresh only reads the manifests written since the last one.
+
+    :param directory: Directory holding the manifests. Chunks are stored in `directory/chunks`
+    :type directory: str
+    :param chunk_size: Side of a chunk in pixels
+    :type chunk_size: int
+    :param compression_level: zlib compression level
+    :type compression_level: int
+    """
+    def __init__(self, directory: str, chunk_size: int = CHUNK_SIZE, compression_level: int = CHUNK_COMPRESSION_LEVEL):
+        self.directory = directory
+        self.chunk_dir = os.path.join(directory, "chunks")
+        self.chunk_size = chunk_size
+        self.compression_level = compression_level
+        self.__manifests: dict[str, dict] = {}      # Manifests are never modified once written
+        self.__lock = threading.Lock()
+
+        # Running totals of the manifests on disk, see `__refresh`
+        self.__index: dict[str, tuple[int, dict[str, int]]] = {}    # manifest file -> (nbytes, chunk sizes)
+        self.__refs: dict[str, int] = {}                            # chunk hash -> manifests using it
+        self.__chunk_bytes: dict[str, int] = {}                     # chunk hash -> compressed size
+        self.__logical_bytes = 0
+        self.__stored_bytes = 0
+        self.__index_lock = threading.Lock()
+
+        self.__gc_lock = threading.Lock()
+        self.__gc_scheduled = False
+        self.__last_gc = 0.0
+
+    @staticmethod
+    def _stem(npy_id: str) -> str:
+        return os.path.splitext(os.path.basename(npy_id))[0]
+
+    def manifest_file(self, npy_id: str) -> str:
+        return os.path.join(self.directory, ChunkStore._stem(npy_id) + MANIFEST_EXT)
+
+    def chunk_file(self, chunk_hash: str) -> str:
+        return os.path.join(self.chunk_dir, chunk_hash[:2], chunk_hash)
+
+    def exists(self, npy_id: str) -> bool:
+        return os.path.exists(self.manifest_file(npy_id))
+
+    def manifest(self, npy_id: str) -> dict:
+        manifest_file = self.manifest_file(npy_id)
+        with self.__lock:
+            if manifest_file not in self.__manifests:
+                with open(manifest_file, 'rb') as f:
+                    self.__manifests[manifest_file] = pickle.load(f)
+            return self.__manifests[manifest_file]
+
+    def header(self, npy_id: str) -> tuple[tuple[int, ...], np.dtype]:
+        """Returns the shape and dtype of an array without reading any chunk"""
+        manifest = self.manifest(npy_id)
+        return manifest["shape"], np.dtype(manifest["dtype"])
+
+    def band_stats(self, npy_id: str) -> dict | None:
+        """Per band stats recorded while the array was written. See `band_stats.BandStats`"""
+        return self.manifest(npy_id).get("band_stats")
+
+    # --------------------------- Write ---------------------------- #
+
+    def writer(self, npy_id: str, shape: tuple[int, ...], dtype, nodata: float | None = None) -> "ChunkWriter":
+        return ChunkWriter(self, npy_id, shape, dtype, nodata)
+
+    def save(self, npy_id: str, npy: np.ndarray, nodata: float | None = None):
+        """Saves a full array. Reads the input one chunk row at a time so memory mapped inputs stay paged out"""
+        writer = self.writer(npy_id, npy.shape, npy.dtype, nodata)
+        for r in range(0, npy.shape[0], self.chunk_size):
+            writer.write(np.asarray(npy[r:r + self.chunk_size]))
+        writer.close()
+
+    def _put_chunk(self, chunk: np.ndarray, pending: Callable[[str], None] | None = None) -> tuple[str, int]:
+        """Stores a chunk if its content is not stored yet. Returns its hash and compressed size
+
+        :param pending: Records the hash before the chunk is looked up, see `gc`
+        :type pending: Callable[[str], None] | None
+        """
+        chunk = np.ascontiguousarray(chunk)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(f"{chunk.dtype.str}{chunk.shape}".encode())
+        digest.update(chunk.data)
+        chunk_hash = digest.hexdigest()
+        if pending is not None:
+            pending(chunk_hash)
+
+        chunk_file = self.chunk_file(chunk_hash)
+        try:
+            return chunk_hash, os.path.getsize(chunk_file)
+        except FileNotFoundError:
+            pass        # Not stored yet, or taken by a concurrent gc. Written again
+
+        os.makedirs(os.path.dirname(chunk_file), exist_ok=True)
+        compressed = zlib.compress(chunk.data, self.compression_level)
+        tmp_file = f"{chunk_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_file, chunk_file)
+        return chunk_hash, len(compressed)
+
+    def _put_manifest(self, npy_id: str, manifest: dict):
+        manifest_file = self.manifest_file(npy_id)
+        with open(manifest_file + ".tmp", 'wb') as f:
+            pickle.dump(manifest, f)
+        os.replace(manifest_file + ".tmp", manifest_file)
+
+    # --------------------------- Read ----------------------------- #
+
+    def read(self, npy_id: str, window: tuple[int, int, int, int] | None = None, bands: slice | list[int] | None = None) -> np.ndarray:
+        """Reads a (y, x, height, width) window and band subset. Only the chunks covering the window are decoded"""
+        manifest = self.manifest(npy_id)
+        shape, dtype, size = manifest["shape"], np.dtype(manifest["dtype"]), manifest["chunk_size"]
+        height, width = shape[:2]
+
+        y, x, h, w = window if window is not None else (0, 0, height, width)
+        y0, x0 = min(max(y, 0), height), min(max(x, 0), width)
+        y1, x1 = min(max(y + h, y0), height), min(max(x + w, x0), width)
+
+        band_count = len(np.arange(shape[2])[bands]) if bands is not None else shape[2]
+        out = np.empty((y1 - y0, x1 - x0, band_count), dtype=dtype)
+
+        for cy in range(y0 // size, math.ceil(y1 / size)):
+            for cx in range(x0 // size, math.ceil(x1 / size)):
+                chunk_hash = manifest["chunks"][cy][cx]
+                chunk_shape = (min(size, height - cy * size), min(size, width - cx * size), shape[2])
+                chunk = _decode(self.chunk_file(chunk_hash), chunk_shape, dtype.str)
+
+                # Intersection of the window and the chunk in image coordinates
+                ry0, ry1 = max(y0, cy * size), min(y1, (cy + 1) * size)
+                rx0, rx1 = max(x0, cx * size), min(x1, (cx + 1) * size)
+                part = chunk[ry0 - cy * size:ry1 - cy * size, rx0 - cx * size:rx1 - cx * size]
+                if bands is not None:
+                    part = part[:, :, bands]
+                out[ry0 - y0:ry1 - y0, rx0 - x0:rx1 - x0] = part
+
+        out.flags.writeable = False
+        return out
+
+    def open(self, npy_id: str, bands: slice | None = None) -> "ChunkedArray":
+        return ChunkedArray(self, npy_id, bands)
+
+    # -------------------------- Remove ---------------------------- #
+
+    def delete(self, *npy_ids: str):
+        """Removes arrays. Their chunks are removed by gc once no other array uses them"""
+        for npy_id in npy_ids:
+            manifest_file = self.manifest_file(npy_id)
+            with self.__lock:
+                self.__manifests.pop(manifest_file, None)
+            if os.path.exists(manifest_file):
+                os.remove(manifest_file)
+
+    def __files(self, ext: str) -> list[str]:
+        if not os.path.exists(self.directory):
+            return []
+        return [os.path.join(self.directory, f) for f in os.listdir(self.directory) if f.endswith(ext)]
+
+    def __refresh(self) -> set[str]:
+        """Updates the running totals with the manifests written or removed since the last refresh. Returns the referenced chunks"""
+        with self.__index_lock:
+            manifest_files = set(self.__files(MANIFEST_EXT))
+            for manifest_file in [f for f in self.__index if f not in manifest_files]:
+                nbytes, sizes = self.__index.pop(manifest_file)
+                self.__logical_bytes -= nbytes
+                for chunk_hash in sizes:
+                    self.__refs[chunk_hash] -= 1
+                    if not self.__refs[chunk_hash]:
+                        del self.__refs[chunk_hash]
+                        self.__stored_bytes -= self.__chunk_bytes.pop(chunk_hash)
+
+            for manifest_file in manifest_files - self.__index.keys():
+                try:
+                    with open(manifest_file, 'rb') as f:
+                        manifest = pickle.load(f)
+                except FileNotFoundError:
+                    continue        # Removed meanwhile
+                self.__index[manifest_file] = (manifest["nbytes"], manifest["sizes"])
+                self.__logical_bytes += manifest["nbytes"]
+                for chunk_hash, size in manifest["sizes"].items():
+                    self.__refs[chunk_hash] = self.__refs.get(chunk_hash, 0) + 1
+                    if chunk_hash not in self.__chunk_bytes:
+                        self.__chunk_bytes[chunk_hash] = size
+                        self.__stored_bytes += size
+            return set(self.__refs)
+
+    def __pending(self) -> set[str]:
+        """Chunks used by writers not closed yet. Files left by writers of processes that are gone are removed"""
+        pending = set()
+        for pending_file in self.__files(PENDING_EXT):
+            pid = int(os.path.basename(pending_file).rsplit(".", 3)[1])
+            if not _alive(pid):
+                _remove(pending_file)
+                continue
+            try:
+                with open(pending_file, 'r') as f:
+                    pending.update(f.read().split())
+            except FileNotFoundError:
+                continue        # Writer closed meanwhile, its manifest is read after this
+        return pending
+
+    def __live(self) -> set[str]:
+        # Pending files before manifests. A writer closing in between has written its manifest before removing its pending file
+        pending = self.__pending()
+        return pending | self.__refresh()
+
+    def gc(self) -> int:
+        """Removes chunks not referenced by any manifest or writer. Returns the number of removed chunks
+        ---
+        1. Unreferenced chunks are renamed out of the way first, so no writer can find them from then on.
+        2. References are read again. Chunks a writer recorded in between are put back, the others are removed.
+        3. A writer recording a chunk after that finds it missing and writes it again.
+        """
+        with self.__gc_lock:
+            if not os.path.exists(self.chunk_dir):
+                return 0
+            live = self.__live()
+            taken: list[tuple[str, str]] = []
+            suffix = f".{os.getpid()}.{threading.get_ident()}.gc"
+            for prefix in os.listdir(self.chunk_dir):
+                for chunk_hash in os.listdir(os.path.join(self.chunk_dir, prefix)):
+                    # Temporary files of writers and gc runs have a suffix
+                    if "." in chunk_hash or chunk_hash in live:
+                        continue
+                    chunk_file = os.path.join(self.chunk_dir, prefix, chunk_hash)
+                    try:
+                        os.replace(chunk_file, chunk_file + suffix)
+                    except OSError:
+                        continue
+                    taken.append((chunk_hash, chunk_file))
+
+            live = self.__live()
+            removed = 0
+            for chunk_hash, chunk_file in taken:
+                if chunk_hash in live:
+                    os.replace(chunk_file + suffix, chunk_file)
+                elif _remove(chunk_file + suffix):
+                    removed += 1
+            return removed
+
+    def schedule_gc(self):
+        """Runs `gc` in a background thread, at most once every CHUNK_GC_INTERVAL seconds. Calls in between are coalesced"""
+        with self.__lock:
+            if self.__gc_scheduled:
+                return
+            self.__gc_scheduled = True
+        delay = max(0.0, self.__last_gc + CHUNK_GC_INTERVAL - time.monotonic())
+        timer = threading.Timer(delay, self.__scheduled_gc)
+        timer.daemon = True
+        timer.start()
+
+    def __scheduled_gc(self):
+        with self.__lock:
+            self.__gc_scheduled = False
+            self.__last_gc = time.monotonic()
+        try:
+            removed = self.gc()
+            if removed:
+                print(f"Chunk gc removed {removed} chunks")
+        except Exception as e:
+            print(f"Chunk gc failed: {e}")
+
+    # -------------------------- Report ---------------------------- #
+
+    @property
+    def stats(self) -> dict:
+        """Compression and deduplication of all arrays in the store. Running totals, see `__refresh`"""
+        self.__refresh()
+        with self.__index_lock:
+            arrays, chunks = len(self.__index), len(self.__refs)
+            logical_bytes, stored_bytes = self.__logical_bytes, self.__stored_bytes
+        return {
+            "arrays": arrays,
+            "chunks": chunks,
+            "logical_bytes": logical_bytes,
+            "stored_bytes": stored_bytes,
+            "compression_ratio": round(logical_bytes / stored_bytes, 2) if stored_bytes else None,
+            "bytes_saved": logical_bytes - stored_bytes,
+        }
+
+
+class ChunkWriter:
+    """Writes an array to the store row strip by row strip. Strips can have any number of rows.
+    Manifest is only written on close so a partially written array is never read.
+    Until then the chunks written are recorded in a pending file, `gc` keeps them.
+    Band stats are accumulated from the same strips and saved in the manifest.
+    """
+    def __init__(self, store: ChunkStore, npy_id: str, shape: tuple[int, ...], dtype, nodata: float | None = None):
+        if len(shape) == 2:
+            shape = (*shape, 1)
+        self.store = store
+        self.npy_id = npy_id
+        self.shape = tuple(int(s) for s in shape)
+        self.dtype = np.dtype(dtype)
+
+        size = store.chunk_size
+        self.__buffer = np.empty((size, self.shape[1], self.shape[2]), dtype=self.dtype)
+        self.__filled = 0
+        self.__rows_written = 0
+        self.__chunks: list[list[str]] = []
+        self.__sizes: dict[str, int] = {}
+        self.__stats = BandStats(self.shape, self.dtype, nodata)
+
+        stem = ChunkStore._stem(npy_id)
+        self.__pending_file = os.path.join(store.directory, f"{stem}.{os.getpid()}.{threading.get_ident()}{PENDING_EXT}")
+        self.__pending = None
+
+    def __pend(self, chunk_hash: str):
+        if self.__pending is None:
+            os.makedirs(self.store.directory, exist_ok=True)
+            self.__pending = open(self.__pending_file, 'a')
+        # Flushed so gc of any process reads it before the chunk is looked up
+        self.__pending.write(chunk_hash + "\n")
+        self.__pending.flush()
+
+    def __release(self):
+        if self.__pending is not None:
+            self.__pending.close()
+            self.__pending = None
+            _remove(self.__pending_file)
+
+    def write(self, rows: np.ndarray):
+        if rows.ndim == 2:
+            rows = rows[..., np.newaxis]
+        self.__stats.update(rows)
+        while len(rows):
+            take = min(len(rows), len(self.__buffer) - self.__filled)
+            self.__buffer[self.__filled:self.__filled + take] = rows[:take]
+            self.__filled += take
+            rows = rows[take:]
+            if self.__filled == len(self.__buffer):
+                self.__flush()
+
+    def __flush(self):
+        if not self.__filled:
+            return
+        size = self.store.chunk_size
+        rows = self.__buffer[:self.__filled]
+        chunk_row = []
+        for c in range(0, self.shape[1], size):
+            chunk_hash, compressed_size = self.store._put_chunk(rows[:, c:c + size], self.__pend)
+            self.__sizes[chunk_hash] = compressed_size
+            chunk_row.append(chunk_hash)
+        self.__chunks.append(chunk_row)
+        self.__rows_written += self.__filled
+        self.__filled = 0
+
+    def abort(self):
+        """Drops a partially written array. Its manifest is never written, chunks already put are collected by `gc`"""
+        self.__filled = 0
+        self.__release()
+
+    def close(self):
+        self.__flush()
+        assert self.__rows_written == self.shape[0], f"Expected {self.shape[0]} rows, got {self.__rows_written}"
+        self.store._put_manifest(self.npy_id, {
+            "shape": self.shape,
+            "dtype": self.dtype.str,
+            "chunk_size": self.store.chunk_size,
+            "chunks": self.__chunks,
+            "sizes": self.__sizes,
+            "nbytes": int(np.prod(self.shape)) * self.dtype.itemsize,
+            "band_stats": self.__stats.to_dict(),
+        })
+        self.__release()
+
+
+class ChunkedArray:
+    """Read only array like view over a stored array. Slicing only decodes the chunks it touches.
+    np.asarray(chunked_array) reads the full array.
+    """
+    def __init__(self, store: ChunkStore, npy_id: str, bands: slice | None = None):
+        self.store = store
+        self.npy_id = npy_id
+        self.bands = bands
+        shape, self.dtype = store.header(npy_id)
+        band_count = len(np.arange(shape[2])[bands]) if bands is not None else shape[2]
+        self.shape = (shape[0], shape[1], band_count)
+        self.ndim = 3
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),) * (3 - len(key))
+        rows, cols, bands = key
+        if isinstance(rows, int) or isinstance(cols, int):
+            raise TypeError("ChunkedArray only supports slices for rows and columns")
+
+        y0, y1, y_step = rows.indices(self.shape[0])
+        x0, x1, x_step = cols.indices(self.shape[1])
+        window = (y0, x0, max(0, y1 - y0), max(0, x1 - x0))
+        npy = self.store.read(self.npy_id, window, self.bands)
+        return npy[::y_step, ::x_step, bands]
+
+    def __array__(self, dtype=None, copy=None):
+        npy = self.store.read(self.npy_id, bands=self.bands)
+        return npy if dtype is None else npy.astype(dtype)
+
+
+def _alive(pid: int) -> bool:
+    """Whether a process is running. Always true on Windows, where signal 0 would terminate it"""
+    if pid == os.getpid() or os.name == "nt":
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _remove(path: str) -> bool:
+    try:
+        os.remove(path)
+        return True
+    except OSError:
+        return False
+
+
+@lru_cache(maxsize=CHUNK_CACHE_ENTRIES)
+def _decode(chunk_file: str, shape: tuple[int, ...], dtype: str) -> np.ndarray:
+    """Decompresses a chunk. Cached by path, chunks are immutable once written"""
+    with open(chunk_file, 'rb') as f:
+        data = zlib.decompress(f.read())
+    return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape)
@@ -1,5 +1,4 @@
 import os
-import pickle
 import base64
 import numpy as np
 from enum import Enum
@@ -7,6 +6,12 @@ from io import BytesIO
 from rasterio import io as rioIO
 from PIL import Image as pilImage
 from PIL import ImageFile as pilImageFile
+from Helpers import array_access
+from Helpers import band_stats
+from Helpers import render_kernel
+from Helpers import render_encoder
+from Helpers import catalogue
+from Helpers.band_stats import BandStats
 
 
 # ------------------ Load ENV Variables ------------------ #
@@ -17,6 +22,10 @@ _cwd = os.path.abspath(os.getcwd())
 UPLOADS_DIR:str = os.getenv("uploads_dir", r"Data\Uploads")
 UPLOADS_DIR = os.path.join(_cwd, UPLOADS_DIR)
 os.makedirs(UPLOADS_DIR, exist_ok=True) # Makes directory if not present.
+
+# Max size of a single window read from the source while ingesting. Bounds peak memory of the ingest.
+INGEST_WINDOW_MB = float(os.getenv("ingest_window_mb", 64))
+THUMBNAIL_SIZE = int(os.getenv("thumbnail_size", 64))
 # -------------------------------------------------------- #
 
 class FileExtensions(Enum):
@@ -28,7 +37,7 @@ class FileExtensions(Enum):
 
 class File:
     """File Object that stores intermediate results for processing accross services.  
-    File.save_pkl() to use the pkl in other services.
+    File.save() records the details in the catalogue to use them in other services, `ImageFile.load` reads them back.
     """
     def __init__(self, _uuid: str, filename: str):
         self._uuid = _uuid
@@ -36,22 +45,22 @@ class File:
         _, self.ext = os.path.splitext(filename)
         pass
     
-    @property
-    def filename_pkl(self) -> str:
-        return os.path.join(UPLOADS_DIR, f'{self._uuid}.pkl')
-    
     @property
     def filepath(self) -> str:
         return os.path.join(UPLOADS_DIR, self._uuid+self.ext)
     
-    def save_pkl(self):
-        """Updates the pkl file with the new object"""
+    @property
+    def meta(self) -> dict:
+        """Details recorded in the catalogue. See `catalogue.set_upload_meta`"""
+        return {}
+    
+    def save(self):
+        """Records the details of the file in the catalogue"""
         try:
-            with open(self.filename_pkl, 'wb') as file_pkl:
-                pickle.dump(self, file_pkl)
-            print(f"Updated {self.filename_pkl}")
+            catalogue.set_upload_meta(self._uuid, self.filename, **self.meta)
+            print(f"Catalogued {self._uuid}")
         except Exception as e:
-            print("Unable to save", self.filename_pkl)
+            print("Unable to catalogue", self._uuid)
             print(e)
     
     def __delete_files(self):
@@ -61,15 +70,8 @@ class File:
             p.unlink()
         
     def delete(self):
-        mapp_file = os.path.join(UPLOADS_DIR, "mapping.pkl")
-        with open(mapp_file, 'rb') as f:
-            mapp = pickle.load(f)
-        
+        catalogue.remove_upload(self._uuid)     # Remove from the listing first, then the files
         self.__delete_files()       # Remove all relevant files
-        del mapp[self._uuid]        # Remove mapping
-        
-        with open(mapp_file, 'wb') as f:
-            pickle.dump(mapp, f)    # Save new mapping
         
         del self                    # Delete object
 
@@ -78,18 +80,50 @@ class ImageFile(File):
     """Class for standard image file."""
     def __init__(self, _uuid, filename):
         super().__init__(_uuid, filename)
+        self.dtype: str | None = None
+        self.shape: tuple[int, int, int] | None = None
+        self.crs: str | None = None
         self.read()
     
+    @classmethod
+    def load(cls, _uuid: str) -> "ImageFile":
+        """File read earlier, built from its catalogue record without reading it again
+        
+        :raises FileNotFoundError: Upload not in the catalogue or not read yet
+        """
+        record = catalogue.get_upload(_uuid)
+        if record is None or record["dtype"] is None:
+            raise FileNotFoundError(f"Upload {_uuid} not read")
+        
+        img = cls.__new__(cls)
+        File.__init__(img, _uuid, record["filename"])
+        img.dtype = record["dtype"]
+        img.shape = (record["height"], record["width"], record["bands"])
+        img.crs = record["crs"]
+        img.band_stats = record["stats"]
+        return img
+    
+    @property
+    def meta(self) -> dict:
+        height, width, bands = self.shape if self.shape else (None, None, None)
+        return {
+            "dtype": self.dtype, "height": height, "width": width, "bands": bands,
+            "crs": self.crs, "stats": self.stats
+        }
+    
     @property
     def __npy_file_path(self):
         return os.path.join(UPLOADS_DIR, self._uuid + '.npy')
     
     @property
     def npy(self) -> np.ndarray:
-        """Reads npy from .npy file if exists and returns np.ndarray"""
-
+        """Reads npy from .npy file if exists and returns a read only np.ndarray"""
+        return self.read_npy()
+    
+    def read_npy(self, window: array_access.Window | None = None, bands: array_access.Bands = None, mmap: bool | None = None) -> np.ndarray:
+        """Reads a window and / or band subset of the .npy file. See `array_access.load_npy`"""
         if os.path.exists(self.__npy_file_path):
-            return np.load(self.__npy_file_path)
+            return array_access.load_npy(self.__npy_file_path, window=window, bands=bands, mmap=mmap)
         else:
             raise FileNotReadError
         
@@ -99,46 +133,82 @@ class ImageFile(File):
         with open(self.__npy_file_path, "wb") as f:
             np.save(f, val)
     
+    def __npy_writer(self, shape: tuple[int, int, int], dtype) -> np.memmap:
+        """Preallocates the (H, W, D) npy file on disk. Commit with __commit_npy once filled"""
+        return np.lib.format.open_memmap(self.__npy_file_path + ".tmp", mode='w+', dtype=dtype, shape=shape)
+    
+    def __commit_npy(self, out: np.memmap):
+        out.flush()
+        del out
+        os.replace(self.__npy_file_path + ".tmp", self.__npy_file_path)
+    
+    @property
+    def stats(self) -> dict | None:
+        """Per band stats recorded at ingest. None for files read by older versions"""
+        return getattr(self, "band_stats", None)
+    
     @property
     def npy8(self):
         """Returns the npy in uint8"""
-        _npy = self.npy
+        return self.__conv_uint8(self.npy, band_stats.render_range(self.stats, bands=slice(None)))
+    
+    @staticmethod
+    def __conv_uint8(_npy: np.ndarray, value_range: tuple[float, float] | None = None, out: np.ndarray | None = None) -> np.ndarray:
         if _npy.dtype == np.uint8:
             return _npy
         
-        # def map_range(img: np.ndarray, outmin=0, outmax=255, outType=np.uint8) -> np.ndarray:
-        _min, _max = np.min(_npy), np.max(_npy)
-        _range = _max - _min
-        normalised_img = (_npy - _min) / _range
-        range_mapped = np.uint8(normalised_img * 255)
+        # Range from the ingest stats. Only scanned for files without stats
+        _min, _max = value_range if value_range is not None else (np.nanmin(_npy), np.nanmax(_npy))
+        range_mapped = render_kernel.to_uint8(_npy, _min, _max, out=out)
         print("8 bit conversion of image", range_mapped.shape, range_mapped.dtype)
         return range_mapped
     
     @property
     def image_render(self):
-        return self.npy8[:, :, :3] # type: ignore
+        # Only the render bands are read
+        render = self.__conv_uint8(self.read_npy(bands=slice(0, 3)), band_stats.render_range(self.stats))
+        # Single band images are stored as (H, W, 1), PIL expects (H, W)
+        return render[:, :, 0] if render.shape[2] == 1 else render
+    
+    @staticmethod
+    def thumbnail_path(_uuid: str) -> str:
+        """Thumbnail JPEG written next to the upload at ingest"""
+        return os.path.join(UPLOADS_DIR, _uuid + '_thumb.jpg')
     
     @property
-    def thumbnail(self):
-        """Returns a base64 64x64 thumbnail image"""
-        pil_img = pilImage.fromarray(self.image_render)
-        pil_img = pil_img.resize((64, 64), pilImage.Resampling.LANCZOS)
+    def thumbnail(self) -> bytes:
+        """Returns the 64x64 JPEG thumbnail. Made from the npy for files read before thumbnails were stored"""
+        thumbnail_file = ImageFile.thumbnail_path(self._uuid)
+        if not os.path.exists(thumbnail_file):
+            self.__saveThumbnail(self.__decimated_npy())
+        with open(thumbnail_file, 'rb') as f:
+            return f.read()
+    
+    def __decimated_npy(self) -> np.ndarray:
+        """Strided read of the render bands from the npy file. Only every step-th row is paged in"""
+        npy = self.read_npy(bands=slice(0, 3), mmap=True)
+        step = max(1, min(npy.shape[:2]) // (4 * THUMBNAIL_SIZE))
+        return npy[::step, ::step]
+    
+    def __saveThumbnail(self, img: np.ndarray):
+        """Saves a decimated (H, W, D) image as the thumbnail. Stretched with the full image stats"""
+        img = img[:, :, :3]
+        value_range = band_stats.render_range(self.stats) or (np.nanmin(img), np.nanmax(img))
+        render = render_kernel.to_uint8(img, *value_range)
+        render = render[:, :, 0] if render.shape[2] == 1 else render
         
-        return ImageFile.to_bytes(np.array(pil_img))
+        pil_img = pilImage.fromarray(np.ascontiguousarray(render))
+        pil_img = pil_img.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), pilImage.Resampling.LANCZOS)
+        pil_img.save(ImageFile.thumbnail_path(self._uuid), format="JPEG")
     
     # @property
     # def image_full(self):
     #     return ImageFile.to_bytes(self.image_render, format="PNG")
         
     @staticmethod
-    def to_bytes(img: np.ndarray, format="JPEG") -> bytes:
-        pimg = pilImage.fromarray(img)
-
-        buf = BytesIO()
-        pimg.save(buf, format=format)
-        # buf.seek(0)
-
-        return buf.getvalue()
+    def to_bytes(img: np.ndarray, format="JPEG", tier: str = render_encoder.RENDER_TIER) -> bytes:
+        """Encodes a uint8 image. See `render_encoder` for the formats and tiers"""
+        return render_encoder.RenderEncoding(format, tier).encode(img)
     
     @staticmethod
     def base64(img: np.ndarray) -> str:
@@ -158,28 +228,72 @@ class ImageFile(File):
         
         return base64_encoded_string
     
+    def __readPIL(self, img: pilImageFile.ImageFile):
+        """Copies a decoded PIL image to the npy file in row strips.
+        
+        PIL decodes PNG and JPEG whole (single tile, no row band decoding), so the decoded image is held in memory
+        while it is copied. INGEST_WINDOW_MB only bounds the strips. The image is closed once copied.
+        """
+        img.load()
+        width, height = img.size
+        
+        # A single row gives the dtype and band count of the decoded image
+        row = np.asarray(img.crop((0, 0, width, 1)))
+        bands = 1 if row.ndim == 2 else row.shape[2]
+        rows = max(1, int(INGEST_WINDOW_MB * 2**20 // (width * bands * row.itemsize)))
+        
+        out = self.__npy_writer((height, width, bands), row.dtype)
+        stats = BandStats((height, width, bands), row.dtype)
+        for r in range(0, height, rows):
+            strip = np.asarray(img.crop((0, r, width, min(r + rows, height))))
+            strip = strip.reshape(strip.shape[0], width, bands)
+            out[r:r + rows] = strip
+            stats.update(strip)
+        img.close()
+        self.__commit_npy(out)
+        self.band_stats = stats.to_dict()
+        self.dtype, self.shape = row.dtype.str, (height, width, bands)
+    
     def __readJPG(self):
         """Read the original JPG and update details"""
         img = FileLoader.jpgLoader(self.filepath)
-        self.npy = np.array(img)
+        self.__readPIL(img)
+        
+        # JPEG decodes straight to a 1/2 ~ 1/8 scale with draft, the full image is not decoded again
+        thumb = FileLoader.jpgLoader(self.filepath)
+        thumb.draft(thumb.mode, (4 * THUMBNAIL_SIZE, 4 * THUMBNAIL_SIZE))
+        thumb = np.asarray(thumb)
+        self.__saveThumbnail(thumb.reshape(thumb.shape[0], thumb.shape[1], -1))
     
     def __readPNG(self):
-        """Read the original JPG and update details"""
-        img = FileLoader.jpgLoader(self.filepath)
-        self.npy = np.array(img)
+        """Read the original PNG and update details"""
+        img = FileLoader.pngLoader(self.filepath)
+        self.__readPIL(img)
+        self.__saveThumbnail(self.__decimated_npy())
     
     def __readTif(self):
-        """Converts a raster loaded from rasterio to an np.ndarray
+        """Streams a raster loaded from rasterio window by window into the npy file
     
         Shape transposed from (D, H, W) -> (H, W, D)
         """
-        img = FileLoader.tifLoader(self.filepath)
-        
-        bands = [img.read(i+1) for i in range(img.count)]
-        _img_bands = np.stack(bands)
-        _img_bands = _img_bands.transpose((1, 2, 0))
-        
-        self.npy = _img_bands
+        with FileLoader.tifLoader(self.filepath) as img:
+            out = self.__npy_writer((img.height, img.width, img.count), img.dtypes[0])
+            stats = BandStats((img.height, img.width, img.count), img.dtypes[0], img.nodata)
+            for window in FileLoader.ingestWindows(img):
+                block = np.moveaxis(img.read(window=window), 0, -1)
+                r, c = int(window.row_off), int(window.col_off)
+                out[r:r + block.shape[0], c:c + block.shape[1]] = block
+                stats.update(block, offset=(r, c))
+            self.__commit_npy(out)
+            self.band_stats = stats.to_dict()
+            self.dtype, self.shape = np.dtype(img.dtypes[0]).str, (img.height, img.width, img.count)
+            self.crs = img.crs.to_string() if img.crs else None
+            
+            # Decimated read. Served from the internal overviews when the raster has them
+            scale = max(1, min(img.height, img.width) // (4 * THUMBNAIL_SIZE))
+            indexes = list(range(1, min(3, img.count) + 1))
+            thumb = img.read(indexes=indexes, out_shape=(len(indexes), max(1, img.height // scale), max(1, img.width // scale)))
+            self.__saveThumbnail(np.moveaxis(thumb, 0, -1))
         
     def read(self):
         """Reads file and creates / updates .npy file in UPLOADS_DIR"""
@@ -213,6 +327,25 @@ class FileLoader:
     def tifLoader(img_path) -> rioIO.DatasetReader:
         import rasterio
         return rasterio.open(img_path)
+    
+    @staticmethod
+    def ingestWindows(img: rioIO.DatasetReader, window_mb: float = INGEST_WINDOW_MB):
+        """Yields windows aligned to the internal tiles / strips of the raster, each under window_mb"""
+        from rasterio.windows import Window
+        
+        block_h, block_w = img.block_shapes[0]
+        pixel_bytes = img.count * np.dtype(img.dtypes[0]).itemsize
+        budget_px = max(1, int(window_mb * 2**20 // pixel_bytes))
+        
+        # Full width strips of whole blocks if they fit. Else whole blocks across as many columns as fit.
+        if block_h * img.width <= budget_px:
+            rows, cols = max(1, budget_px // img.width) // block_h * block_h, img.width
+        else:
+            rows, cols = block_h, max(1, budget_px // block_h // block_w) * block_w
+        
+        for r in range(0, img.height, rows):
+            for c in range(0, img.width, cols):
+                yield Window(c, r, min(cols, img.width - c), min(rows, img.height - r))  # type: ignore
 
     
 class FileNotReadError(Exception):
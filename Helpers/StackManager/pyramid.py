@@ -0,0 +1,142 @@
+import os
+import pickle
+import math
+import numpy as np
+from Helpers import common_helpers
+from Helpers import array_access
+from Helpers import band_stats
+from Helpers import render_kernel
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+TILE_SIZE = int(os.getenv("tile_size", 256))
+# Rows processed at once while building overviews. Bounds memory while building.
+PYRAMID_STRIP_ROWS = int(os.getenv("pyramid_strip_rows", 1024))
+# -------------------------------------------------------- #
+
+
+class Pyramid:
+    """Lazily built overview pyramid for a single stack entry.
+    ---
+    1. Level 0 is the stack entry itself. Level n is level n-1 decimated by 2 in both axes.
+    2. Overview levels only keep the 3 render bands and are written to the stack dir as `<id>_pyr<n>.npy`.
+    3. Levels and the render range are built on first request and reused afterwards.
+    4. Zoom `z` follows the usual tile convention, `z = 0` fits the whole image in a single tile and `z = max_zoom` is full resolution.
+
+    :param npy_id: Stack entry id
+    :type npy_id: str
+    :param tile_size: Side of a square tile in pixels
+    :type tile_size: int
+    """
+    def __init__(self, npy_id: str, tile_size: int = TILE_SIZE):
+        self.npy_id = npy_id
+        self.tile_size = tile_size
+        self.__stem = os.path.join(common_helpers.STACK_DIR, os.path.splitext(npy_id)[0])
+
+        # Header only read, pixels are read when touched
+        base = self.level(0)
+        self.height, self.width = base.shape[:2]
+        self.dtype = base.dtype
+
+        self.max_zoom = max(0, math.ceil(math.log2(max(self.height, self.width) / self.tile_size)))
+        self.__meta = self.__load_meta()
+
+    @property
+    def __meta_file(self) -> str:
+        return self.__stem + "_pyr.pkl"
+
+    def __level_file(self, level: int) -> str:
+        return f"{self.__stem}_pyr{level}.npy"
+
+    def __load_meta(self) -> dict:
+        if os.path.exists(self.__meta_file):
+            with open(self.__meta_file, 'rb') as f:
+                return pickle.load(f)
+        return {"range": None}
+
+    def __save_meta(self):
+        with open(self.__meta_file, 'wb') as f:
+            pickle.dump(self.__meta, f)
+
+    @property
+    def info(self) -> dict:
+        return {
+            "width": self.width,
+            "height": self.height,
+            "tile_size": self.tile_size,
+            "max_zoom": self.max_zoom,
+            "dtype": str(self.dtype),
+        }
+
+    @property
+    def render_range(self) -> tuple[float, float]:
+        """Global min and max of the render bands. Read from the entry stats, computed once in strips for entries without stats."""
+        if self.__meta["range"] is None:
+            stats_range = band_stats.render_range(common_helpers.stack_npy_stats(self.npy_id))
+            if stats_range is not None:
+                self.__meta["range"] = stats_range
+                return stats_range
+            
+            base = self.level(0)
+            _min, _max = np.inf, -np.inf
+            for r in range(0, self.height, PYRAMID_STRIP_ROWS):
+                strip = base[r:r + PYRAMID_STRIP_ROWS]
+                _min = min(_min, float(np.min(strip)))
+                _max = max(_max, float(np.max(strip)))
+            self.__meta["range"] = (_min, _max)
+            self.__save_meta()
+        return self.__meta["range"]
+
+    def level(self, level: int) -> np.ndarray:
+        """Returns the lazily read array for an overview level. Builds it if missing."""
+        # Levels are only read where sliced, a tile only touches its own window
+        if level == 0:
+            base = common_helpers.open_stack_npy(self.npy_id, bands=slice(0, 3))
+            if base is None:
+                raise FileNotFoundError(self.npy_id)
+            return base   # type: ignore
+
+        level_file = self.__level_file(level)
+        if not os.path.exists(level_file):
+            self.__build_level(level)
+        return array_access.load_npy(level_file, mmap=True)
+
+    def __build_level(self, level: int):
+        """Decimates the previous level into a new level, strip by strip"""
+        prev = self.level(level - 1)
+        height, width = (prev.shape[0] + 1) // 2, (prev.shape[1] + 1) // 2
+        bands = prev.shape[2]
+
+        # Written to a temp file first so a partially built level is never served
+        tmp_file = self.__level_file(level) + ".tmp"
+        out = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=prev.dtype, shape=(height, width, bands))
+        for r in range(0, height, PYRAMID_STRIP_ROWS):
+            rows = out[r:r + PYRAMID_STRIP_ROWS]
+            rows[:] = prev[2 * r:2 * (r + rows.shape[0]):2, ::2]   # type: ignore
+        out.flush()
+        del out
+        os.replace(tmp_file, self.__level_file(level))
+        print(f"Built pyramid level {level} {(height, width, bands)} for {self.npy_id}")
+
+    def tile(self, z: int, x: int, y: int) -> np.ndarray | None:
+        """Returns the uint8 render of a single tile. None if the tile is outside the image"""
+        if not 0 <= z <= self.max_zoom:
+            return None
+
+        lvl = self.level(self.max_zoom - z)
+        y0, x0 = y * self.tile_size, x * self.tile_size
+        if x < 0 or y < 0 or y0 >= lvl.shape[0] or x0 >= lvl.shape[1]:
+            return None
+
+        window = array_access.select(lvl, (y0, x0, self.tile_size, self.tile_size))
+        return render_kernel.to_uint8(window, *self.render_range)
+
+    @staticmethod
+    def remove(npy_id: str):
+        """Removes all overview files of a stack entry"""
+        stem, _ = os.path.splitext(npy_id)
+        directory, name = os.path.split(os.path.join(common_helpers.STACK_DIR, stem))
+        pyramid_files = [f for f in os.listdir(directory) if f.startswith(name + "_pyr")]
+        common_helpers.removeFiles(*pyramid_files, dir=directory)
@@ -0,0 +1,154 @@
+import os
+import shutil
+import hashlib
+import threading
+from collections import OrderedDict
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+RENDER_CACHE_MB = float(os.getenv("render_cache_mb", 256))
+# Evicted renders are written to disk instead of being dropped (1 / 0)
+RENDER_CACHE_SPILL = bool(int(os.getenv("render_cache_spill", 0)))
+RENDER_CACHE_SPILL_MB = float(os.getenv("render_cache_spill_mb", 1024))
+# -------------------------------------------------------- #
+
+# (npy_id, render params) -> npy ids are never reused so a key always maps to the same pixels
+RenderKey = tuple[str, tuple]
+
+
+class RenderCache:
+    """Byte budgeted LRU cache for encoded renders.
+    ---
+    1. Entries are keyed by the stack npy id and the render parameters, not the stack position.
+    2. When the memory budget is exceeded the least recently used renders are evicted.
+    3. If a spill directory is set, evicted renders are moved to disk and promoted back on the next hit.
+
+    :param budget_bytes: Memory budget for cached renders
+    :type budget_bytes: int
+    :param spill_dir: Directory for the disk tier. Disk tier is disabled if None
+    :type spill_dir: str | None
+    :param spill_budget_bytes: Disk budget for the spilled renders
+    :type spill_budget_bytes: int
+    """
+    def __init__(self, budget_bytes: int, spill_dir: str | None = None, spill_budget_bytes: int = 0):
+        self.budget_bytes = budget_bytes
+        self.spill_dir = spill_dir
+        self.spill_budget_bytes = spill_budget_bytes
+
+        self.__memory: OrderedDict[RenderKey, bytes] = OrderedDict()
+        self.__memory_bytes = 0
+        self.__spilled: OrderedDict[RenderKey, int] = OrderedDict()     # key -> size on disk
+        self.__spilled_bytes = 0
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.spill_dir:
+            # Spilled files of a previous process are not indexed, start clean
+            shutil.rmtree(self.spill_dir, ignore_errors=True)
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    @classmethod
+    def fromEnv(cls, spill_dir: str) -> "RenderCache":
+        """Cache configured by `render_cache_*` env variables"""
+        return cls(
+            budget_bytes=int(RENDER_CACHE_MB * 2**20),
+            spill_dir=spill_dir if RENDER_CACHE_SPILL else None,
+            spill_budget_bytes=int(RENDER_CACHE_SPILL_MB * 2**20)
+        )
+
+    def __spill_file(self, key: RenderKey) -> str:
+        return os.path.join(self.spill_dir, hashlib.sha1(repr(key).encode()).hexdigest())  # type: ignore
+
+    def get(self, key: RenderKey) -> bytes | None:
+        with self.__lock:
+            if key in self.__memory:
+                self.__memory.move_to_end(key)
+                self.hits += 1
+                return self.__memory[key]
+
+            if key in self.__spilled:
+                with open(self.__spill_file(key), 'rb') as f:
+                    value = f.read()
+                self.__unspill(key)
+                self.spill_hits += 1
+                self.__put(key, value)
+                return value
+
+            self.misses += 1
+            return None
+
+    def put(self, key: RenderKey, value: bytes):
+        with self.__lock:
+            self.__put(key, value)
+
+    def __put(self, key: RenderKey, value: bytes):
+        if key in self.__memory:
+            self.__memory_bytes -= len(self.__memory.pop(key))
+
+        self.__memory[key] = value
+        self.__memory_bytes += len(value)
+
+        while self.__memory_bytes > self.budget_bytes and self.__memory:
+            old_key, old_value = self.__memory.popitem(last=False)
+            self.__memory_bytes -= len(old_value)
+            self.evictions += 1
+            self.__spill(old_key, old_value)
+
+    def __spill(self, key: RenderKey, value: bytes):
+        if not self.spill_dir or len(value) > self.spill_budget_bytes:
+            return
+
+        with open(self.__spill_file(key), 'wb') as f:
+            f.write(value)
+        self.__spilled[key] = len(value)
+        self.__spilled_bytes += len(value)
+
+        while self.__spilled_bytes > self.spill_budget_bytes:
+            self.__unspill(next(iter(self.__spilled)))
+
+    def __unspill(self, key: RenderKey):
+        self.__spilled_bytes -= self.__spilled.pop(key)
+        spill_file = self.__spill_file(key)
+        if os.path.exists(spill_file):
+            os.remove(spill_file)
+
+    def invalidate(self, npy_id: str):
+        """Drops all renders of a npy id from both tiers"""
+        with self.__lock:
+            for key in [k for k in self.__memory if k[0] == npy_id]:
+                self.__memory_bytes -= len(self.__memory.pop(key))
+            for key in [k for k in self.__spilled if k[0] == npy_id]:
+                self.__unspill(key)
+
+    def clear(self):
+        """Drops every render from both tiers. Counters are kept"""
+        with self.__lock:
+            self.__memory.clear()
+            self.__memory_bytes = 0
+            for key in list(self.__spilled):
+                self.__unspill(key)
+
+    @property
+    def memory_bytes(self) -> int:
+        return self.__memory_bytes
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "spill_hits": self.spill_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.__memory),
+                "bytes": self.__memory_bytes,
+                "budget_bytes": self.budget_bytes,
+                "spill_entries": len(self.__spilled),
+                "spill_bytes": self.__spilled_bytes,
+            }
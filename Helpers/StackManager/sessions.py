@@ -0,0 +1,221 @@
+import os
+import re
+import time
+import shutil
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+from Helpers import common_helpers
+from Helpers.StackManager.stackManager import StackManager, DEFAULT_SESSION, SESSIONS_DIR
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Seconds without a request after which a session is unloaded. Its stack stays on disk
+SESSION_IDLE_SECONDS = float(os.getenv("session_idle_seconds", 900))
+# MB of renders all loaded sessions may hold. Least recently used sessions are unloaded beyond it
+SESSION_MEMORY_MB = float(os.getenv("session_memory_mb", 1024))
+# Hours an unloaded session is kept on disk. Its stack entries and folder are deleted after it
+SESSION_TTL_HOURS = float(os.getenv("session_ttl_hours", 168))
+# Seconds between two scans for expired sessions
+SESSION_PURGE_INTERVAL = float(os.getenv("session_purge_interval", 600))
+# -------------------------------------------------------- #
+
+"""
+Stack managers of every session served by the Backend.
+---
+1. Each session id gets its own `StackManager`, loaded from `SESSIONS_DIR/<session id>` on first use.
+2. Requests of a session are serialised by a lock of that session. Other sessions are not blocked.
+3. Idle sessions and, beyond the memory budget, least recently used sessions are unloaded. Sessions in use are not.
+   Unloading drops the renders held in memory, the stack is saved on every change so nothing is lost.
+4. Session ids are signed by Frontend (`common_helpers.sign_session`), ids not issued by it are refused.
+5. Sessions unloaded for SESSION_TTL_HOURS are deleted from disk with their stack entries, scanned in the background.
+   DEFAULT_SESSION (requests without a session) is kept.
+6. Loading and deleting a session only hold the lock of that session, never the registry lock.
+
+USAGE::
+    with sessions.session(session_id) as stackManager:
+        stackManager.undo()
+"""
+
+SESSION_ID_PATTERN = re.compile(r"[A-Za-z0-9_-]{1,64}")
+
+
+def _touch(session_dir: str):
+    """Marks the session as used. The folder time is the last use of an unloaded session"""
+    try:
+        os.utime(session_dir)
+    except OSError:
+        pass
+
+
+class Session:
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.stack: StackManager | None = None      # Loaded by the first request, under the session lock
+        self.lock = threading.RLock()
+        self.last_used = time.monotonic()
+        self.users = 0      # Requests holding or waiting on the session. Only unloaded at 0
+
+
+class SessionRegistry:
+    """Loaded sessions, least recently used first
+
+    :param idle_seconds: Idle time after which a session is unloaded
+    :type idle_seconds: float
+    :param memory_bytes: Memory budget of all loaded sessions
+    :type memory_bytes: int
+    :param ttl_seconds: Time an unloaded session is kept on disk
+    :type ttl_seconds: float
+    """
+    def __init__(self, idle_seconds: float = SESSION_IDLE_SECONDS, memory_bytes: int = int(SESSION_MEMORY_MB * 2**20), ttl_seconds: float = SESSION_TTL_HOURS * 3600):
+        self.idle_seconds = idle_seconds
+        self.memory_bytes = memory_bytes
+        self.ttl_seconds = ttl_seconds
+        self.__sessions: dict[str, Session] = {}
+        self.__lock = threading.Lock()
+        self.__deleting: set[str] = set()       # Expired sessions being deleted, not loaded until done
+        self.__deleted = threading.Condition(self.__lock)
+        self.evictions = 0
+        self.purged = 0
+        self.__last_purge = time.monotonic()
+        self.__purging = False
+
+    @staticmethod
+    def validate(token: str | None) -> str:
+        """Session id of a token issued by Frontend. DEFAULT_SESSION if not set
+
+        :raises ValueError: Not signed by Frontend. Ids are used as folder names, only letters, digits, _ and - are allowed
+        """
+        if not token:
+            return DEFAULT_SESSION
+        session_id = common_helpers.verify_session(token)
+        if session_id is None or not SESSION_ID_PATTERN.fullmatch(session_id):
+            raise ValueError("Invalid session id")
+        return session_id
+
+    def __get(self, session_id: str) -> Session:
+        with self.__lock:
+            while session_id in self.__deleting:
+                self.__deleted.wait()
+            session = self.__sessions.pop(session_id, None)
+            if session is None:
+                session = Session(session_id)
+            self.__sessions[session_id] = session       # Moved to the end, most recently used
+            session.last_used = time.monotonic()
+            session.users += 1
+            return session
+
+    @contextmanager
+    def session(self, session_id: str = DEFAULT_SESSION) -> Iterator[StackManager]:
+        """Holds the lock of a session and yields its stack manager. Loaded from disk if it was unloaded
+
+        :param session_id: Id returned by `validate`
+        :type session_id: str
+        """
+        session = self.__get(session_id)
+        try:
+            with session.lock:
+                if session.stack is None:
+                    session.stack = StackManager(session_id)
+                yield session.stack
+        finally:
+            with self.__lock:
+                session.users -= 1
+                session.last_used = time.monotonic()
+        self.sweep()
+
+    def sweep(self):
+        """Unloads idle sessions, then least recently used ones while over the memory budget. Busy sessions are skipped"""
+        now = time.monotonic()
+        with self.__lock:
+            # Sessions not loaded yet are in use, or failed to load and are dropped
+            for session in list(self.__sessions.values()):
+                if session.stack is None and not session.users:
+                    del self.__sessions[session.id]
+            sessions = [session for session in self.__sessions.values() if session.stack is not None]
+            used = sum(session.stack.memoryBytes for session in sessions)     # type: ignore
+            for session in sessions:
+                idle = now - session.last_used > self.idle_seconds
+                frees = used > self.memory_bytes and session.stack.memoryBytes > 0
+                if session.users or not (idle or frees):
+                    continue
+                used -= session.stack.memoryBytes
+                session.stack.releaseMemory()
+                del self.__sessions[session.id]
+                _touch(session.stack.session_dir)
+                self.evictions += 1
+                print(f"Session {session.id} unloaded" + (" (idle)" if idle else ""))
+
+            purge = not self.__purging and time.monotonic() - self.__last_purge > SESSION_PURGE_INTERVAL
+            if purge:
+                self.__purging = True
+        if purge:
+            threading.Thread(target=self.purge, daemon=True).start()
+
+    def purge(self) -> int:
+        """Deletes sessions unloaded for longer than the TTL, their stack entries included. Returns the number deleted"""
+        deleted = 0
+        try:
+            now = time.time()
+            session_ids = os.listdir(SESSIONS_DIR) if os.path.exists(SESSIONS_DIR) else []
+            for session_id in session_ids:
+                session_dir = os.path.join(SESSIONS_DIR, session_id)
+                # Claimed under the registry lock, requests of the session wait for the delete. Others are not blocked
+                with self.__lock:
+                    if session_id == DEFAULT_SESSION or session_id in self.__sessions:
+                        continue
+                    try:
+                        if now - os.path.getmtime(session_dir) < self.ttl_seconds:
+                            continue
+                    except OSError:
+                        continue
+                    self.__deleting.add(session_id)
+                try:
+                    if os.path.exists(os.path.join(session_dir, "stack.pkl")):
+                        StackManager(session_id).delete()
+                    else:
+                        shutil.rmtree(session_dir, ignore_errors=True)
+                    deleted += 1
+                finally:
+                    with self.__lock:
+                        self.__deleting.discard(session_id)
+                        self.__deleted.notify_all()
+                print(f"Session {session_id} expired, deleted")
+        finally:
+            with self.__lock:
+                self.__purging = False
+                self.__last_purge = time.monotonic()
+                self.purged += deleted
+        return deleted
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            sessions = [session for session in self.__sessions.values() if session.stack is not None]
+        now = time.monotonic()
+        return {
+            "loaded": len(sessions),
+            "memory_bytes": sum(session.stack.memoryBytes for session in sessions),     # type: ignore
+            "memory_budget_bytes": self.memory_bytes,
+            "idle_seconds": self.idle_seconds,
+            "evictions": self.evictions,
+            "ttl_seconds": self.ttl_seconds,
+            "purged": self.purged,
+            "sessions": {
+                session.id: {
+                    "stack_size": len(session.stack.npy_stack),     # type: ignore
+                    "memory_bytes": session.stack.memoryBytes,     # type: ignore
+                    "idle_seconds": round(now - session.last_used, 1),
+                }
+                for session in sessions
+            },
+        }
+
+
+registry = SessionRegistry()
+
+def session(session_id: str = DEFAULT_SESSION):
+    """`SessionRegistry.session` of the registry of this process"""
+    return registry.session(session_id)
@@ -7,11 +7,22 @@ _cwd = os.path.abspath(os.getcwd())
 STACK_DIR:str = os.getenv("stack_dir", r"Data\Session\Stack")
 STACK_DIR = os.path.join(_cwd, STACK_DIR)
 os.makedirs(STACK_DIR, exist_ok=True) # Makes directory if not present.
+# Per session state (stack.pkl, spilled renders) is kept in STACK_DIR/sessions/<session id>
+SESSIONS_DIR = os.path.join(STACK_DIR, "sessions")
 # -------------------------------------------------------- #
 
+DEFAULT_SESSION = "default"
+
 import pickle
 import numpy as np
 from Helpers import common_helpers
+from Helpers import catalogue
+from Helpers import band_stats
+from Helpers import render_kernel
+from Helpers.render_encoder import RenderEncoding
+from Helpers.StackManager.pyramid import Pyramid
+from Helpers.StackManager.renderCache import RenderCache
+from Helpers.TransformationClass.transformation import Transformation
 import shutil
 from functools import lru_cache
 
@@ -19,7 +30,11 @@ class StackManager:
     """The stack manager maintains the stack for the session.
     ---
     1. It allows for capabilities for undo / redo and list of transformation histories.
-    2. To reset the stack, simply remove the stack folder.
+    2. Each session has its own stack manager. Stack entries share the stack store, their ids are unique.
+    3. To reset the stack, simply remove the session folder and the entries of the stack.
+    
+    :param session_id: Session the stack belongs to. State is saved in `SESSIONS_DIR/<session_id>`
+    :type session_id: str
     
     :param canonical_npy: Contains the list of npy file names within the current edit session
     :type canonical_npy: list[str]
@@ -34,12 +49,25 @@ class StackManager:
     :param currentImage: Returns the current Image np.ndarray read from disk
     :type currentImage: np.ndarray
     """
-    def __init__(self):
-        # os.makedirs ensures that the stack folder exists
+    def __init__(self, session_id: str = DEFAULT_SESSION):
+        # os.makedirs ensures that the session folder exists
         # If stack.pkl exists, previous session can be retrieved
-        print("Initilising Stack Manager")
+        print("Initilising Stack Manager", session_id)
+        
+        self.session_id = session_id
+        self.session_dir = os.path.join(SESSIONS_DIR, session_id)
+        os.makedirs(self.session_dir, exist_ok=True)
+        self.stack_pkl = os.path.join(self.session_dir, "stack.pkl")
+        # Content hash of every render served. Saved with the stack, so a render stays addressable by its hash after
+        # it is evicted or the session is unloaded
+        self.__render_hashes: dict[tuple, str] = {}
+        self.__hash_keys: dict[str, tuple] = {}
+        
+        # Single session stack of older versions becomes the default session
+        legacy_pkl = os.path.join(STACK_DIR, "stack.pkl")
+        if session_id == DEFAULT_SESSION and os.path.exists(legacy_pkl) and not os.path.exists(self.stack_pkl):
+            os.replace(legacy_pkl, self.stack_pkl)
         
-        self.stack_pkl = os.path.join(STACK_DIR, "stack.pkl")
         if os.path.exists(self.stack_pkl):
             print("Previous Session Found!")
             self.__retrieve_session()
@@ -47,7 +75,9 @@ class StackManager:
             self.npy_stack:list[str] = []
             self.parent_uuid: str | None = None
             self.current_pointer = -1
-            self.__png_cache: dict[int, bytes] = {}
+        
+        self.__render_cache = RenderCache.fromEnv(spill_dir=os.path.join(self.session_dir, "render_cache"))
+        self.__pyramids: dict[str, Pyramid] = {}
         
         print(f"""Initialised Stack Manager\n
               \tImage Stack: {len(self.npy_stack)}
@@ -57,7 +87,7 @@ class StackManager:
         
     def __retrieve_session(self):
         if not os.path.exists(self.stack_pkl):
-            self.__init__()
+            self.__init__(self.session_id)
             return
         
         """Reads directory to get previous session details"""
@@ -70,27 +100,56 @@ class StackManager:
         self.npy_stack = prev_session.npy_stack
         self.current_pointer = prev_session.current_pointer
         self.parent_uuid = prev_session.parent_uuid
+        # Stacks saved by older versions have no hashes
+        self.__render_hashes = getattr(prev_session, "render_hashes", {})
+        self.__hash_keys = {render_hash: key for key, render_hash in self.__render_hashes.items()}
     
-    def __save_session(self):
+    def __getstate__(self):
+        """Only the stack and the render hashes are persisted. Render caches and pyramids are rebuilt on demand"""
+        return {
+            "session_id": self.session_id,
+            "stack_pkl": self.stack_pkl,
+            "npy_stack": self.npy_stack,
+            "parent_uuid": self.parent_uuid,
+            "current_pointer": self.current_pointer,
+            "render_hashes": self.__render_hashes,
+        }
+    
+    def __save_state(self):
         """Over writes the stack file"""
         with open(self.stack_pkl, 'wb') as stack_file:
             pickle.dump(self, stack_file)
+    
+    def __save_session(self):
+        """Over writes the stack file and the stack entries of the session in the catalogue"""
+        self.__save_state()
+        catalogue.set_stack_entries(self.session_id, self.npy_stack, self.parent_uuid)
 
     def reset(self):
         """Resets the stack"""
-        # Remove the directory and just make it again :)
-        print("Resetting Stack")
-        shutil.rmtree(STACK_DIR)
-        os.makedirs(STACK_DIR, exist_ok=True)       
-        self.__init__()       # Updates the stack vars
+        # Remove the entries and the session directory and just make it again :)
+        print("Resetting Stack", self.session_id)
+        self.__remove_npy(*self.npy_stack)
+        shutil.rmtree(self.session_dir)
+        catalogue.set_stack_entries(self.session_id, [], None)
+        self.__init__(self.session_id)       # Updates the stack vars
         # It is that simple :D
         
-    def resetImage(self, npy_id: str):
+    def delete(self):
+        """Deletes the session, its entries and its folder. The stack manager is not usable afterwards"""
+        print("Deleting Session", self.session_id)
+        self.__remove_npy(*self.npy_stack)
+        shutil.rmtree(self.session_dir, ignore_errors=True)
+        catalogue.set_stack_entries(self.session_id, [], None)
+        
+    def resetImage(self, npy_id: str, parent_uuid: str | None = None):
+        """Starts a new stack with npy_id, made from the upload parent_uuid"""
         self.current_pointer = 0
+        self.parent_uuid = parent_uuid
         
         # Removes all other files from stack
         _removed_npy = self.npy_stack
-        common_helpers.removeFiles(*_removed_npy, dir=STACK_DIR)
+        self.__remove_npy(*_removed_npy)
         
         self.npy_stack = [npy_id+".npy"]
         
@@ -112,7 +171,7 @@ class StackManager:
 
         # Removes all entries from stack after insert position
         _removed_npy = self.npy_stack[self.current_pointer:]
-        common_helpers.removeFiles(*_removed_npy, dir=STACK_DIR)
+        self.__remove_npy(*_removed_npy)
         
         # Add entry to stack.
         self.npy_stack = self.npy_stack[:self.current_pointer]
@@ -123,6 +182,17 @@ class StackManager:
         
         self.__save_session()
 
+    def __remove_npy(self, *npy_files: str):
+        """Removes stack npy files along with their overview pyramids and transformation nodes"""
+        common_helpers.remove_stack_npy(*npy_files)
+        for npy_file in npy_files:
+            Transformation.remove(npy_file)
+            self.__render_cache.invalidate(npy_file)
+            for key in [k for k in self.__render_hashes if k[0] == npy_file]:
+                self.__hash_keys.pop(self.__render_hashes.pop(key), None)
+            self.__pyramids.pop(npy_file, None)
+            Pyramid.remove(npy_file)
+    
     def undo(self) -> bool:
         if self.undoPossible:
             self.current_pointer -= 1
@@ -145,34 +215,138 @@ class StackManager:
     def redoPossible(self) -> bool:
         return self.current_pointer < len(self.npy_stack) -1
     
-    def __conv_uint8(self, _npy):
-        """Returns the npy in uint8"""
+    def __conv_uint8(self, _npy, value_range: tuple[float, float] | None = None):
+        """Returns the npy in uint8. Non uint8 renders are written to the reusable render buffer, encode them before the next render"""
         if _npy.dtype == np.uint8:
-            return _npy
+            return np.asarray(_npy)
         
-        _min, _max = np.min(_npy), np.max(_npy)
-        _range = _max - _min
-        normalised_img = (_npy - _min) / _range
-        range_mapped = np.uint8(normalised_img * 255)
+        # Range from the stats of the stack entry. Only scanned for entries without stats
+        if value_range is None:
+            value_range = float(np.nanmin(np.asarray(_npy))), float(np.nanmax(np.asarray(_npy)))
+        _min, _max = value_range
+        range_mapped = render_kernel.to_uint8(_npy, _min, _max, out=render_kernel.render_buffer(_npy.shape))
         print("8 bit conversion of image", range_mapped.shape, range_mapped.dtype)
         return range_mapped
     
     # @lru_cache
-    def getCurrentImage(self) -> bytes | None:
-        """Returns the image for render"""
+    def getCurrentImage(self, encoding: RenderEncoding | None = None) -> bytes | None:
+        """Returns the image for render. PNG of the default tier if no encoding is given"""
         
         if self.current_pointer <= -1:
             return None
         
-        if self.current_pointer in self.__png_cache:
-            return self.__png_cache[self.current_pointer]
+        return self.__render_full(self.npy_stack[self.current_pointer], encoding or RenderEncoding())
+    
+    def __render_full(self, npy_file: str, encoding: RenderEncoding) -> bytes:
+        key = (npy_file, ("full", *encoding.key))
+        img_bytes = self.__render_cache.get(key)
+        if img_bytes is not None:
+            return img_bytes
+        
+        # Read strip by strip by the render kernel, only the uint8 output is held whole
+        npy = common_helpers.open_stack_npy(npy_file, bands=slice(0, 3))
+        
+        img8 = self.__conv_uint8(npy, band_stats.render_range(common_helpers.stack_npy_stats(npy_file)))
+        img_bytes = encoding.encode(img8) # pyright: ignore[reportArgumentType]
+        self.__render_cache.put(key, img_bytes)
+        self.__remember_hash(key, img_bytes)
+        return img_bytes
+    
+    def __remember_hash(self, key: tuple, img_bytes: bytes) -> str:
+        render_hash = self.__render_hashes.get(key)
+        if render_hash is None:
+            render_hash = common_helpers.content_hash(img_bytes)
+            self.__render_hashes[key] = render_hash
+            self.__hash_keys[render_hash] = key
+            self.__save_state()
+        return render_hash
+    
+    def currentRenderHash(self, encoding: RenderEncoding | None = None) -> str | None:
+        """Content hash of the render of the current image. Known hashes are returned without rendering"""
+        if self.current_pointer <= -1:
+            return None
         
-        npy_file = self.npy_stack[self.current_pointer]
-        npy_file = os.path.join(STACK_DIR, npy_file)
-        with open(npy_file, 'rb') as f:
-            npy = np.load(f)
+        encoding = encoding or RenderEncoding()
+        key = (self.npy_stack[self.current_pointer], ("full", *encoding.key))
+        render_hash = self.__render_hashes.get(key)
+        if render_hash is None:
+            render_hash = self.__remember_hash(key, self.__render_full(key[0], encoding))
+        return render_hash
+    
+    def getRender(self, render_hash: str) -> tuple[bytes, RenderEncoding] | None:
+        """Render of a stack entry addressed by its content hash and its encoding. None if the hash was never served by this stack"""
+        key = self.__hash_keys.get(render_hash)
+        if key is None or key[0] not in self.npy_stack:
+            return None
         
-        img8 = self.__conv_uint8(npy[:, :, :3])
-        png_bytes = common_helpers.image_bytes(img8) # pyright: ignore[reportArgumentType]
-        self.__png_cache[self.current_pointer] = png_bytes
-        return png_bytes
\ No newline at end of file
+        encoding = RenderEncoding(*key[1][1:])
+        img_bytes = self.__render_full(key[0], encoding)
+        # Rendered again after an eviction. Encoder settings changed since then give other bytes, never served under the old hash
+        if common_helpers.content_hash(img_bytes) != render_hash:
+            self.__render_cache.invalidate(key[0])
+            self.__hash_keys.pop(self.__render_hashes.pop(key), None)
+            self.__save_state()
+            return None
+        return img_bytes, encoding
+    
+    def __pyramid(self, npy_file: str | None = None) -> Pyramid | None:
+        """Returns the pyramid of a stack entry. Defaults to the current entry"""
+        if npy_file is None:
+            if self.current_pointer <= -1:
+                return None
+            npy_file = self.npy_stack[self.current_pointer]
+        elif npy_file not in self.npy_stack:
+            return None
+        
+        if npy_file not in self.__pyramids:
+            self.__pyramids[npy_file] = Pyramid(npy_file)
+        return self.__pyramids[npy_file]
+    
+    def getTileInfo(self) -> dict | None:
+        """Returns the tile grid of the current image"""
+        pyramid = self.__pyramid()
+        if pyramid is None:
+            return None
+        
+        return {
+            "npy_id": self.npy_stack[self.current_pointer],
+            **pyramid.info
+        }
+    
+    def getTile(self, z: int, x: int, y: int, npy_file: str | None = None, encoding: RenderEncoding | None = None) -> bytes | None:
+        """Returns a single tile of a stack entry. Defaults to the current entry and a PNG of the default tier"""
+        pyramid = self.__pyramid(npy_file)
+        if pyramid is None:
+            return None
+        
+        encoding = encoding or RenderEncoding()
+        key = (pyramid.npy_id, ("tile", z, x, y, pyramid.tile_size, *encoding.key))
+        img_bytes = self.__render_cache.get(key)
+        if img_bytes is not None:
+            return img_bytes
+        
+        tile = pyramid.tile(z, x, y)
+        if tile is None:
+            return None
+        img_bytes = encoding.encode(tile)
+        self.__render_cache.put(key, img_bytes)
+        return img_bytes
+    
+    def releaseMemory(self):
+        """Drops renders and pyramids held in memory. Rebuilt on demand, the stack itself is on disk"""
+        self.__render_cache.clear()
+        self.__pyramids.clear()
+    
+    @property
+    def memoryBytes(self) -> int:
+        """Bytes of renders held in memory"""
+        return self.__render_cache.memory_bytes
+    
+    @property
+    def renderCacheStats(self) -> dict:
+        return self.__render_cache.stats
+    
+    @property
+    def storageStats(self) -> dict:
+        """Compression ratio and bytes saved by the chunked stack store"""
+        return common_helpers.stack_store.stats
@@ -1,22 +1,285 @@
+import os
 import time
+import pickle
+import numpy as np
+from typing import Callable, Any
+from Helpers import common_helpers
+from Helpers.ChunkStore.chunkStore import ChunkedArray
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+STACK_DIR = common_helpers.STACK_DIR
+# Rows computed at once while running fused pointwise ops. Bounds memory of a materialisation.
+FUSION_STRIP_ROWS = int(os.getenv("fusion_strip_rows", 512))
+# Pointwise ops fused in a single run. Longer runs are split, see `TransformationManager`
+FUSION_MAX_OPS = int(os.getenv("fusion_max_ops", 8))
+# -------------------------------------------------------- #
+
+
+def _stem(npy_id: str) -> str:
+    return os.path.splitext(npy_id)[0]
+
 
 class Transformation:
-    def __init__(self, operation: str, input_npy_id: str, params: dict):
+    """A single node of the transformation graph.
+    ---
+    The output of a transformation is a stack entry. It is only computed (materialised) when its pixels are needed.
+    Nodes are saved as `<output id>.node.pkl` in the stack dir.
+    """
+    def __init__(self, operation: str, input_npy_id: str, params: dict, output_npy_id: str | None = None):
         self.operation = operation
         self.input_npy_id = input_npy_id
         self.params = params
+        self.output_npy_id = output_npy_id or common_helpers.generate_uuid()
         self.time = time.ctime(time.time())
 
     def __repr__(self):
         out_str = f"""Tranformation performed:{{
             "Operation": {self.operation},
             "Input File ID": {self.input_npy_id},
+            "Output File ID": {self.output_npy_id},
             "Parameters": {self.params},
             "Time": {self.time}
         }}"""
-        
+
         return out_str
-    
-class TransformatioManager:
-    def __init__(self):
-        pass
\ No newline at end of file
+
+    @staticmethod
+    def node_file(npy_id: str) -> str:
+        return os.path.join(STACK_DIR, _stem(npy_id) + ".node.pkl")
+
+    def save(self):
+        with open(Transformation.node_file(self.output_npy_id), 'wb') as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(npy_id: str) -> "Transformation | None":
+        node_file = Transformation.node_file(npy_id)
+        if not os.path.exists(node_file):
+            return None
+        with open(node_file, 'rb') as f:
+            return pickle.load(f)
+
+    @staticmethod
+    def remove(npy_id: str):
+        common_helpers.removeFile(Transformation.node_file(npy_id))
+
+
+class PointwiseOp:
+    """An operation where each output pixel only depends on the same input pixel.
+    ---
+    Consecutive pointwise ops are fused and run together strip by strip in a single pass.
+
+    :param apply: `apply(chunk, ctx) -> chunk` Runs the op on a strip of rows
+    :type apply: Callable
+    :param prepare: `prepare(src, stats, **params) -> ctx` Computes data dependent constants of the op input.
+        src is read strip by strip (see `FusedView`), stats are the band stats recorded for it or None. Params are passed as is when not set
+    :type prepare: Callable | None
+    :param validate: `validate(**params)` Raises ValueError for invalid params. Called when the node is recorded
+    :type validate: Callable | None
+    :param monotone: The output never decreases when the input increases, band by band. The band min / max of its output
+        are then the op run on the band min / max of its input, and are passed to the next op without reading
+    :type monotone: bool
+    """
+    def __init__(self, apply: Callable[[np.ndarray, Any], np.ndarray], prepare: Callable[..., Any] | None = None, validate: Callable[..., None] | None = None, monotone: bool = False):
+        self.apply = apply
+        self.prepare = prepare or (lambda src, stats, **params: params)
+        self.validate = validate or (lambda **params: None)
+        self.monotone = monotone
+
+    def output_stats(self, ctx, stats: dict | None, dtype) -> dict | None:
+        """Band min / max of the output from the band min / max of the input. None if not monotone or not known"""
+        if stats is None or not self.monotone:
+            return None
+        mins, maxs = np.asarray(stats["min"], dtype=np.float64), np.asarray(stats["max"], dtype=np.float64)
+        if not (np.all(np.isfinite(mins)) and np.all(np.isfinite(maxs))):
+            return None
+        # A 1 x 2 image of the band min and max, run through the op like any strip
+        out = self.apply(np.stack([mins, maxs])[np.newaxis].astype(dtype), ctx).astype(np.float64)
+        return {"min": out[0, 0].tolist(), "max": out[0, 1].tolist()}
+
+
+class TransformationManager:
+    """Lazy transformation graph over the stack.
+    ---
+    1. `record` only saves a node. No pixels are read or written.
+    2. `materialise` walks back to the nearest materialised ancestor and runs the pending nodes.
+    3. Runs of pointwise ops are fused so the data is read and written once for the whole run.
+    4. The constants of each op in a run are prepared on its exact input. Band min / max come from the recorded stats and are
+       carried through monotone ops. A prepare that reads its input (normalise percentiles) reads the run input through the ops
+       before it, one pass each. Runs are split after FUSION_MAX_OPS ops to bound those passes.
+
+    :param ops: Maps operation to a function `op(npy, **params) -> np.ndarray` run on the full image
+    :type ops: dict[str, Callable]
+    :param pointwise: Maps operation to its fusable definition
+    :type pointwise: dict[str, PointwiseOp]
+    """
+    def __init__(self, ops: dict[str, Callable[..., np.ndarray]], pointwise: dict[str, PointwiseOp]):
+        self.ops = ops
+        self.pointwise = pointwise
+
+    @staticmethod
+    def isMaterialised(npy_id: str) -> bool:
+        return common_helpers.stack_npy_exists(npy_id)
+
+    def exists(self, npy_id: str) -> bool:
+        return self.isMaterialised(npy_id) or os.path.exists(Transformation.node_file(npy_id))
+
+    def record(self, operation: str, input_npy_id: str, params: dict) -> str:
+        """Adds a node to the graph and returns the id of its output"""
+        if operation not in self.ops and operation not in self.pointwise:
+            raise NotImplementedError
+        if not self.exists(input_npy_id):
+            raise FileNotFoundError
+        if operation in self.pointwise:
+            self.pointwise[operation].validate(**params)
+
+        node = Transformation(operation, input_npy_id, params)
+        node.save()
+        return node.output_npy_id
+
+    def chain(self, npy_id: str) -> tuple[str, list[Transformation]]:
+        """Returns the nearest materialised ancestor and the pending nodes from it to npy_id"""
+        nodes: list[Transformation] = []
+        while not self.isMaterialised(npy_id):
+            node = Transformation.load(npy_id)
+            if node is None:
+                raise FileNotFoundError(npy_id)
+            nodes.append(node)
+            npy_id = node.input_npy_id
+        return npy_id, nodes[::-1]
+
+    def __groups(self, nodes: list[Transformation]) -> list[list[Transformation]]:
+        """Splits pending nodes into runs of fusable pointwise ops and single non pointwise ops"""
+        groups: list[list[Transformation]] = []
+        for node in nodes:
+            fusable = node.operation in self.pointwise
+            if fusable and groups and groups[-1][0].operation in self.pointwise and len(groups[-1]) < FUSION_MAX_OPS:
+                groups[-1].append(node)
+            else:
+                groups.append([node])
+        return groups
+
+    def materialise(self, npy_id: str, handoff: bool = False, progress: Callable[[float], None] | None = None) -> bool:
+        """Computes and saves the pixels of npy_id. Returns False if it was already materialised.
+        With handoff the output is put in shared memory for the caller and saved to the stack in the background.
+
+        :param progress: Called with the done fraction (0 ~ 1) between steps. An exception raised by it stops the run
+        :type progress: Callable[[float], None] | None
+        """
+        base_id, nodes = self.chain(npy_id)
+        if not nodes:
+            return False
+
+        print(f"Materialising {npy_id} from {base_id} ({len(nodes)} pending)")
+        report = progress or (lambda done: None)
+        npy = common_helpers.open_stack_npy(base_id)
+        groups = self.__groups(nodes)
+        # Recorded stats of the base entry. Carried through the runs of pointwise ops while they are known
+        stats = common_helpers.stack_npy_stats(base_id)
+
+        for i, group in enumerate(groups):
+            report(i / len(groups))
+            last = i == len(groups) - 1
+            if group[0].operation in self.pointwise:
+                group_report = lambda done, i=i: report((i + done) / len(groups))
+                npy, stats = self.__run_fused(npy, group, stats, out_id=npy_id if last else None, handoff=handoff, progress=group_report)
+            else:
+                node = group[0]
+                npy = self.ops[node.operation](np.asarray(npy), **node.params)
+                stats = None
+
+        if not self.isMaterialised(npy_id):
+            common_helpers.save_stack_npy(_stem(npy_id), npy, handoff=handoff)
+        report(1.0)
+        return True
+
+    def __run_fused(self, npy: np.ndarray | ChunkedArray, group: list[Transformation], stats: dict | None, out_id: str | None, handoff: bool = False, progress: Callable[[float], None] | None = None) -> tuple[np.ndarray | ChunkedArray, dict | None]:
+        """Runs a run of pointwise ops in a single pass. Writes straight to the stack if out_id is set.
+        Returns the output and its band min / max if they are known
+
+        :param stats: Band stats of npy. The min / max of the input of each later op are carried through the ops before it
+        :type stats: dict | None
+        """
+        ops = [self.pointwise[node.operation] for node in group]
+        height, width = npy.shape[:2]
+
+        # Data dependent constants of each op are prepared on its exact input, the same as the op run on the full image
+        src = FusedView(npy)
+        ctxs = []
+        for op, node in zip(ops, group):
+            ctx = op.prepare(src, stats, **node.params)
+            ctxs.append(ctx)
+            stats = op.output_stats(ctx, stats, src.dtype)
+            src = src.then(op, ctx)
+
+        out_shape = src.shape
+        if out_id is None:
+            out = np.empty(out_shape, dtype=src.dtype)
+        else:
+            out = common_helpers.stack_writer(out_id, out_shape, src.dtype, handoff=handoff)
+
+        try:
+            for r in range(0, height, FUSION_STRIP_ROWS):
+                if progress is not None:
+                    progress(r / height)
+                chunk = npy[r:r + FUSION_STRIP_ROWS]
+                for op, ctx in zip(ops, ctxs):
+                    chunk = op.apply(chunk, ctx)
+                if out_id is None:
+                    out[r:r + FUSION_STRIP_ROWS] = chunk
+                else:
+                    out.write(chunk)     # type: ignore
+        except BaseException:
+            if out_id is not None:
+                out.abort()     # type: ignore
+            raise
+
+        if out_id is not None:
+            out.close()     # type: ignore
+            return common_helpers.open_stack_npy(out_id), stats     # type: ignore
+        return out, stats
+
+
+class FusedView:
+    """Read only view of an image pushed through pointwise ops. Only the rows sliced are read and computed.
+    ---
+    Lets the ops of a fused run read their exact input strip by strip without it ever being written.
+
+    :param npy: Input of the first op
+    :type npy: np.ndarray | ChunkedArray
+    """
+    def __init__(self, npy: np.ndarray | ChunkedArray, ops: tuple[PointwiseOp, ...] = (), ctxs: tuple = ()):
+        self.npy = npy
+        self.ops = ops
+        self.ctxs = ctxs
+        # Output band count and dtype of the ops, from the first row
+        first = self.__rows(slice(0, 1))
+        self.shape = (npy.shape[0], npy.shape[1]) + first.shape[2:]
+        self.dtype = first.dtype
+        self.ndim = len(self.shape)
+
+    def then(self, op: PointwiseOp, ctx) -> "FusedView":
+        return FusedView(self.npy, self.ops + (op,), self.ctxs + (ctx,))
+
+    def __rows(self, rows: slice) -> np.ndarray:
+        chunk = np.asarray(self.npy[rows])
+        for op, ctx in zip(self.ops, self.ctxs):
+            chunk = op.apply(chunk, ctx)
+        return chunk
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        if not isinstance(key, tuple):
+            key = (key,)
+        if not isinstance(key[0], slice):
+            raise TypeError("FusedView only supports slices for rows")
+        return self.__rows(key[0])[(slice(None),) + key[1:]]
+
+    def __array__(self, dtype=None, copy=None):
+        npy = self.__rows(slice(None))
+        return npy if dtype is None else npy.astype(dtype)
@@ -0,0 +1,63 @@
+import os
+import numpy as np
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Opt in to memory mapped reads. Pixels are then only paged in when touched.
+MMAP_NPY = bool(int(os.getenv("npy_mmap", 0)))
+# -------------------------------------------------------- #
+
+# (y, x, height, width) measured from the upper left of the image. Same as the clip offsets.
+Window = tuple[int, int, int, int]
+Bands = int | slice | list[int] | None
+
+
+def load_npy(npy_file: str, window: Window | None = None, bands: Bands = None, mmap: bool | None = None) -> np.ndarray:
+    """Reads a (H, W, D) npy file and returns a read only array.
+
+    :param npy_file: Fully qualified path of the npy file
+    :type npy_file: str
+    :param window: Region to read as (y, x, height, width). Reads the full image if None
+    :type window: Window | None
+    :param bands: Band index, slice or list of band indices to read. Reads all bands if None
+    :type bands: Bands
+    :param mmap: Memory map the file instead of reading it. Defaults to `npy_mmap` from env
+    :type mmap: bool | None
+    """
+    if mmap is None:
+        mmap = MMAP_NPY
+
+    npy = np.load(npy_file, mmap_mode='r' if mmap else None)
+    view = select(npy, window, bands)
+
+    # Without mmap the selection is copied so the rest of the file can be freed
+    if not mmap and (window is not None or bands is not None):
+        view = view.copy()
+
+    view.flags.writeable = False
+    return view
+
+
+def select(npy: np.ndarray, window: Window | None = None, bands: Bands = None) -> np.ndarray:
+    """Returns a view of a window and band subset of a (H, W) or (H, W, D) array"""
+    if window is not None:
+        y, x, height, width = window
+        npy = npy[y:y + height, x:x + width]
+
+    if bands is not None and npy.ndim == 3:
+        if isinstance(bands, int):
+            bands = slice(bands, bands + 1)
+        # Contiguous band lists are kept as slices so the result stays a view
+        if isinstance(bands, list) and bands and bands == list(range(bands[0], bands[-1] + 1)):
+            bands = slice(bands[0], bands[-1] + 1)
+        npy = npy[:, :, bands]
+
+    return npy
+
+
+def npy_header(npy_file: str) -> tuple[tuple[int, ...], np.dtype]:
+    """Returns the shape and dtype of a npy file without reading the pixels"""
+    npy = np.load(npy_file, mmap_mode='r')
+    return npy.shape, npy.dtype
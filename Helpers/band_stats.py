@@ -0,0 +1,154 @@
+import os
+import math
+import numpy as np
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Bins of the coarse per band histogram
+STATS_HIST_BINS = int(os.getenv("stats_hist_bins", 64))
+# Pixels sampled for the histogram of float and wide integer images. 8 and 16 bit images are counted exactly.
+STATS_SAMPLE_PX = int(os.getenv("stats_sample_px", 1_000_000))
+# -------------------------------------------------------- #
+
+"""
+Per band statistics of an (H, W, D) image, accumulated strip by strip while the image is written.
+
+STATS::
+{
+    "bands": 3,
+    "min": [..], "max": [..], "mean": [..],     -> Per band, NaN ignored
+    "count": [..],                               -> Valid (non NaN) pixels per band
+    "nodata": [..],                              -> Pixels equal to nodata_value or NaN per band
+    "nodata_value": 0 | None,
+    "hist": [[..], ..],                          -> STATS_HIST_BINS counts per band
+    "hist_range": [[lo, hi], ..],                -> Range covered by the histogram of each band
+    "hist_exact": True | False                   -> False when the histogram is built from a sample
+}
+"""
+
+
+class BandStats:
+    """Streaming accumulator of per band statistics.
+    ---
+    Call `update` with consecutive row strips of the image, then `to_dict`.
+
+    :param shape: (H, W, D) or (H, W) shape of the full image
+    :type shape: tuple[int, ...]
+    :param dtype: dtype of the image
+    :param nodata: Value counted as nodata. NaN is always counted
+    :type nodata: float | None
+    """
+    def __init__(self, shape: tuple[int, ...], dtype, nodata: float | None = None):
+        height, width = shape[:2]
+        bands = shape[2] if len(shape) == 3 else 1
+        self.dtype = np.dtype(dtype)
+        self.nodata = nodata
+
+        self.min = np.full(bands, np.inf)
+        self.max = np.full(bands, -np.inf)
+        self.sum = np.zeros(bands, dtype=np.float64)
+        self.count = np.zeros(bands, dtype=np.int64)
+        self.nodata_count = np.zeros(bands, dtype=np.int64)
+        self.hist = np.zeros((bands, STATS_HIST_BINS), dtype=np.int64)
+
+        # 8 / 16 bit integers are binned over the dtype range while streaming. Others from a sample once the range is known.
+        self.__exact_hist = np.issubdtype(self.dtype, np.integer) and self.dtype.itemsize <= 2
+        if self.__exact_hist:
+            info = np.iinfo(self.dtype)
+            self.__hist_lo = int(info.min)
+            self.__hist_hi = int(info.max) + 1
+            self.__bin_width = max(1, (self.__hist_hi - self.__hist_lo) // STATS_HIST_BINS)
+        else:
+            self.__step = max(1, math.ceil(math.sqrt(height * width / STATS_SAMPLE_PX)))
+            self.__samples: list[np.ndarray] = []
+        self.__rows_seen = 0
+
+    def update(self, rows: np.ndarray, offset: tuple[int, int] | None = None):
+        """Adds the next strip of rows. Pass the (y, x) offset of the block when not adding full width strips in order"""
+        rows = np.asarray(rows)
+        if rows.ndim == 2:
+            rows = rows[..., np.newaxis]
+        if not rows.size:
+            return
+
+        is_float = np.issubdtype(rows.dtype, np.floating)
+        for b in range(rows.shape[2]):
+            band = rows[:, :, b]
+            nan_count = int(np.count_nonzero(np.isnan(band))) if is_float else 0
+            valid = band.size - nan_count
+            self.nodata_count[b] += nan_count
+            if self.nodata is not None and not (is_float and np.isnan(self.nodata)):
+                self.nodata_count[b] += int(np.count_nonzero(band == self.nodata))
+            if not valid:
+                continue
+
+            self.min[b] = min(self.min[b], float(np.nanmin(band)))
+            self.max[b] = max(self.max[b], float(np.nanmax(band)))
+            self.sum[b] += float(np.nansum(band, dtype=np.float64))
+            self.count[b] += valid
+
+            if self.__exact_hist:
+                bins = (band.astype(np.int32) - self.__hist_lo) // self.__bin_width
+                self.hist[b] += np.bincount(bins.ravel(), minlength=STATS_HIST_BINS)[:STATS_HIST_BINS]
+
+        y, x = offset if offset is not None else (self.__rows_seen, 0)
+        if not self.__exact_hist:
+            # Strided sample aligned to the full image, not the block
+            first_y, first_x = (-y) % self.__step, (-x) % self.__step
+            sample = rows[first_y::self.__step, first_x::self.__step].astype(np.float64)
+            self.__samples.append(sample.reshape(-1, 1, rows.shape[2]))
+        self.__rows_seen += rows.shape[0]
+
+    def __sampled_hist(self) -> list[list[float]]:
+        sample = np.concatenate(self.__samples) if self.__samples else np.empty((0, 1, len(self.min)))
+        ranges = []
+        for b in range(len(self.min)):
+            lo, hi = (float(self.min[b]), float(self.max[b])) if self.count[b] else (0.0, 0.0)
+            ranges.append([lo, hi])
+            if not self.count[b]:
+                continue
+            # NaN lies outside the range and is not counted. Counts are scaled back to the full image
+            counts = np.histogram(sample[:, :, b], bins=STATS_HIST_BINS, range=(lo, hi if hi > lo else lo + 1))[0]
+            self.hist[b] = np.rint(counts * self.__step ** 2).astype(np.int64)
+        return ranges
+
+    def to_dict(self) -> dict:
+        if self.__exact_hist:
+            hist_range = [[self.__hist_lo, self.__hist_lo + self.__bin_width * STATS_HIST_BINS]] * len(self.min)
+        else:
+            hist_range = self.__sampled_hist()
+
+        valid = self.count > 0
+        return {
+            "bands": len(self.min),
+            "min": np.where(valid, self.min, np.nan).tolist(),
+            "max": np.where(valid, self.max, np.nan).tolist(),
+            "mean": np.where(valid, self.sum / np.maximum(self.count, 1), np.nan).tolist(),
+            "count": self.count.tolist(),
+            "nodata": self.nodata_count.tolist(),
+            "nodata_value": self.nodata,
+            "hist": self.hist.tolist(),
+            "hist_range": hist_range,
+            "hist_exact": self.__exact_hist,
+        }
+
+
+def compute_stats(npy: np.ndarray, nodata: float | None = None, strip_rows: int = 1024) -> dict:
+    """Stats of an existing array, read strip by strip"""
+    stats = BandStats(npy.shape, npy.dtype, nodata)
+    for r in range(0, npy.shape[0], strip_rows):
+        stats.update(npy[r:r + strip_rows])
+    return stats.to_dict()
+
+
+def render_range(stats: dict | None, bands: slice | list[int] = slice(0, 3)) -> tuple[float, float] | None:
+    """Global min and max over the render bands. None if the stats are unknown"""
+    if not stats:
+        return None
+    _min = np.asarray(stats["min"], dtype=np.float64)[bands]
+    _max = np.asarray(stats["max"], dtype=np.float64)[bands]
+    if not len(_min) or np.all(np.isnan(_min)):
+        return None
+    return float(np.nanmin(_min)), float(np.nanmax(_max))
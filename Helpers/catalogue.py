@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import pickle
+import sqlite3
+import threading
+import numpy as np
+from contextlib import contextmanager
+from typing import Iterator
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+_cwd = os.path.abspath(os.getcwd())
+UPLOADS_DIR:str = os.getenv("uploads_dir", r"Data\Uploads")
+UPLOADS_DIR = os.path.join(_cwd, UPLOADS_DIR)
+os.makedirs(UPLOADS_DIR, exist_ok=True) # Makes directory if not present.
+
+# SQLite file of the catalogue. Shared by every service on the machine
+CATALOGUE_DB: str = os.getenv("catalogue_db") or os.path.join(UPLOADS_DIR, "catalogue.sqlite3")
+# Milliseconds a write waits for another process holding the database
+CATALOGUE_BUSY_MS = int(os.getenv("catalogue_busy_ms", 5000))
+# -------------------------------------------------------- #
+
+"""
+Catalogue of uploads and stack entries in an embedded SQLite database.
+---
+1. `uploads` holds the original file name of every upload and the metadata recorded at ingest (dtype, shape, CRS, band stats).
+   Rows are indexed by creation time and file name, so listing a page is an index scan, not a read of every upload.
+2. `stack_entries` holds the stack entries of every session with the upload they were made from.
+3. Writes run in a transaction that takes the write lock up front (`BEGIN IMMEDIATE`), concurrent uploads never lose rows.
+   The database is in WAL mode so readers are never blocked by a writer.
+4. `mapping.pkl` and the `<uuid>.pkl` pickles of older versions are imported on first use.
+
+UPLOAD::
+{
+    "uuid": str, "filename": str, "ext": str, "created": float,
+    "dtype": str | None, "height": int | None, "width": int | None, "bands": int | None,
+    "crs": str | None, "stats": dict | None
+}
+"""
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS uploads (
+    uuid TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    ext TEXT NOT NULL,
+    created REAL NOT NULL,
+    dtype TEXT,
+    height INTEGER,
+    width INTEGER,
+    bands INTEGER,
+    crs TEXT,
+    stats TEXT
+);
+CREATE INDEX IF NOT EXISTS uploads_created ON uploads (created);
+CREATE INDEX IF NOT EXISTS uploads_filename ON uploads (filename COLLATE NOCASE, created);
+
+CREATE TABLE IF NOT EXISTS stack_entries (
+    npy_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    parent_uuid TEXT,
+    position INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS stack_entries_session ON stack_entries (session_id, position);
+CREATE INDEX IF NOT EXISTS stack_entries_parent ON stack_entries (parent_uuid);
+"""
+
+# Listing sort keys -> ORDER BY. Each is served by an index
+SORT_KEYS = {
+    "created": "created {order}",
+    "filename": "filename COLLATE NOCASE {order}, created {order}",
+}
+_META_COLUMNS = ("dtype", "height", "width", "bands", "crs", "stats")
+
+_local = threading.local()
+_init_lock = threading.Lock()
+_initialised: int | None = None         # pid of the process the schema was checked in
+
+
+def _connection() -> sqlite3.Connection:
+    """Connection of this thread. Connections are not shared between threads or carried over a fork"""
+    global _initialised
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        return conn
+
+    os.makedirs(os.path.dirname(CATALOGUE_DB), exist_ok=True)
+    conn = sqlite3.connect(CATALOGUE_DB, timeout=CATALOGUE_BUSY_MS / 1000, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    _local.conn, _local.pid = conn, os.getpid()
+
+    with _init_lock:
+        if _initialised != os.getpid():
+            conn.executescript(_SCHEMA)
+            _import_pickles(conn)
+            _initialised = os.getpid()
+    return conn
+
+
+@contextmanager
+def transaction() -> Iterator[sqlite3.Connection]:
+    """Write transaction. Committed on exit, rolled back on an exception"""
+    conn = _connection()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+
+def _import_pickles(conn: sqlite3.Connection):
+    """Imports `mapping.pkl` and the per upload pickles of older versions. The mapping is renamed once imported"""
+    mapping_file = os.path.join(UPLOADS_DIR, "mapping.pkl")
+    if not os.path.exists(mapping_file):
+        return
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        # Imported by another process meanwhile
+        if not os.path.exists(mapping_file):
+            conn.execute("ROLLBACK")
+            return
+        with open(mapping_file, 'rb') as f:
+            mapping: dict[str, str] = pickle.load(f)
+
+        # Dict order is upload order, kept through the creation time
+        created = os.path.getmtime(mapping_file) - len(mapping)
+        for i, (_uuid, filename) in enumerate(mapping.items()):
+            row = {"uuid": _uuid, "filename": filename, "ext": os.path.splitext(filename)[1], "created": created + i}
+            row.update(_pickled_meta(_uuid))
+            _insert_upload(conn, row)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+
+    os.replace(mapping_file, mapping_file + ".imported")
+    print(f"Imported {len(mapping)} uploads from {mapping_file}")
+
+
+def _pickled_meta(_uuid: str) -> dict:
+    pkl_file = os.path.join(UPLOADS_DIR, _uuid + ".pkl")
+    try:
+        with open(pkl_file, 'rb') as f:
+            file = pickle.load(f)
+    except Exception:
+        return {}
+
+    meta = {"stats": getattr(file, "band_stats", None)}
+    npy_file = os.path.join(UPLOADS_DIR, _uuid + ".npy")
+    if os.path.exists(npy_file):
+        # Header only read
+        npy = np.load(npy_file, mmap_mode='r')
+        meta.update(dtype=npy.dtype.str, height=npy.shape[0], width=npy.shape[1], bands=npy.shape[2] if npy.ndim > 2 else 1)
+    return meta
+
+
+def _insert_upload(conn: sqlite3.Connection, row: dict):
+    meta = {k: row.get(k) for k in _META_COLUMNS}
+    meta["stats"] = json.dumps(meta["stats"]) if meta["stats"] is not None else None
+    conn.execute(
+        "INSERT OR IGNORE INTO uploads (uuid, filename, ext, created, dtype, height, width, bands, crs, stats) "
+        "VALUES (:uuid, :filename, :ext, :created, :dtype, :height, :width, :bands, :crs, :stats)",
+        {"uuid": row["uuid"], "filename": row["filename"], "ext": row["ext"], "created": row["created"], **meta}
+    )
+
+
+def _upload(row: sqlite3.Row) -> dict:
+    upload = dict(row)
+    upload["stats"] = json.loads(upload["stats"]) if upload.get("stats") else None
+    return upload
+
+
+# ------------------------ Uploads ------------------------ #
+
+def add_upload(_uuid: str, filename: str):
+    """Records a new upload. Metadata is added once the file is read, see `set_upload_meta`"""
+    with transaction() as conn:
+        _insert_upload(conn, {"uuid": _uuid, "filename": filename, "ext": os.path.splitext(filename)[1], "created": time.time()})
+
+
+def set_upload_meta(_uuid: str, filename: str, **meta):
+    """Sets the ingest metadata of an upload. Keys are the `uploads` columns: dtype, height, width, bands, crs, stats"""
+    unknown = set(meta) - set(_META_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown upload columns {sorted(unknown)}")
+    if "stats" in meta and meta["stats"] is not None:
+        meta["stats"] = json.dumps(meta["stats"])
+
+    with transaction() as conn:
+        # Files read before Frontend recorded the upload get a row here
+        _insert_upload(conn, {"uuid": _uuid, "filename": filename, "ext": os.path.splitext(filename)[1], "created": time.time()})
+        if meta:
+            assignments = ", ".join(f"{k} = :{k}" for k in meta)
+            conn.execute(f"UPDATE uploads SET {assignments} WHERE uuid = :uuid", {**meta, "uuid": _uuid})
+
+
+def get_upload(_uuid: str) -> dict | None:
+    row = _connection().execute("SELECT * FROM uploads WHERE uuid = ?", (_uuid,)).fetchone()
+    return _upload(row) if row is not None else None
+
+
+def list_uploads(offset: int = 0, limit: int | None = None, sort: str = "created", descending: bool = False) -> tuple[list[dict], int]:
+    """A page of uploads and the number of uploads. Stats are not returned, read them with `get_upload`
+
+    :param sort: Key of SORT_KEYS
+    :type sort: str
+    :raises ValueError: Unknown sort key
+    """
+    if sort not in SORT_KEYS:
+        raise ValueError(f"Unknown sort key {sort}, expected one of {list(SORT_KEYS)}")
+    order = SORT_KEYS[sort].format(order="DESC" if descending else "ASC")
+
+    conn = _connection()
+    rows = conn.execute(
+        f"SELECT uuid, filename, ext, created, dtype, height, width, bands, crs FROM uploads ORDER BY {order} LIMIT ? OFFSET ?",
+        (-1 if limit is None else max(0, limit), max(0, offset))
+    ).fetchall()
+    total = conn.execute("SELECT COUNT(*) FROM uploads").fetchone()[0]
+    return [dict(row) for row in rows], total
+
+
+def remove_upload(_uuid: str) -> bool:
+    """Removes an upload. False if it was not recorded"""
+    with transaction() as conn:
+        return conn.execute("DELETE FROM uploads WHERE uuid = ?", (_uuid,)).rowcount > 0
+
+
+# --------------------- Stack Entries --------------------- #
+
+def set_stack_entries(session_id: str, npy_ids: list[str], parent_uuid: str | None):
+    """Replaces the stack entries recorded for a session with its current stack. Entries kept keep their creation time"""
+    now = time.time()
+    with transaction() as conn:
+        placeholders = ", ".join("?" * len(npy_ids))
+        conn.execute(f"DELETE FROM stack_entries WHERE session_id = ? AND npy_id NOT IN ({placeholders})", (session_id, *npy_ids))
+        conn.executemany(
+            "INSERT INTO stack_entries (npy_id, session_id, parent_uuid, position, created) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (npy_id) DO UPDATE SET session_id = excluded.session_id, parent_uuid = excluded.parent_uuid, position = excluded.position",
+            [(npy_id, session_id, parent_uuid, position, now) for position, npy_id in enumerate(npy_ids)]
+        )
+
+
+def stack_entries(session_id: str | None = None, parent_uuid: str | None = None) -> list[dict]:
+    """Stack entries of a session and / or made from an upload, in stack order"""
+    where, params = [], []
+    if session_id is not None:
+        where.append("session_id = ?")
+        params.append(session_id)
+    if parent_uuid is not None:
+        where.append("parent_uuid = ?")
+        params.append(parent_uuid)
+    query = "SELECT * FROM stack_entries" + (" WHERE " + " AND ".join(where) if where else "") + " ORDER BY session_id, position"
+    return [dict(row) for row in _connection().execute(query, params).fetchall()]
@@ -1,4 +1,4 @@
-import uuid, base64, os
+import uuid, base64, os, hashlib, hmac
 
 
 # -------------------- Load Env Vars --------------------- #  
@@ -13,12 +13,20 @@ os.makedirs(UPLOADS_DIR, exist_ok=True) # Makes directory if not present.
 STACK_DIR:str = os.getenv("stack_dir", r"Data\Session\Stack")
 STACK_DIR = os.path.join(_cwd, STACK_DIR)
 os.makedirs(STACK_DIR, exist_ok=True) # Makes directory if not present.
+
+# Key signing the session ids Frontend issues. Shared by Frontend and Backend, generated in STACK_DIR once if not set
+SESSION_SECRET: str = os.getenv("session_secret", "")
 # -------------------------------------------------------- #
 
 from flask import request
 import numpy as np
-from PIL import Image as pilImage
-from io import BytesIO
+from Helpers import array_access
+from Helpers import shared_array
+from Helpers.render_encoder import RenderEncoding
+from Helpers.ChunkStore.chunkStore import ChunkStore, ChunkedArray, ChunkWriter
+
+# Stack entries are stored chunked and deduplicated. Plain .npy entries of older sessions are still read.
+stack_store = ChunkStore(STACK_DIR)
 
 
 
@@ -57,6 +65,50 @@ def generate_uuid() -> str:
     
     return base64_uuid.replace('-', '0')
 
+# ---------------------- Session ids ---------------------- #
+
+_session_key: bytes | None = None
+
+def _sessionKey() -> bytes:
+    global _session_key
+    if _session_key is None:
+        _session_key = SESSION_SECRET.encode() if SESSION_SECRET else _sharedSecret(os.path.join(STACK_DIR, "session_secret"))
+    return _session_key
+
+def _sharedSecret(secret_file: str) -> bytes:
+    """Reads the secret file. Created by the first service to need it, linked in place only once fully written"""
+    if not os.path.exists(secret_file):
+        tmp_file = f"{secret_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(base64.urlsafe_b64encode(os.urandom(32)))
+        try:
+            os.link(tmp_file, secret_file)
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp_file)
+    with open(secret_file, 'rb') as f:
+        return f.read().strip()
+
+def _sessionSignature(session_id: str) -> str:
+    digest = hmac.new(_sessionKey(), session_id.encode(), hashlib.sha256).digest()[:16]
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')
+
+def sign_session(session_id: str) -> str:
+    """Token `<session id>.<signature>` given to the browser and sent to Backend as X-Session-Id"""
+    return f"{session_id}.{_sessionSignature(session_id)}"
+
+def verify_session(token: str | None) -> str | None:
+    """Session id of a token issued by `sign_session`. None if it is missing or was not signed with our key"""
+    if not token or "." not in token:
+        return None
+    session_id, signature = token.rsplit(".", 1)
+    if not hmac.compare_digest(signature, _sessionSignature(session_id)):
+        return None
+    return session_id
+
+# -------------------------------------------------------- #
+
 def removeFile(path: str, dir=""):
     path = os.path.join(dir, path)
     if os.path.exists(path):
@@ -67,25 +119,83 @@ def removeFiles(*files: str, dir=""):
         removeFile(file, dir)
 
 
-def image_bytes(img: np.ndarray):
-    pimg = pilImage.fromarray(img)
+def image_bytes(img: np.ndarray, encoding: RenderEncoding | None = None) -> bytes:
+    """Encodes a uint8 render. PNG of the default tier if no encoding is given, see `render_encoder`"""
+    return (encoding or RenderEncoding()).encode(img)
 
-    buf = BytesIO()
-    pimg.save(buf, format="PNG")
-    # buf.seek(0)
+def content_hash(data: bytes) -> str:
+    """Hash of encoded bytes. Used as the ETag and URL of renders"""
+    return hashlib.sha1(data).hexdigest()
 
-    return buf.getvalue()
+def _stack_bands(bands: array_access.Bands) -> slice | list[int] | None:
+    return slice(bands, bands + 1) if isinstance(bands, int) else bands
 
-def read_stack_npy(id) -> np.ndarray | None:
-    npy_file = os.path.join(STACK_DIR, id)
+# Entries handed over in shared memory are read from there until they are persisted. See `shared_array`
 
+def stack_npy_exists(id) -> bool:
+    stem, _ = os.path.splitext(id)
+    return shared_array.exists(id) or stack_store.exists(id) or os.path.exists(os.path.join(STACK_DIR, stem + '.npy'))
+
+def open_stack_npy(id, bands: slice | None = None) -> ChunkedArray | np.ndarray | None:
+    """Returns a lazily read, read only array of a stack entry. Only the sliced region is read"""
+    shared = shared_array.get(id)
+    if shared is not None:
+        return array_access.select(shared, bands=bands)
+    if stack_store.exists(id):
+        return stack_store.open(id, bands=bands)
+    
+    stem, _ = os.path.splitext(id)
+    npy_file = os.path.join(STACK_DIR, stem + '.npy')
+    if not os.path.exists(npy_file):
+        return None
+    return array_access.load_npy(npy_file, bands=bands, mmap=True)
+
+def read_stack_npy(id, window: array_access.Window | None = None, bands: array_access.Bands = None, mmap: bool | None = None) -> np.ndarray | None:
+    """Returns a read only window and / or band subset of a stack entry. See `array_access.load_npy`"""
+    shared = shared_array.get(id)
+    if shared is not None:
+        return array_access.select(shared, window, bands)
+    if stack_store.exists(id):
+        return stack_store.read(id, window=window, bands=_stack_bands(bands))
+    
+    stem, _ = os.path.splitext(id)
+    npy_file = os.path.join(STACK_DIR, stem + '.npy')
     if not os.path.exists(npy_file):
         return None
 
-    with open(npy_file, 'rb') as f:
-        return np.load(f)
+    return array_access.load_npy(npy_file, window=window, bands=bands, mmap=mmap)
+    
+def stack_npy_stats(id) -> dict | None:
+    """Per band stats of a stack entry recorded when it was written. None for entries of older sessions"""
+    if shared_array.get(id) is not None and (stats := shared_array.stats(id)) is not None:
+        return stats
+    if stack_store.exists(id):
+        return stack_store.band_stats(id)
+    return None
     
-def save_stack_npy(id, npy):
-    npy_file = os.path.join(STACK_DIR, id + '.npy')
-    with open(npy_file, 'wb') as f:
-        np.save(f, npy)
\ No newline at end of file
+def save_stack_npy(id, npy, nodata: float | None = None, handoff: bool = False):
+    """Saves a stack entry. With handoff it is put in shared memory and saved to the store in the background"""
+    if handoff and shared_array.SHM_HANDOFF:
+        shared_array.publish(id, npy, nodata, persist=lambda arr: stack_store.save(id, arr, nodata), unpersist=lambda: _unpersist(id))
+        return
+    stack_store.save(id, npy, nodata)
+
+def stack_writer(id, shape: tuple[int, ...], dtype, nodata: float | None = None, handoff: bool = False) -> ChunkWriter | shared_array.SharedWriter:
+    """Writer to save a stack entry strip by strip. See `save_stack_npy` for handoff"""
+    if handoff and shared_array.SHM_HANDOFF:
+        return shared_array.SharedWriter(id, shape, dtype, nodata, persist=lambda arr: stack_store.save(id, arr, nodata), unpersist=lambda: _unpersist(id))
+    return stack_store.writer(id, shape, dtype, nodata)
+
+def _unpersist(id):
+    """Removes an entry discarded while it was persisted from shared memory"""
+    stack_store.delete(id)
+    stack_store.schedule_gc()
+
+def remove_stack_npy(*ids: str):
+    """Removes stack entries. Chunks no longer used are collected in the background"""
+    if not ids:
+        return
+    shared_array.discard(*ids)
+    stack_store.delete(*ids)
+    removeFiles(*[os.path.splitext(id)[0] + '.npy' for id in ids], dir=STACK_DIR)
+    stack_store.schedule_gc()
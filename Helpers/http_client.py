@@ -0,0 +1,196 @@
+import os
+import time
+import bisect
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import MaxRetryError, NewConnectionError
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Seconds to open a connection and seconds to wait for a response. Slow calls pass their own read timeout
+HTTP_CONNECT_TIMEOUT = float(os.getenv("http_connect_timeout", 3))
+HTTP_READ_TIMEOUT = float(os.getenv("http_read_timeout", 30))
+# Keep-alive connections held per upstream
+HTTP_POOL_SIZE = int(os.getenv("http_pool_size", 16))
+# Extra attempts of idempotent calls and the base backoff between them in seconds
+HTTP_RETRIES = int(os.getenv("http_retries", 2))
+HTTP_BACKOFF = float(os.getenv("http_backoff", 0.1))
+# -------------------------------------------------------- #
+
+"""
+Shared client for calls between services.
+---
+1. One `requests.Session` per upstream, so connections are kept alive and reused across calls instead of opened per call.
+2. Every call gets a (connect, read) timeout. Only the read timeout is overridden per call.
+3. Idempotent calls (GET, HEAD, OPTIONS by default) are retried on connection errors, timeouts and 502 / 503 / 504.
+   Other methods are only retried when the connection could not be opened, as the request never reached the upstream.
+4. Latency of every call is recorded in a histogram per upstream, see `metrics`.
+
+USAGE::
+    backend = http_client.upstream("backend", BACKEND_URL)
+    response = backend.get("/image/tiles/info", timeout=5)
+"""
+
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+RETRY_STATUS = frozenset((502, 503, 504))
+# Upper bounds of the latency buckets in ms. The last bucket is unbounded
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class LatencyHistogram:
+    """Thread safe fixed bucket histogram of call latencies"""
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, ms: float, error: bool = False, retries: int = 0):
+        with self.__lock:
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+            self.count += 1
+            self.errors += int(error)
+            self.retries += retries
+            self.total_ms += ms
+            self.max_ms = max(self.max_ms, ms)
+
+    def quantile(self, q: float) -> float | None:
+        """Upper bound of the bucket holding the quantile. None if nothing was recorded"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS_MS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return float(bound)
+        return self.max_ms
+
+    def to_dict(self) -> dict:
+        with self.__lock:
+            return {
+                "count": self.count,
+                "errors": self.errors,
+                "retries": self.retries,
+                "mean_ms": round(self.total_ms / self.count, 2) if self.count else None,
+                "max_ms": round(self.max_ms, 2),
+                "p50_ms": self.quantile(0.5),
+                "p95_ms": self.quantile(0.95),
+                "p99_ms": self.quantile(0.99),
+                "buckets": {
+                    **{f"le_{bound}": n for bound, n in zip(LATENCY_BUCKETS_MS, self.buckets)},
+                    "inf": self.buckets[-1],
+                },
+            }
+
+
+def _notSent(e: requests.ConnectionError) -> bool:
+    """Whether the connection failed before the request was sent, so any method is safe to repeat"""
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    reason = e.args[0] if e.args else None
+    if isinstance(reason, MaxRetryError):
+        reason = reason.reason
+    return isinstance(reason, NewConnectionError)
+
+
+class UpstreamClient:
+    """Pooled keep-alive client of a single upstream service.
+
+    :param name: Name the metrics are reported under
+    :type name: str
+    :param base_url: Scheme, host and port of the upstream. Paths are joined to it
+    :type base_url: str
+    """
+    def __init__(self, name: str, base_url: str):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.latency = LatencyHistogram()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HTTP_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method: str, path: str, timeout: float | None = None, idempotent: bool | None = None, **kwargs) -> requests.Response:
+        """Sends a request to the upstream. Arguments other than these are passed on to `requests`.
+
+        :param timeout: Read timeout in seconds. HTTP_READ_TIMEOUT if not set
+        :type timeout: float | None
+        :param idempotent: Whether the call is safe to repeat. Decided by the method if not set
+        :type idempotent: bool | None
+        :raises requests.RequestException: Once the retries are used up
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        url = self.base_url + path
+        timeout_pair = (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT if timeout is None else timeout)
+
+        attempt = 0
+        start = time.perf_counter()
+        while True:
+            try:
+                response = self.session.request(method, url, timeout=timeout_pair, **kwargs)
+            except requests.ConnectionError as e:
+                if attempt < HTTP_RETRIES and (idempotent or _notSent(e)):
+                    attempt = self.__backoff(attempt)
+                    continue
+                self.__record(start, True, attempt)
+                raise
+            except requests.Timeout:
+                if attempt < HTTP_RETRIES and idempotent:
+                    attempt = self.__backoff(attempt)
+                    continue
+                self.__record(start, True, attempt)
+                raise
+
+            if response.status_code in RETRY_STATUS and idempotent and attempt < HTTP_RETRIES:
+                response.close()
+                attempt = self.__backoff(attempt)
+                continue
+            self.__record(start, response.status_code >= 500, attempt)
+            return response
+
+    def __backoff(self, attempt: int) -> int:
+        time.sleep(HTTP_BACKOFF * 2 ** attempt)
+        return attempt + 1
+
+    def __record(self, start: float, error: bool, retries: int):
+        self.latency.record((time.perf_counter() - start) * 1000, error, retries)
+
+    def get(self, path: str, **kwargs) -> requests.Response:
+        return self.request("GET", path, **kwargs)
+
+    def put(self, path: str, **kwargs) -> requests.Response:
+        return self.request("PUT", path, **kwargs)
+
+    def post(self, path: str, **kwargs) -> requests.Response:
+        return self.request("POST", path, **kwargs)
+
+    def delete(self, path: str, **kwargs) -> requests.Response:
+        return self.request("DELETE", path, **kwargs)
+
+
+_clients: dict[str, UpstreamClient] = {}
+_clients_lock = threading.Lock()
+
+def upstream(name: str, base_url: str) -> UpstreamClient:
+    """Shared client of an upstream. Created on first use, every later call with the same name gets the same pool"""
+    with _clients_lock:
+        client = _clients.get(name)
+        if client is None:
+            client = _clients[name] = UpstreamClient(name, base_url)
+        return client
+
+def metrics() -> dict:
+    """Latency histograms of every upstream this process has called"""
+    with _clients_lock:
+        clients = list(_clients.values())
+    return {client.name: {"url": client.base_url, **client.latency.to_dict()} for client in clients}
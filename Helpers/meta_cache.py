@@ -0,0 +1,171 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Default bounds of a cache. Entries and MB, whichever is reached first
+META_CACHE_ENTRIES = int(os.getenv("meta_cache_entries", 1024))
+META_CACHE_MB = float(os.getenv("meta_cache_mb", 64))
+# -------------------------------------------------------- #
+
+"""
+Bounded caches for file metadata and artefacts derived from files (thumbnails, sprite sheets).
+---
+1. Every entry is stored with the version of the files it was made from, see `file_version`.
+   A lookup passes the current version. A changed version reloads the entry, a missing file drops it.
+   Versions are read from the file system, so files rewritten or deleted by another process are noticed too.
+2. Entries are evicted least recently used first once the entry or byte bound is exceeded.
+3. Safe to share between threads. Loads run outside the lock, a slow load does not block other keys.
+4. Hit, miss, stale and eviction counters of every cache are returned by `metrics`.
+
+USAGE::
+    fileCache = meta_cache.MetaCache("files")
+    img = fileCache.get(_uuid, meta_cache.file_version(npy_file), lambda: ImageFile.load(_uuid))
+"""
+
+# (mtime_ns, size) of each file. None for a missing file
+Version = Hashable
+
+
+def file_version(*paths: str) -> tuple[tuple[int, int], ...] | None:
+    """Version of a set of files. None if any of them is missing"""
+    version = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        version.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(version)
+
+
+def files_version(*paths: str) -> tuple[tuple[int, int] | None, ...]:
+    """Version of a set of files, some of which may be missing. Appearing or disappearing files change it too"""
+    return tuple(version[0] if (version := file_version(path)) else None for path in paths)
+
+
+def _sizeof(value: Any) -> int:
+    """Approximate bytes held by a cached value"""
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return len(value)
+    if isinstance(value, tuple):
+        return sum(_sizeof(v) for v in value)
+    try:
+        return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return 1024
+
+
+class MetaCache:
+    """Thread safe LRU cache of versioned values bounded by entries and bytes
+
+    :param name: Name the counters are reported under
+    :type name: str
+    :param max_entries: Entries kept at most
+    :type max_entries: int
+    :param max_bytes: Approximate bytes kept at most. Values larger than this are not cached
+    :type max_bytes: int
+    :param sizeof: Bytes held by a value. Length of bytes, pickled length of other values by default
+    :type sizeof: Callable[[Any], int]
+    """
+    def __init__(self, name: str, max_entries: int = META_CACHE_ENTRIES, max_bytes: int = int(META_CACHE_MB * 2**20), sizeof: Callable[[Any], int] = _sizeof):
+        self.name = name
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.__sizeof = sizeof
+
+        self.__entries: OrderedDict[Hashable, tuple[Version, Any, int]] = OrderedDict()     # key -> (version, value, size)
+        self.__bytes = 0
+        self.__lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+
+        with _caches_lock:
+            _caches.append(self)
+
+    def get(self, key: Hashable, version: Version | None, load: Callable[[], Any]) -> Any:
+        """Cached value of key if it was made from this version. Else load() is cached and returned
+
+        :param version: Current version of the files the value is made from. None if they are missing
+        :type version: Version | None
+        :raises FileNotFoundError: version is None. The entry is dropped
+        """
+        if version is None:
+            self.invalidate(key)
+            raise FileNotFoundError(f"{self.name}: {key} not found")
+
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.__entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self.stale += 1
+                self.__drop(key)
+            self.misses += 1
+
+        value = load()
+        self.put(key, version, value)
+        return value
+
+    def put(self, key: Hashable, version: Version, value: Any):
+        size = self.__sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self.__lock:
+            if key in self.__entries:
+                self.__drop(key)
+            self.__entries[key] = (version, value, size)
+            self.__bytes += size
+
+            while len(self.__entries) > self.max_entries or self.__bytes > self.max_bytes:
+                self.__drop(next(iter(self.__entries)))
+                self.evictions += 1
+
+    def __drop(self, key: Hashable):
+        self.__bytes -= self.__entries.pop(key)[2]
+
+    def invalidate(self, key: Hashable):
+        with self.__lock:
+            if key in self.__entries:
+                self.__drop(key)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+            self.__bytes = 0
+
+    @property
+    def stats(self) -> dict:
+        with self.__lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.__entries),
+                "bytes": self.__bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "stale": self.stale,
+                "evictions": self.evictions,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+_caches: list[MetaCache] = []
+_caches_lock = threading.Lock()
+
+def metrics() -> dict:
+    """Counters of every cache of this process"""
+    with _caches_lock:
+        caches = list(_caches)
+    return {cache.name: cache.stats for cache in caches}
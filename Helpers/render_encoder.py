@@ -0,0 +1,155 @@
+import os
+import time
+import threading
+import numpy as np
+from enum import Enum
+from io import BytesIO
+from PIL import Image as pilImage
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Format and tier used when the client asks for none
+RENDER_FORMAT = os.getenv("render_format", "png")
+RENDER_TIER = os.getenv("render_tier", "fast")
+# PNG zlib level of the exact tier (0 ~ 9). The fast tier uses 1
+RENDER_PNG_LEVEL = int(os.getenv("render_png_level", 6))
+# JPEG / WebP quality of the fast tier
+RENDER_LOSSY_QUALITY = int(os.getenv("render_lossy_quality", 80))
+# -------------------------------------------------------- #
+
+"""
+Encoders of uint8 renders.
+---
+1. Formats: png, jpeg, webp and raw (the uint8 array as a `.npy`, no compression).
+2. Tiers:
+    - fast: lowest encode time. PNG at zlib level 1 (still lossless), JPEG / WebP lossy at RENDER_LOSSY_QUALITY.
+    - exact: smallest lossless output. PNG at RENDER_PNG_LEVEL, lossless WebP, JPEG at quality 95 without chroma subsampling.
+3. `negotiate` picks the encoding of a request: `format` / `tier` query params, else the `Accept` header, else the defaults.
+4. Encode time and size of the current thread are summed until `reset_timing`, so a request can report them.
+
+USAGE::
+    encoding = render_encoder.negotiate(request.args, request.accept_mimetypes)
+    data = encoding.encode(img8)
+"""
+
+
+class Formats(Enum):
+    PNG = 'png'
+    JPEG = 'jpeg'
+    WEBP = 'webp'
+    RAW = 'raw'
+
+
+class Tiers(Enum):
+    FAST = 'fast'
+    EXACT = 'exact'
+
+
+_MIMETYPES = {
+    Formats.PNG: "image/png",
+    Formats.JPEG: "image/jpeg",
+    Formats.WEBP: "image/webp",
+    Formats.RAW: "application/x-npy",
+}
+_EXTENSIONS = {Formats.PNG: "png", Formats.JPEG: "jpg", Formats.WEBP: "webp", Formats.RAW: "npy"}
+# File extension of a render URL -> format
+FORMAT_BY_EXT = {ext: format.value for format, ext in _EXTENSIONS.items()}
+
+
+class RenderEncoding:
+    """Format and tier of an encoded render
+
+    :raises ValueError: Unknown format or tier
+    """
+    def __init__(self, format: str = RENDER_FORMAT, tier: str = RENDER_TIER):
+        self.format = Formats(format.lower().replace("jpg", "jpeg"))
+        self.tier = Tiers(tier.lower())
+
+    @property
+    def key(self) -> tuple[str, str]:
+        """Part of render cache keys. Renders of different encodings are cached apart"""
+        return (self.format.value, self.tier.value)
+
+    @property
+    def mimetype(self) -> str:
+        return _MIMETYPES[self.format]
+
+    @property
+    def ext(self) -> str:
+        return _EXTENSIONS[self.format]
+
+    def __pil_options(self) -> dict:
+        fast = self.tier == Tiers.FAST
+        if self.format == Formats.PNG:
+            return {"format": "PNG", "compress_level": 1 if fast else RENDER_PNG_LEVEL}
+        if self.format == Formats.JPEG:
+            return {"format": "JPEG", "quality": RENDER_LOSSY_QUALITY} if fast else {"format": "JPEG", "quality": 95, "subsampling": 0}
+        # WebP method 0 is the fastest encoder setting
+        return {"format": "WEBP", "quality": RENDER_LOSSY_QUALITY, "method": 0} if fast else {"format": "WEBP", "lossless": True}
+
+    def encode(self, img: np.ndarray) -> bytes:
+        """Encodes an (H, W) or (H, W, D) uint8 render"""
+        start = time.perf_counter()
+        # Single band images are stored as (H, W, 1), PIL expects (H, W)
+        if img.ndim == 3 and img.shape[2] == 1:
+            img = img[:, :, 0]
+
+        buf = BytesIO()
+        if self.format == Formats.RAW:
+            np.save(buf, np.ascontiguousarray(img))
+        else:
+            pilImage.fromarray(img).save(buf, **self.__pil_options())
+        data = buf.getvalue()
+
+        _record((time.perf_counter() - start) * 1000, len(data))
+        return data
+
+
+def negotiate(args: dict, accept=None) -> RenderEncoding:
+    """Encoding asked for by a request.
+    ---
+    1. `format` and `tier` query params.
+    2. Else the `Accept` header. The highest quality format wins, ties go to RENDER_FORMAT and then png, webp, jpeg.
+    3. Else RENDER_FORMAT and RENDER_TIER.
+
+    :param args: Query params of the request
+    :type args: dict
+    :param accept: `request.accept_mimetypes`
+    :type accept: werkzeug.datastructures.MIMEAccept | None
+    :raises ValueError: Unknown format or tier
+    """
+    tier = args.get("tier") or RENDER_TIER
+    if args.get("format"):
+        return RenderEncoding(args["format"], tier)
+
+    if accept:
+        preference = [Formats(RENDER_FORMAT), Formats.PNG, Formats.WEBP, Formats.JPEG]
+        qualities = [(accept.quality(_MIMETYPES[f]), -i, f) for i, f in enumerate(preference)]
+        quality, _, format = max(qualities)
+        if quality > 0:
+            return RenderEncoding(format.value, tier)
+    return RenderEncoding(RENDER_FORMAT, tier)
+
+
+# ------------------------ Timing ------------------------ #
+
+_timing = threading.local()
+
+def _record(ms: float, size: int):
+    _timing.ms = getattr(_timing, "ms", 0.0) + ms
+    _timing.bytes = getattr(_timing, "bytes", 0) + size
+    _timing.count = getattr(_timing, "count", 0) + 1
+
+def reset_timing():
+    """Starts summing the encodes of this thread from zero. Call at the start of a request"""
+    _timing.ms, _timing.bytes, _timing.count = 0.0, 0, 0
+
+def timing() -> dict:
+    """Encodes of this thread since `reset_timing`. 0 encodes when the render came from a cache"""
+    return {
+        "ms": round(getattr(_timing, "ms", 0.0), 2),
+        "bytes": getattr(_timing, "bytes", 0),
+        "count": getattr(_timing, "count", 0),
+    }
@@ -0,0 +1,82 @@
+import os
+import threading
+import numpy as np
+from functools import lru_cache
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Rows converted at once. Temporaries of the conversion are bounded by a strip, not the image
+RENDER_STRIP_ROWS = int(os.getenv("render_strip_rows", 64))
+# -------------------------------------------------------- #
+
+"""
+uint8 render kernel. Maps [_min, _max] linearly to [0, 255], clips outside values and truncates like `np.uint8(x * 255)`.
+
+1. uint8 input is returned (or copied to out) as is.
+2. 16 bit input goes through a 65536 entry lookup table. No float math per pixel.
+3. Any other input is converted in row strips with float64 math in place. float32 would lose values near a large offset.
+Every path gives the same uint8 values as `np.uint8(np.clip((npy - _min) / (_max - _min), 0, 1) * 255)` on the whole image in float64.
+"""
+
+
+@lru_cache(maxsize=16)
+def _lut16(dtype_str: str, _min: float, _max: float) -> np.ndarray:
+    """uint8 value for every 16 bit pattern of the dtype, indexed by the raw bits as uint16"""
+    values = np.arange(2**16, dtype=np.uint16).view(np.dtype(dtype_str)).astype(np.float64)
+    return _scale(values, _min, _max)
+
+
+def _scale(values: np.ndarray, _min: float, _max: float) -> np.ndarray:
+    """float64 values to uint8 in place of values. Same steps as the whole image formula, so the values match it exactly"""
+    values -= _min
+    values /= (_max - _min) or 1
+    np.clip(values, 0, 1, out=values)
+    values *= 255
+    np.nan_to_num(values, copy=False, nan=0)
+    return values.astype(np.uint8)
+
+
+def to_uint8(npy: np.ndarray, _min: float, _max: float, out: np.ndarray | None = None) -> np.ndarray:
+    """Renders an (H, W) or (H, W, D) array to uint8.
+
+    :param npy: Input array. Memory mapped and chunked arrays are read strip by strip
+    :type npy: np.ndarray
+    :param _min: Value mapped to 0
+    :type _min: float
+    :param _max: Value mapped to 255
+    :type _max: float
+    :param out: uint8 array of the same shape to write to. A new array is allocated if not set
+    :type out: np.ndarray | None
+    """
+    dtype = np.dtype(npy.dtype)
+    _min, _max = float(_min), float(_max)
+    if dtype == np.uint8 and out is None:
+        return np.asarray(npy)
+    if out is None:
+        out = np.empty(npy.shape, dtype=np.uint8)
+    assert out.shape == tuple(npy.shape) and out.dtype == np.uint8, "out should be a uint8 array of the input shape"
+
+    lut = _lut16(dtype.str, _min, _max) if dtype.kind in "iu" and dtype.itemsize == 2 else None
+
+    for r in range(0, npy.shape[0], RENDER_STRIP_ROWS):
+        strip = np.asarray(npy[r:r + RENDER_STRIP_ROWS])
+        if dtype == np.uint8:
+            out[r:r + RENDER_STRIP_ROWS] = strip
+        elif lut is not None:
+            np.take(lut, strip.view(np.uint16), out=out[r:r + RENDER_STRIP_ROWS], mode='clip')
+        else:
+            out[r:r + RENDER_STRIP_ROWS] = _scale(strip.astype(np.float64), _min, _max)
+    return out
+
+
+_buffers = threading.local()
+
+def render_buffer(shape: tuple[int, ...]) -> np.ndarray:
+    """Per thread reusable uint8 output for `to_uint8`. Valid until the next call on the same thread, encode or copy it before that"""
+    size = int(np.prod(shape))
+    buffer = getattr(_buffers, "buffer", None)
+    if buffer is None or buffer.size < size:
+        buffer = _buffers.buffer = np.empty(size, dtype=np.uint8)
+    return buffer[:size].reshape(shape)
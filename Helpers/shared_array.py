@@ -0,0 +1,266 @@
+import os
+import json
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from Helpers.band_stats import BandStats
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Hand computed stack entries to other services through shared memory (1 / 0). Services should run on the same machine
+SHM_HANDOFF = bool(int(os.getenv("shm_handoff", 1)))
+# Directory of the shared arrays. A RAM backed directory (/dev/shm) when available
+SHM_DIR: str = os.getenv("shm_dir") or (
+    "/dev/shm/image-processing" if os.path.isdir("/dev/shm") else os.path.join(os.getcwd(), "Data", "Session", "Shm")
+)
+# MB of shared arrays a reading process keeps mapped. Older mappings are dropped and read from the stack again
+SHM_ATTACH_MB = int(os.getenv("shm_attach_mb", 2048))
+# -------------------------------------------------------- #
+
+"""
+Shared memory handoff of stack entries between co-located services.
+---
+1. The computing service (ImageOperations) writes the output to `<SHM_DIR>/<id>.npy`, a memory mapped npy in RAM, instead of the stack store.
+2. The entry can be read right away. A descriptor `{"npy_id", "file", "shape", "dtype", "offset"}` is returned over HTTP and
+   the reading service (Backend) maps the same pages with `attach`. No pixels are encoded, written to disk or read back.
+3. The entry is saved to the stack store in a background thread. Once saved the shared file is removed.
+   Mappings already held stay valid, new readers find the entry in the stack store.
+4. Band stats of the entry are written next to it as `<id>.stats.json`.
+
+The `common_helpers` stack functions look here before the stack store, so callers do not change.
+"""
+
+_lock = threading.Lock()
+_arrays: "OrderedDict[str, np.ndarray]" = OrderedDict()     # Mapped in this process. Oldest first
+_stats: dict[str, dict | None] = {}
+_owned: set[str] = set()                                    # Published by this process, removed once persisted
+_persist_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shm-persist")
+
+def _reset_after_fork():
+    # Threads are not forked. A forked worker process gets its own persist thread and registry
+    global _lock, _persist_pool
+    _lock = threading.Lock()
+    _persist_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shm-persist")
+    _arrays.clear()
+    _stats.clear()
+    _owned.clear()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _stem(npy_id: str) -> str:
+    return os.path.splitext(os.path.basename(npy_id))[0]
+
+def array_file(npy_id: str) -> str:
+    return os.path.join(SHM_DIR, _stem(npy_id) + ".npy")
+
+def stats_file(npy_id: str) -> str:
+    return os.path.join(SHM_DIR, _stem(npy_id) + ".stats.json")
+
+
+class SharedWriter:
+    """Writes a stack entry to shared memory row strip by row strip. Same interface as `ChunkWriter`.
+    ---
+    The entry is only visible once closed. `close` schedules `persist(array)` and returns the descriptor.
+
+    :param persist: Saves the finished array to the stack store. Run in a background thread
+    :type persist: Callable[[np.ndarray], None]
+    :param unpersist: Removes it from the stack store again. Called when the entry was discarded while it was persisted
+    :type unpersist: Callable[[], None] | None
+    """
+    def __init__(self, npy_id: str, shape: tuple[int, ...], dtype, nodata: float | None, persist: Callable[[np.ndarray], None], unpersist: Callable[[], None] | None = None):
+        if len(shape) == 2:
+            shape = (*shape, 1)
+        os.makedirs(SHM_DIR, exist_ok=True)
+        self.npy_id = npy_id
+        self.shape = tuple(int(s) for s in shape)
+        self.__persist = persist
+        self.__unpersist = unpersist
+        self.__tmp_file = os.path.join(SHM_DIR, f"{_stem(npy_id)}.{os.getpid()}.{threading.get_ident()}.tmp.npy")
+        self.__npy = np.lib.format.open_memmap(self.__tmp_file, mode='w+', dtype=np.dtype(dtype), shape=self.shape)
+        self.__stats = BandStats(self.shape, dtype, nodata)
+        self.__rows_written = 0
+
+    def write(self, rows: np.ndarray):
+        if rows.ndim == 2:
+            rows = rows[..., np.newaxis]
+        self.__stats.update(rows)
+        self.__npy[self.__rows_written:self.__rows_written + len(rows)] = rows      # type: ignore
+        self.__rows_written += len(rows)
+
+    def abort(self):
+        """Drops a partially written array"""
+        self.__npy = None
+        try:
+            os.remove(self.__tmp_file)
+        except OSError:
+            pass
+
+    def close(self) -> dict:
+        assert self.__rows_written == self.shape[0], f"Expected {self.shape[0]} rows, got {self.__rows_written}"
+        self.__npy.flush()      # type: ignore
+        self.__npy = None       # Unmapped before the rename, required on Windows
+
+        stats = self.__stats.to_dict()
+        with open(stats_file(self.npy_id), 'w') as f:
+            json.dump(stats, f)
+        os.replace(self.__tmp_file, array_file(self.npy_id))
+
+        npy = np.load(array_file(self.npy_id), mmap_mode='r')
+        _register(self.npy_id, npy, stats, owned=True)
+        _persist_pool.submit(_persist, self.npy_id, npy, self.__persist, self.__unpersist)
+        return descriptor(self.npy_id)      # type: ignore
+
+
+def publish(npy_id: str, npy: np.ndarray, nodata: float | None, persist: Callable[[np.ndarray], None], strip_rows: int = 1024, unpersist: Callable[[], None] | None = None) -> dict:
+    """Copies a computed array to shared memory. See `SharedWriter`"""
+    writer = SharedWriter(npy_id, npy.shape, npy.dtype, nodata, persist, unpersist)
+    for r in range(0, npy.shape[0], strip_rows):
+        writer.write(np.asarray(npy[r:r + strip_rows]))
+    return writer.close()
+
+
+def _persist(npy_id: str, npy: np.ndarray, persist: Callable[[np.ndarray], None], unpersist: Callable[[], None] | None = None):
+    # Removed by a reader meanwhile (stack entry deleted), nothing to keep
+    if not os.path.exists(array_file(npy_id)):
+        release(npy_id)
+        return
+    try:
+        persist(npy)
+    except Exception as e:
+        # Kept in shared memory, it is the only copy
+        print(f"Error persisting shared array {npy_id}", e)
+        return
+    # Discarded while it was persisted. Nothing references the saved copy, it is removed again.
+    # A discard after this check is followed by the reader removing it from the stack store itself
+    if not os.path.exists(array_file(npy_id)) and unpersist is not None:
+        unpersist()
+    release(npy_id)
+
+
+def _register(npy_id: str, npy: np.ndarray, stats: dict | None, owned: bool = False):
+    stem = _stem(npy_id)
+    with _lock:
+        _arrays[stem] = npy
+        _stats[stem] = stats
+        if owned:
+            _owned.add(stem)
+
+        # Mappings of other processes' arrays beyond the budget are dropped. They can be read again
+        mapped = sum(a.nbytes for a in _arrays.values())
+        for old in list(_arrays):
+            if mapped <= SHM_ATTACH_MB * 1024 * 1024:
+                break
+            if old in _owned or old == stem:
+                continue
+            mapped -= _arrays.pop(old).nbytes
+            _stats.pop(old, None)
+
+
+def descriptor(npy_id: str) -> dict | None:
+    """Descriptor of a shared array mapped by this process, sent to readers. None if it is not in shared memory"""
+    with _lock:
+        npy = _arrays.get(_stem(npy_id))
+    if npy is None:
+        return None
+    return {
+        "npy_id": npy_id,
+        "file": os.path.basename(array_file(npy_id)),
+        "shape": list(npy.shape),
+        "dtype": npy.dtype.str,
+        "offset": int(getattr(npy, "offset", 0)),
+    }
+
+
+def attach(desc: dict) -> np.ndarray | None:
+    """Maps a shared array from its descriptor. None if it is already persisted and removed"""
+    npy_id = desc["npy_id"]
+    try:
+        if "offset" in desc:
+            npy = np.memmap(array_file(npy_id), dtype=np.dtype(desc["dtype"]), mode='r', offset=desc["offset"], shape=tuple(desc["shape"]))
+        else:
+            npy = np.load(array_file(npy_id), mmap_mode='r')
+    except (FileNotFoundError, ValueError):
+        return None
+
+    try:
+        with open(stats_file(npy_id)) as f:
+            stats = json.load(f)
+    except (FileNotFoundError, ValueError):
+        stats = None
+    _register(npy_id, npy, stats)
+    return npy
+
+
+def exists(npy_id: str) -> bool:
+    if not SHM_HANDOFF:
+        return False
+    with _lock:
+        if _stem(npy_id) in _owned:
+            return True
+    return os.path.exists(array_file(npy_id))
+
+
+def get(npy_id: str) -> np.ndarray | None:
+    """Read only shared array of a stack entry, mapped on first use. None if it is not in shared memory"""
+    if not SHM_HANDOFF:
+        return None
+    stem = _stem(npy_id)
+    present = os.path.exists(array_file(npy_id))
+    with _lock:
+        npy = _arrays.get(stem)
+        if npy is not None and (present or stem in _owned):
+            _arrays.move_to_end(stem)
+            return npy
+        # Persisted and removed by its owner. The mapping is dropped so its memory is freed, the stack store has it now
+        _arrays.pop(stem, None)
+        _stats.pop(stem, None)
+    if not present:
+        return None
+    return attach({"npy_id": npy_id})
+
+
+def stats(npy_id: str) -> dict | None:
+    with _lock:
+        return _stats.get(_stem(npy_id))
+
+
+def _remove_files(npy_id: str):
+    for file in (array_file(npy_id), stats_file(npy_id)):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # Windows does not remove files mapped by another process
+            print(f"Could not remove {file}", e)
+
+
+def release(*npy_ids: str):
+    """Drops the mappings of this process. Files published by this process are removed"""
+    for npy_id in npy_ids:
+        stem = _stem(npy_id)
+        with _lock:
+            _arrays.pop(stem, None)
+            _stats.pop(stem, None)
+            owned = stem in _owned
+            _owned.discard(stem)
+        if owned:
+            _remove_files(npy_id)
+
+
+def discard(*npy_ids: str):
+    """Removes deleted stack entries from shared memory. Entries not persisted yet are then never persisted"""
+    for npy_id in npy_ids:
+        with _lock:
+            _arrays.pop(_stem(npy_id), None)
+            _stats.pop(_stem(npy_id), None)
+            # No longer published. A pending persist finds the file gone and releases it
+            _owned.discard(_stem(npy_id))
+        if SHM_HANDOFF:
+            _remove_files(npy_id)
@@ -1,12 +1,16 @@
 from dotenv import load_dotenv
 print("Load ENV:", load_dotenv())
 
-from flask import Flask, jsonify, send_file, Response, request
+from flask import Flask, jsonify, send_file, Response, request, redirect, abort
 import requests
 import traceback
+import threading
 import os
 import Services.Backend.helpers as backendHelpers
 import Helpers.common_helpers as common_helpers
+from Helpers import http_client
+from Helpers import meta_cache
+from Helpers import render_encoder
 from io import BytesIO
 
 backendApp = Flask("Backend App")
@@ -22,20 +26,54 @@ del _baseUrl
 
 DEBUG = bool(os.getenv("DEBUG", 0))
 
+# Renders addressed by their content hash never change, browsers keep them for a year without asking again
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
 # -------------------------------------------------------- #
 
 
 # ----------------------- Stack Init --------------------- #
-# Load Stack manager on load
+# Stack managers are loaded per session on first use. Frontend sends the session id in the X-Session-Id header
+
+from Helpers.StackManager import sessions
+
+def sessionId() -> str:
+    return sessions.SessionRegistry.validate(request.headers.get("X-Session-Id"))
 
-from Helpers.StackManager.stackManager import StackManager
-stackManager = StackManager() 
+def sessionStack():
+    """Stack manager of the session of the request, locked for the request"""
+    return sessions.session(sessionId())
 # -------------------------------------------------------- #
 
 
 # backendApp.route("/parse", methods=["POST"])
 # def parseFile(fileName: str):
 
+@backendApp.before_request
+def validateSession():
+    render_encoder.reset_timing()
+    try:
+        sessionId()
+    except ValueError as e:
+        return Response(str(e)), 400
+
+def requestEncoding() -> render_encoder.RenderEncoding:
+    """Encoding of the renders of the request. `format` / `tier` params or the Accept header. See `render_encoder.negotiate`"""
+    try:
+        return render_encoder.negotiate(request.args, request.accept_mimetypes)
+    except ValueError as e:
+        abort(Response(f"Unsupported render encoding: {e}", 400))
+
+@backendApp.after_request
+def encodeTiming(response):
+    """Time spent encoding renders for this request and the bytes produced. 0 encodes if the render was cached"""
+    if request.path.startswith("/image"):
+        timing = render_encoder.timing()
+        response.headers["X-Encode-Ms"] = str(timing["ms"])
+        response.headers["X-Encode-Bytes"] = str(timing["bytes"])
+        response.headers["Server-Timing"] = f'encode;dur={timing["ms"]};desc="{timing["count"]} encodes"'
+    return response
+
 @backendApp.errorhandler(Exception)
 def handle_exception(e):
     # Log error
@@ -47,6 +85,21 @@ def handle_exception(e):
         "error": "Internal Server Error"
     }), 500
 
+@backendApp.route("/metrics/upstreams", methods=["GET"])
+def upstreamMetrics():
+    """Latency histograms of the calls this service made to other services"""
+    return jsonify(http_client.metrics())
+
+@backendApp.route("/metrics/caches", methods=["GET"])
+def cacheMetrics():
+    """Hit rates and sizes of the file metadata and thumbnail caches"""
+    return jsonify(meta_cache.metrics())
+
+@backendApp.route("/metrics/sessions", methods=["GET"])
+def sessionMetrics():
+    """Loaded sessions and the memory they hold"""
+    return jsonify(sessions.registry.stats)
+
 @backendApp.route("/file-saved", methods=["PUT"])
 def fileSaved():
     _uuid, filename = common_helpers.get_requestArgs('_uuid', 'filename')
@@ -66,12 +119,37 @@ def getThumbnail():
     # print("Closed?", thumbnail.closed)
     # print("Buffer size:", thumbnail.getbuffer().nbytes)
     
+    # Revalidated on every use, an unchanged thumbnail costs a 304
     return send_file(
         BytesIO(thumbnail), 
         mimetype="image/jpeg",
-        max_age=3600
+        etag=common_helpers.content_hash(thumbnail),
+        max_age=0
     ) 
 
+@backendApp.route("/image/thumbnails", methods=['GET'])
+def getThumbnails():
+    """All thumbnails of a list of uploads in one sprite sheet. Params: uuids=a,b,c, columns"""
+    uuids = tuple(filter(None, common_helpers.get_requestArgs('uuids')[0].split(",")))
+    if not uuids:
+        return Response("No uuids"), 400
+    columns = int(request.args.get("columns", 10))
+    
+    sprite, missing = backendHelpers.getThumbnailSprite(uuids, columns)
+    
+    response = send_file(
+        BytesIO(sprite), 
+        mimetype="image/jpeg",
+        etag=common_helpers.content_hash(sprite),
+        max_age=0
+    )
+    # Index of the sheet. Cell i belongs to uuids[i]
+    response.headers["X-Sprite-Uuids"] = ",".join(uuids)
+    response.headers["X-Sprite-Columns"] = str(max(1, min(columns, len(uuids))))
+    response.headers["X-Sprite-Cell"] = str(backendHelpers.THUMBNAIL_SIZE)
+    response.headers["X-Sprite-Missing"] = ",".join(missing)
+    return response
+
 @backendApp.route("/image", methods=['PUT'])
 def setImage():
     _uuid: str = common_helpers.get_requestArgs('_uuid')[0]
@@ -80,26 +158,141 @@ def setImage():
     new_uuid = backendHelpers.imageSaveToStack(_uuid)
 
     # Add Image to stack
-    stackManager.resetImage(new_uuid)
-    
+    with sessionStack() as stackManager:
+        stackManager.resetImage(new_uuid, _uuid)
     return getImage()
 
+def renderResponse(render_hash: str | None, encoding: render_encoder.RenderEncoding) -> Response:
+    """303 to the content addressed URL of a render. 304 if the client already has it"""
+    if render_hash is None:
+        return Response("No Image", 404)
+    if render_hash in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = redirect(f"/image/{render_hash}.{encoding.ext}", 303)
+    response.set_etag(render_hash)
+    response.headers["X-Render-Hash"] = render_hash
+    response.headers["X-Render-Encoding"] = "/".join(encoding.key)
+    response.cache_control.no_cache = True
+    response.vary.add("Accept")
+    return response
+
+def materialiseCurrent(npy_id: str | None = None) -> Response | None:
+    """Computes pending transformations of the current image (or npy_id of the stack) before it is rendered.
+    Transform jobs compute their output already, this only runs for entries still pending. The session is not held meanwhile.
+    Returns the error response if it could not be computed
+    """
+    with sessionStack() as stackManager:
+        if npy_id not in stackManager.npy_stack:
+            npy_id = stackManager.npy_stack[stackManager.current_pointer] if stackManager.current_pointer > -1 else None
+    if npy_id is None:
+        return None
+    try:
+        backendHelpers.materialise(npy_id)
+    except requests.RequestException as e:
+        return Response(f"Could not compute image: {e}", 502)
+    return None
+
 @backendApp.route("/image", methods=['GET'])
 def getImage():
-    image: bytes | None = stackManager.getCurrentImage()
-    if image is None:
+    """Redirects to the render of the current image, see `getRender`. Encoding from the format / tier params or Accept"""
+    encoding = requestEncoding()
+    if (error := materialiseCurrent()) is not None:
+        return error
+    with sessionStack() as stackManager:
+        render_hash = stackManager.currentRenderHash(encoding)
+    return renderResponse(render_hash, encoding)
+
+@backendApp.route("/image/current", methods=['GET'])
+def getCurrentRender():
+    """Content hash and URL of the render of the current image"""
+    encoding = requestEncoding()
+    if (error := materialiseCurrent()) is not None:
+        return error
+    with sessionStack() as stackManager:
+        render_hash = stackManager.currentRenderHash(encoding)
+    if render_hash is None:
+        return Response("No Image"), 404
+    return jsonify({
+        "hash": render_hash,
+        "url": f"/image/{render_hash}.{encoding.ext}",
+        "format": encoding.format.value,
+        "tier": encoding.tier.value
+    }), 200
+
+@backendApp.route("/image/<render_hash>.<ext>", methods=['GET'])
+def getRender(render_hash: str, ext: str):
+    """Render addressed by its content hash. Its bytes never change, so it is cached as immutable"""
+    if ext not in render_encoder.FORMAT_BY_EXT:
+        return Response("No Image"), 404
+    if render_hash in request.if_none_match:
+        response = Response(status=304)
+    else:
+        # Only hashes this stack served are known. Unknown ones are never rendered to be looked up
+        with sessionStack() as stackManager:
+            render = stackManager.getRender(render_hash)
+        if render is None or render[1].ext != ext:
+            return Response("No Image"), 404
+        image, encoding = render
+        response = send_file(
+            BytesIO(image), 
+            mimetype=encoding.mimetype,
+            max_age=IMMUTABLE_MAX_AGE,
+            conditional=False
+        )
+        response.headers["X-Render-Encoding"] = "/".join(encoding.key)
+    response.set_etag(render_hash)
+    # Renders are scoped to the session, only the browser may keep them
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+@backendApp.route("/image/tiles/info", methods=['GET'])
+def getTileInfo():
+    if (error := materialiseCurrent()) is not None:
+        return error
+    with sessionStack() as stackManager:
+        info: dict | None = stackManager.getTileInfo()
+    if info is None:
         return Response("No Image"), 404
     
-    return send_file(
-        BytesIO(image), 
-        mimetype="image/png",
-        max_age=3600
+    return jsonify(info), 200
+
+@backendApp.route("/image/tiles/<int:z>/<int:x>/<int:y>", methods=['GET'])
+def getTile(z: int, x: int, y: int):
+    # Tiles of a particular stack entry can be requested with npy_id. Defaults to current image
+    npy_id = request.args.get("npy_id")
+    encoding = requestEncoding()
+    if (error := materialiseCurrent(npy_id)) is not None:
+        return error
+    with sessionStack() as stackManager:
+        tile: bytes | None = stackManager.getTile(z, x, y, npy_id, encoding)
+    if tile is None:
+        return Response("No Tile"), 404
+    
+    # Tiles of an npy_id never change. Tiles of the current image change with it and are revalidated
+    # Accept decides the format when no params are given, caches keep the variants apart
+    response = send_file(
+        BytesIO(tile), 
+        mimetype=encoding.mimetype,
+        etag=common_helpers.content_hash(tile),
+        max_age=IMMUTABLE_MAX_AGE if npy_id else 0
     )
+    if npy_id:
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+    response.vary.add("Accept")
+    response.headers["X-Render-Encoding"] = "/".join(encoding.key)
+    return response
 
 @backendApp.route("/stack", methods=["DELETE"])
 def resetStack():
     try:
-        stackManager.reset()
+        with sessionStack() as stackManager:
+            stackManager.reset()
     except:
         return jsonify({
             "success": False
@@ -111,44 +304,77 @@ def resetStack():
 
 @backendApp.route("/stack/state", methods=["GET"])
 def getStackState():
-    stack_size = len(stackManager.npy_stack)
-    pointer = stackManager.current_pointer
+    with sessionStack() as stackManager:
+        stack_size = len(stackManager.npy_stack)
+        pointer = stackManager.current_pointer
 
-    has_image = stack_size > 0
-    is_dirty = stack_size > 1
+        has_image = stack_size > 0
+        is_dirty = stack_size > 1
 
-    return jsonify({
-        "has_image": has_image,
-        "stack_size": stack_size,
-        "current_pointer": pointer,
-        "is_dirty": is_dirty,
-        "undo_possible": stackManager.undoPossible,
-        "redo_possible": stackManager.redoPossible
-    }), 200
+        return jsonify({
+            "session_id": stackManager.session_id,
+            "has_image": has_image,
+            "stack_size": stack_size,
+            "current_pointer": pointer,
+            "is_dirty": is_dirty,
+            "undo_possible": stackManager.undoPossible,
+            "redo_possible": stackManager.redoPossible,
+            "render_cache": stackManager.renderCacheStats,
+            "storage": stackManager.storageStats
+        }), 200
 
 @backendApp.route("/stack/undo", methods=["POST"])
 def undoStack():
-    return jsonify({
-        "success": stackManager.undo(),
-        "stack_pointer": stackManager.current_pointer,
-        "undo_possible": stackManager.undoPossible,
-        "redo_possible": stackManager.redoPossible
-    }), 200
+    with sessionStack() as stackManager:
+        return jsonify({
+            "success": stackManager.undo(),
+            "stack_pointer": stackManager.current_pointer,
+            "undo_possible": stackManager.undoPossible,
+            "redo_possible": stackManager.redoPossible
+        }), 200
     
 @backendApp.route("/stack/redo", methods=["POST"])
 def redoStack():
-    return jsonify({
-        "success": stackManager.redo(),
-        "stack_pointer": stackManager.current_pointer,
-        "undo_possible": stackManager.undoPossible,
-        "redo_possible": stackManager.redoPossible
-    }), 200
+    with sessionStack() as stackManager:
+        return jsonify({
+            "success": stackManager.redo(),
+            "stack_pointer": stackManager.current_pointer,
+            "undo_possible": stackManager.undoPossible,
+            "redo_possible": stackManager.redoPossible
+        }), 200
+
+# ------------------- Transform Jobs --------------------- #
+# A single transform job runs at a time per session. Its output is added to the session's stack once ImageOperations
+# finishes it, only if the image it was applied to is still the current one.
+
+transformJobs: dict[str, dict] = {}        # Last known state of recent jobs
+TRANSFORM_JOB_HISTORY = 64
+pendingJobs: dict[str, str] = {}           # Session id -> running job
+transformLock = threading.Lock()
+
+def watchTransformJob(job_id: str, input_id: str, session_id: str):
+    state = backendHelpers.waitTransformJob(job_id, on_update=lambda s: transformJobs.update({job_id: {**s, "session_id": session_id, "stack_updated": False, "final": False}}))
+
+    # The session may have been unloaded meanwhile, it is loaded again
+    with sessions.session(session_id) as stackManager, transformLock:
+        stack_updated = False
+        if state["status"] == "done":
+            current = stackManager.npy_stack[stackManager.current_pointer] if stackManager.current_pointer > -1 else None
+            if current == input_id:
+                backendHelpers.attachShared(state.get("shared"))
+                stackManager.addImage(state["output_uuid"])
+                stack_updated = True
+            else:
+                print(f"Transform job {job_id} finished after its image was changed, output dropped")
+                backendHelpers.discardOutput(state["output_uuid"])
+
+        transformJobs[job_id] = {**state, "session_id": session_id, "stack_updated": stack_updated, "final": True}
+        pendingJobs.pop(session_id, None)
 
 @backendApp.route("/transform", methods=["PUT"])
 def applyTransform():
-    if stackManager.current_pointer < 0:
-        return Response("No active image selected"), 400
-
+    """Queues a transform of the current image. Poll `GET /transform/jobs/<job_id>` for its progress"""
+    session_id = sessionId()
     body = request.get_json(silent=True) or {}
     op = body.get("op")
     
@@ -157,40 +383,61 @@ def applyTransform():
 
     params = body.get("params", {})
 
-    input_id = stackManager.npy_stack[stackManager.current_pointer]
-
-    try:
-        resp = requests.put(
-            f"{IMAGEOP_URL}/transform",
-            params={
-                "_uuid": input_id,
-                "op": op
-            },
-            json={"params": params},
-            timeout=60
-        )
-    except requests.RequestException as e:
-        return Response(f"ImageOp service unavailable: {e}"), 502
+    with sessionStack() as stackManager, transformLock:
+        if stackManager.current_pointer < 0:
+            return Response("No active image selected"), 400
+        if session_id in pendingJobs:
+            return jsonify({"error": "A transform is already running", "job_id": pendingJobs[session_id]}), 409
+        
+        input_id = stackManager.npy_stack[stackManager.current_pointer]
 
-    if resp.status_code != 201:
-        return Response(resp.text, resp.status_code)
+        try:
+            resp = backendHelpers.submitTransform(input_id, op, params)
+        except requests.RequestException as e:
+            return Response(f"ImageOp service unavailable: {e}"), 502
 
-    data = resp.json()
-    new_id = data.get("output_uuid")
-    if not new_id:
-        return Response("Invalid response from ImageOp"), 500
+        if resp.status_code != 202:
+            return Response(resp.text, resp.status_code)
 
-    stackManager.addImage(new_id)
+        job = resp.json()
+        job_id = job.get("job_id")
+        if not job_id:
+            return Response("Invalid response from ImageOp"), 500
+        
+        pendingJobs[session_id] = job_id
+        transformJobs[job_id] = {**job, "session_id": session_id, "stack_updated": False, "final": False}
+        for old_id in list(transformJobs)[:-TRANSFORM_JOB_HISTORY]:
+            transformJobs.pop(old_id, None)
+    
+    threading.Thread(target=watchTransformJob, args=(job_id, input_id, session_id), daemon=True).start()
 
     return jsonify({
-        "status": "success",
+        "status": job["status"],
+        "job_id": job_id,
         "operation": op,
         "input_uuid": input_id,
-        "output_uuid": new_id,
-        "stack_pointer": stackManager.current_pointer,
-        "undo_possible": stackManager.undoPossible,
-        "redo_possible": stackManager.redoPossible
-    }), 201
+        "output_uuid": job["output_uuid"]
+    }), 202
+
+@backendApp.route("/transform/jobs/<job_id>", methods=["GET"])
+def getTransformJob(job_id: str):
+    """Status and progress of a transform job. final is set once Backend is done with it, stack_updated if its output is the current image"""
+    state = transformJobs.get(job_id)
+    if state is None or state["session_id"] != sessionId():
+        return Response("Job not found"), 404
+    return jsonify(state), 200
+
+@backendApp.route("/transform/jobs/<job_id>", methods=["DELETE"])
+def cancelTransformJob(job_id: str):
+    state = transformJobs.get(job_id)
+    if state is None or state["session_id"] != sessionId():
+        return Response("Job not found"), 404
+    try:
+        resp = backendHelpers.cancelTransformJob(job_id)
+    except requests.RequestException as e:
+        return Response(f"ImageOp service unavailable: {e}"), 502
+    return Response(resp.content, resp.status_code, content_type=resp.headers.get("Content-Type", "application/json"))
 
 
-backendApp.run(port=PORT, debug=DEBUG)
\ No newline at end of file
+if __name__ == "__main__":
+    backendApp.run(port=PORT, debug=DEBUG)
\ No newline at end of file
@@ -1,9 +1,14 @@
-from Helpers.FileClass.file import ImageFile
+from Helpers.FileClass.file import ImageFile, THUMBNAIL_SIZE
 from Helpers import common_helpers
-from functools import lru_cache
+from Helpers import http_client
+from Helpers import shared_array
+from Helpers import meta_cache
+from Helpers.TransformationClass.transformation import TransformationManager, Transformation
 from io import BytesIO
-import pickle
+import time
+import math
 import os
+from PIL import Image as pilImage
 
 # ------------------ Load ENV Variables ------------------ #
 import dotenv
@@ -20,32 +25,146 @@ UPLOADS_DIR:str = os.getenv("uploads_dir", r"Data\Uploads")
 UPLOADS_DIR = os.path.join(_cwd, UPLOADS_DIR)
 os.makedirs(UPLOADS_DIR, exist_ok=True) # Makes directory if not present.
 
+# Seconds between status checks of a running transform job
+TRANSFORM_POLL_SECONDS = float(os.getenv("transform_poll_seconds", 0.2))
 # -------------------------------------------------------- #
 
+imageOp = http_client.upstream("imageOp", IMAGEOP_URL)
+
+# Checked against the files they are made from on every lookup. Re-ingested or deleted uploads are never served stale
+fileCache = meta_cache.MetaCache("files")
+thumbnailCache = meta_cache.MetaCache("thumbnails")
+spriteCache = meta_cache.MetaCache("thumbnail_sprites", max_entries=32)
+
 def initialiseFile(_uuid: str, filename: str):
     """Initialises a File type object and saves a pkl file"""
     newFile = ImageFile(_uuid, filename)
-    newFile.save_pkl()
+    newFile.save()
+
+
+def readFile(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
 
 
-@lru_cache
 def getThumbnail(_uuid: str) -> bytes:
-    img: ImageFile = getPickle(_uuid)
-    return img.thumbnail
+    """Thumbnails are saved at ingest, serving them is a (cached) file read"""
+    thumbnail_file = ImageFile.thumbnail_path(_uuid)
+    if not os.path.exists(thumbnail_file):
+        # Uploads read before thumbnails were saved. Written here and cached from the next call
+        thumbnailCache.invalidate(_uuid)
+        img: ImageFile = getFile(_uuid)
+        return img.thumbnail
+    
+    return thumbnailCache.get(_uuid, meta_cache.file_version(thumbnail_file), lambda: readFile(thumbnail_file))
+
+
+def getThumbnailSprite(uuids: tuple[str, ...], columns: int) -> tuple[bytes, list[str]]:
+    """Packs the thumbnails of many uploads into a single JPEG sheet.
+    
+    Thumbnail i is the cell at column `i % columns`, row `i // columns`, each `THUMBNAIL_SIZE` square.
+    Returns the sheet and the uuids whose thumbnail could not be read (left blank).
+    Cached until one of the thumbnails changes, appears or is removed.
+    """
+    version = meta_cache.files_version(*(ImageFile.thumbnail_path(_uuid) for _uuid in uuids))
+    return spriteCache.get((uuids, columns), version, lambda: packThumbnails(uuids, columns))
+
+
+def packThumbnails(uuids: tuple[str, ...], columns: int) -> tuple[bytes, list[str]]:
+    columns = max(1, min(columns, len(uuids)))
+    rows = max(1, math.ceil(len(uuids) / columns))
+    sheet = pilImage.new("RGB", (columns * THUMBNAIL_SIZE, rows * THUMBNAIL_SIZE), (255, 255, 255))
+    
+    missing = []
+    for i, _uuid in enumerate(uuids):
+        try:
+            thumb = pilImage.open(BytesIO(getThumbnail(_uuid))).convert("RGB")
+        except Exception as e:
+            print(f"Thumbnail of {_uuid} not available", e)
+            missing.append(_uuid)
+            continue
+        if thumb.size != (THUMBNAIL_SIZE, THUMBNAIL_SIZE):
+            thumb = thumb.resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), pilImage.Resampling.LANCZOS)
+        sheet.paste(thumb, ((i % columns) * THUMBNAIL_SIZE, (i // columns) * THUMBNAIL_SIZE))
+    
+    buf = BytesIO()
+    sheet.save(buf, format="JPEG", quality=90)
+    return buf.getvalue(), missing
 
 
-@lru_cache
-def getPickle(_uuid: str) -> ImageFile:
-    """Returns the File Object (Probably ImageFile) Handle FileNotExist manually in when calling this function"""
-    pkl_file = os.path.join(UPLOADS_DIR, _uuid + ".pkl")
-    with open(pkl_file, 'rb') as pkl:
-        return pickle.load(pkl)
+def getFile(_uuid: str) -> ImageFile:
+    """Returns the File Object (Probably ImageFile) from the catalogue. Handle FileNotFoundError manually when calling this function
+    
+    Cached until the npy of the upload is rewritten or removed.
+    """
+    npy_file = os.path.join(UPLOADS_DIR, _uuid + ".npy")
+    return fileCache.get(_uuid, meta_cache.file_version(npy_file), lambda: ImageFile.load(_uuid))
         
 def imageSaveToStack(_uuid: str) -> str:
-    img: ImageFile = getPickle(_uuid)
+    img: ImageFile = getFile(_uuid)
     
     npy = img.npy
     new_uuid = common_helpers.generate_uuid()
-    common_helpers.save_stack_npy(new_uuid, npy)
+    nodata = img.stats["nodata_value"] if img.stats else None
+    common_helpers.save_stack_npy(new_uuid, npy, nodata)
+    
+    return new_uuid
+
+def materialise(npy_id: str):
+    """Transformations are lazy. Asks ImageOperations to compute a stack entry before its pixels are read"""
+    if TransformationManager.isMaterialised(npy_id):
+        return
     
-    return new_uuid
\ No newline at end of file
+    # Not retried, a timed out call would only queue the same compute again
+    response = imageOp.put(
+        "/materialise",
+        params={"_uuid": npy_id},
+        timeout=600
+    )
+    response.raise_for_status()
+    attachShared(response.json().get("shared"))
+
+def attachShared(descriptor: dict | None):
+    """Maps a stack entry ImageOperations handed over in shared memory, so it is rendered without reading the stack"""
+    if descriptor:
+        shared_array.attach(descriptor)
+
+
+# ====================== Transform Jobs ====================== #
+
+def submitTransform(npy_id: str, op: str, params: dict):
+    """Queues a transform on ImageOperations. Returns its response, 202 with the job when accepted"""
+    return imageOp.post(
+        "/jobs",
+        json={"_uuid": npy_id, "op": op, "params": params},
+        timeout=30
+    )
+
+def transformJob(job_id: str) -> dict | None:
+    response = imageOp.get(f"/jobs/{job_id}")
+    if response.status_code != 200:
+        return None
+    return response.json()
+
+def cancelTransformJob(job_id: str):
+    return imageOp.delete(f"/jobs/{job_id}", idempotent=True)
+
+def waitTransformJob(job_id: str, on_update=None) -> dict:
+    """Polls a job until it is done, failed or cancelled. on_update is called with every state seen"""
+    while True:
+        try:
+            state = transformJob(job_id)
+        except Exception as e:
+            return {"job_id": job_id, "status": "failed", "error": f"ImageOp service unavailable: {e}"}
+        if state is None:
+            return {"job_id": job_id, "status": "failed", "error": "Job not found"}
+        if on_update is not None:
+            on_update(state)
+        if state["status"] in ("done", "failed", "cancelled"):
+            return state
+        time.sleep(TRANSFORM_POLL_SECONDS)
+
+def discardOutput(npy_id: str):
+    """Removes a computed stack entry that will not be added to the stack"""
+    common_helpers.remove_stack_npy(npy_id)
+    Transformation.remove(npy_id)
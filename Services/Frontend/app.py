@@ -5,9 +5,10 @@ print("Load ENV:", load_dotenv())
 
 
 import os
-from flask import Flask, render_template, jsonify, request, Response
+from flask import Flask, render_template, jsonify, request, Response, g
 import Services.Frontend.helpers as frontHelpers
 import Helpers.common_helpers as common_helpers
+from Helpers import http_client
 from werkzeug.exceptions import HTTPException
 import logging
 
@@ -26,6 +27,21 @@ DEBUG = bool(os.getenv("DEBUG", 0))
 # -------------------------------------------------------- #
 
 
+# Every browser gets its own stack in Backend. The session id is kept signed in a cookie, Backend only accepts ids issued here
+@frontendApp.before_request
+def loadSession():
+    g.session_token = request.cookies.get(frontHelpers.SESSION_COOKIE)
+    # Cookies of older versions are unsigned, they get a new session
+    g.new_session = common_helpers.verify_session(g.session_token) is None
+    if g.new_session:
+        g.session_token = common_helpers.sign_session(common_helpers.generate_uuid())
+
+@frontendApp.after_request
+def saveSession(response):
+    if g.get("new_session"):
+        response.set_cookie(frontHelpers.SESSION_COOKIE, g.session_token, httponly=True, samesite="Lax")
+    return response
+
 @frontendApp.errorhandler(Exception)
 def handle_exception(e):
     if isinstance(e, HTTPException):
@@ -45,15 +61,29 @@ def handle_exception(e):
 def index():
     return render_template('index.html')
 
-# API endpoint to get image list
+# API endpoint to get image list. Params: offset, limit, sort (created / filename), order (asc / desc)
 @frontendApp.route('/api/images', methods=['GET'])
 def api_get_images():
-    images = frontHelpers.getImageList()
-    # Return as list of dicts: [{uuid:..., filename:...}, ...]
-    return jsonify([
-        {"uuid": uuid, "filename": filename}
-        for uuid, filename in images.items()
-    ])
+    limit = request.args.get('limit')
+    try:
+        images, total = frontHelpers.getImageList(
+            offset=int(request.args.get('offset', 0)),
+            limit=int(limit) if limit is not None else None,
+            sort=request.args.get('sort', 'created'),
+            descending=request.args.get('order', 'asc') == 'desc'
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    
+    # Return as list of dicts: [{uuid:..., filename:..., ...}, ...]. Total count of uploads in X-Total-Count
+    response = jsonify(images)
+    response.headers["X-Total-Count"] = str(total)
+    return response
+
+# Latency of the calls made to Backend
+@frontendApp.route('/metrics/upstreams', methods=['GET'])
+def upstreamMetrics():
+    return jsonify(http_client.metrics())
 
 # Proxy thumbnail route
 @frontendApp.route('/image/thumbnail', methods=['GET'])
@@ -61,11 +91,28 @@ def getImageThumbnail():
     _uuid = common_helpers.get_requestArgs('_uuid')[0]
     return frontHelpers.getImageThumbnail(_uuid)
 
+# Batched thumbnails. Either a list of uuids or a page of the image list
+@frontendApp.route('/image/thumbnails', methods=['GET'])
+def getImageThumbnails():
+    columns = int(request.args.get('columns', 10))
+    uuids = request.args.get('uuids')
+    if uuids:
+        uuids = uuids.split(",")
+    else:
+        page = int(request.args.get('page', 0))
+        page_size = int(request.args.get('page_size', 100))
+        images, _ = frontHelpers.getImageList(offset=page * page_size, limit=page_size)
+        uuids = [image["uuid"] for image in images]
+    
+    if not uuids:
+        return jsonify({"error": "No images"}), 404
+    return frontHelpers.getImageThumbnails(uuids, columns)
+
 @frontendApp.route('/upload', methods=['PUT'])
 def fileUpload():
     """
     Copies the file to 'Data/Uploads'
-    Renames file to uuid.ext and updates mapping.pkl
+    Renames file to uuid.ext and records it in the catalogue
     """    
     file = request.files['file']
     filename = str(file.filename)
@@ -121,13 +168,32 @@ def resetStack():
 @frontendApp.route('/image', methods=['PUT'])
 def setImage():
     _uuid = common_helpers.get_requestArgs('_uuid')[0]
-    content, status, headers = frontHelpers.setImage(_uuid)
-    return Response(content, status=status, headers=dict(headers))
+    return frontHelpers.setImage(_uuid)
 
 @frontendApp.route('/image', methods=['GET'])
 def getImage():
     return frontHelpers.getImage()
 
+@frontendApp.route('/image/current', methods=['GET'])
+def getCurrentRender():
+    content, status, headers = frontHelpers.getCurrentRender()
+    return Response(content, status=status, headers=dict(headers))
+
+# Renders addressed by their content hash. Cached by the browser as immutable
+@frontendApp.route('/image/<render_hash>.<ext>', methods=['GET'])
+def getRender(render_hash: str, ext: str):
+    return frontHelpers.getRender(render_hash, ext)
+
+@frontendApp.route('/image/tiles/info', methods=['GET'])
+def getTileInfo():
+    content, status, headers = frontHelpers.getTileInfo()
+    return Response(content, status=status, headers=dict(headers))
+
+@frontendApp.route('/image/tiles/<int:z>/<int:x>/<int:y>', methods=['GET'])
+def getTile(z: int, x: int, y: int):
+    npy_id = request.args.get('npy_id')
+    return frontHelpers.getTile(z, x, y, npy_id)
+
 @frontendApp.route("/transform", methods=["PUT"])
 def applyTransform():
     """
@@ -142,5 +208,15 @@ def applyTransform():
 
     return frontHelpers.applyTransform(op, params)
 
+@frontendApp.route("/transform/jobs/<job_id>", methods=["GET"])
+def getTransformJob(job_id: str):
+    content, status, headers = frontHelpers.getTransformJob(job_id)
+    return Response(content, status=status, headers=dict(headers))
+
+@frontendApp.route("/transform/jobs/<job_id>", methods=["DELETE"])
+def cancelTransformJob(job_id: str):
+    content, status, headers = frontHelpers.cancelTransformJob(job_id)
+    return Response(content, status=status, headers=dict(headers))
+
 if __name__ == '__main__':
     frontendApp.run(port=PORT, debug=DEBUG)
\ No newline at end of file
@@ -1,12 +1,13 @@
 import uuid
 import base64
 import os
-import pickle
 import dotenv
 from werkzeug import datastructures as ds
 import logging
 import requests
-from flask import jsonify, Response
+from flask import jsonify, Response, request, g
+from Helpers import http_client
+from Helpers import catalogue
 
 # ------------------ Load ENV Variables ------------------ #
 # dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
@@ -21,21 +22,62 @@ UPLOADS_DIR:str = os.getenv("uploads_dir", r"Data\Uploads")
 UPLOADS_DIR = os.path.join(_cwd, UPLOADS_DIR)
 os.makedirs(UPLOADS_DIR, exist_ok=True) # Makes directory if not present.
 
+# Bytes held per proxied image response while it is passed on to the browser
+PROXY_CHUNK_SIZE = int(os.getenv("proxy_chunk_kb", 64)) * 1024
 # -------------------------------------------------------- #
 
+backend = http_client.upstream("backend", BACKEND_URL)
+
+# Headers of an upstream image response passed on to the browser
+_PROXY_HEADERS = (
+    "Content-Length", "Content-Encoding", "ETag", "Last-Modified", "Cache-Control", "Expires", "Vary",
+    "X-Render-Encoding", "X-Encode-Ms", "X-Encode-Bytes", "Server-Timing"
+)
+# Conditional headers of the browser request passed on to Backend, so unchanged images come back as 304
+_CONDITIONAL_HEADERS = ("If-None-Match", "If-Modified-Since")
+# Params and headers of the browser request choosing the encoding of renders, see `render_encoder.negotiate`
+_RENDER_PARAMS = ("format", "tier")
+_RENDER_HEADERS = ("Accept",)
+
+# Cookie holding the session id of the browser. Backend keeps a stack per session
+SESSION_COOKIE = "session_id"
+
+def sessionHeaders() -> dict:
+    """Session of the request for Backend. Set by `before_request` of the app"""
+    return {"X-Session-Id": g.session_token}
+
+def conditionalHeaders() -> dict:
+    return {k: v for k in _CONDITIONAL_HEADERS if (v := request.headers.get(k))}
+
+def renderParams() -> dict:
+    return {k: v for k in _RENDER_PARAMS if (v := request.args.get(k))}
+
+def renderHeaders() -> dict:
+    return {k: v for k in _RENDER_HEADERS if (v := request.headers.get(k))}
+
+def streamResponse(response, default_type: str = "image/png", extra_headers: tuple[str, ...] = ()) -> Response:
+    """Passes an upstream `stream=True` response on chunk by chunk.
+    ---
+    The body is never held whole, at most PROXY_CHUNK_SIZE bytes of it are in memory at a time.
+    Bytes are forwarded as received (no decoding), so Content-Length and Content-Encoding stay valid.
+    The upstream connection goes back to the pool once the browser has the body or disconnects.
+    """
+    headers = {k: v for k in _PROXY_HEADERS + extra_headers if (v := response.headers.get(k))}
+    body = response.raw.stream(PROXY_CHUNK_SIZE, decode_content=False)
+    proxied = Response(
+        body,
+        status=response.status_code,
+        content_type=response.headers.get("Content-Type", default_type),
+        headers=headers,
+        direct_passthrough=True
+    )
+    proxied.call_on_close(response.close)
+    return proxied
+
 def addFileMapping(_uuid, filename) -> bool:
     try:
-        mapping_file = os.path.join(UPLOADS_DIR, 'mapping.pkl')
-        print("Mapping", mapping_file)
-        try:
-            with open(mapping_file, 'rb') as mapp:
-                mapping = pickle.load(mapp)
-        except FileNotFoundError:
-            mapping = {}
-        mapping[_uuid] = filename
-        
-        with open(mapping_file, 'wb') as mapp:
-            pickle.dump(mapping, mapp, protocol=pickle.HIGHEST_PROTOCOL)
+        # Single row insert in its own transaction. Concurrent uploads do not overwrite each other
+        catalogue.add_upload(_uuid, filename)
     except Exception as e:
         print(e)
         # logging.exception("Unhandled", e)
@@ -58,8 +100,8 @@ def saveFileToUploads(_uuid: str, file: ds.FileStorage) -> bool:
 def backend_informFileUpload(_uuid: str, original_filename: str) -> bool:
     # Send a put request to backend
     # Informs backend that a new file has been uploaded with uuid
-    response = requests.put(
-        f'{BACKEND_URL}/file-saved',
+    response = backend.put(
+        '/file-saved',
         params={'_uuid': _uuid, 'filename': original_filename}
     )
     if response.status_code != 200:
@@ -70,39 +112,43 @@ def removeFile(file: str):
     filepath = os.path.join(UPLOADS_DIR, file)
     os.remove(filepath)
 
-def getImageList():
-    # Read mapping.pkl for list of files
-    # Generate map: -> {uuid: uuid, fileName: filename}
-    # return json
-    mapping_file_path = os.path.join(UPLOADS_DIR, 'mapping.pkl')
-    try:
-        with open(mapping_file_path, 'rb') as mapp:
-            mapping = pickle.load(mapp)
-        return mapping
-    except FileNotFoundError:
-        return {}
+def getImageList(offset: int = 0, limit: int | None = None, sort: str = "created", descending: bool = False) -> tuple[list[dict], int]:
+    """A page of the uploads from the catalogue and the number of uploads. See `catalogue.list_uploads`"""
+    return catalogue.list_uploads(offset, limit, sort, descending)
     
 def getImageThumbnail(_uuid: str):
-    response = requests.get(
-        f'{BACKEND_URL}/image/thumbnail',
+    response = backend.get(
+        '/image/thumbnail',
         params={'_uuid': _uuid},
-        stream=True,
-        timeout=5
+        headers=conditionalHeaders(),
+        stream=True
     )
-    if response.status_code != 200:
+    if response.status_code not in (200, 304):
+        response.close()
         return Response("Thumbnail fetch failed", status=404)
     
     logging.info("Thumbnail fetched for %s", _uuid)
-    return Response(
-        response.content,
-        status=200,
-        content_type=response.headers.get("Content-Type", "image/jpeg")
+    return streamResponse(response, "image/jpeg")
+    
+def getImageThumbnails(uuids: list[str], columns: int):
+    """Single request for the thumbnails of many uploads. Sprite sheet with its index in the X-Sprite-* headers"""
+    response = backend.get(
+        '/image/thumbnails',
+        params={'uuids': ",".join(uuids), 'columns': columns},
+        headers=conditionalHeaders(),
+        stream=True
     )
+    if response.status_code not in (200, 304):
+        response.close()
+        return Response("Thumbnail fetch failed", status=response.status_code)
+    
+    sprite_headers = tuple(k for k in response.headers if k.startswith("X-Sprite-"))
+    return streamResponse(response, "image/jpeg", sprite_headers)
     
 def getStackState():
-    response = requests.get(
-        f'{BACKEND_URL}/stack/state',
-        timeout=5
+    response = backend.get(
+        '/stack/state',
+        headers=sessionHeaders()
     )
     if response.status_code != 200:
         return None
@@ -110,9 +156,9 @@ def getStackState():
     return response.json()
 
 def undoStack():
-    response = requests.post(
-        f'{BACKEND_URL}/stack/undo',
-        timeout=5
+    response = backend.post(
+        '/stack/undo',
+        headers=sessionHeaders()
     )
 
     return (
@@ -122,9 +168,9 @@ def undoStack():
     )
 
 def redoStack():
-    response = requests.post(
-        f'{BACKEND_URL}/stack/redo',
-        timeout=5
+    response = backend.post(
+        '/stack/redo',
+        headers=sessionHeaders()
     )
 
     return (
@@ -134,9 +180,10 @@ def redoStack():
     )
 
 def resetStack():
-    response = requests.delete(
-        f'{BACKEND_URL}/stack',
-        timeout=5
+    response = backend.delete(
+        '/stack',
+        headers=sessionHeaders(),
+        idempotent=True
     )
 
     return (
@@ -147,30 +194,94 @@ def resetStack():
 
 
 def setImage(_uuid):
-    response = requests.put(
-        f'{BACKEND_URL}/image',
-        params={'_uuid': _uuid},
-        timeout=10
+    response = backend.put(
+        '/image',
+        params={'_uuid': _uuid, **renderParams()},
+        headers={**sessionHeaders(), **renderHeaders()},
+        stream=True
     )
 
+    return streamResponse(response)
+
+def getImage():
+    # The redirect to the render is passed on, the browser then fetches (or reuses) the content addressed render
+    # Backend may compute a pending image first, these calls are not repeated on a timeout
+    try:
+        response = backend.get(
+            '/image',
+            params=renderParams(),
+            headers={**sessionHeaders(), **conditionalHeaders(), **renderHeaders()},
+            allow_redirects=False,
+            stream=True,
+            idempotent=False
+        )
+    except requests.RequestException as e:
+        return Response(f"Backend unavailable: {e}", status=502)
+
+    return streamResponse(response, extra_headers=("Location", "X-Render-Hash"))
+
+def getCurrentRender():
+    try:
+        response = backend.get(
+            '/image/current',
+            params=renderParams(),
+            headers={**sessionHeaders(), **renderHeaders()},
+            idempotent=False
+        )
+    except requests.RequestException as e:
+        return f"Backend unavailable: {e}", 502, []
+
     return (
         response.content,
         response.status_code,
         response.headers.items()
     )
 
-def getImage():
-    response = requests.get(
-        f'{BACKEND_URL}/image',
-        stream=True,
-        timeout=10
+def getRender(render_hash: str, ext: str):
+    response = backend.get(
+        f'/image/{render_hash}.{ext}',
+        headers={**sessionHeaders(), **conditionalHeaders()},
+        stream=True
     )
+    if response.status_code not in (200, 304):
+        response.close()
+        return Response("Render fetch failed", status=response.status_code)
 
-    return Response(
+    return streamResponse(response)
+    
+def getTileInfo():
+    try:
+        response = backend.get(
+            '/image/tiles/info',
+            headers=sessionHeaders(),
+            idempotent=False
+        )
+    except requests.RequestException as e:
+        return f"Backend unavailable: {e}", 502, []
+
+    return (
         response.content,
-        status=response.status_code,
-        content_type=response.headers.get("Content-Type", "image/png")
+        response.status_code,
+        response.headers.items()
     )
+
+def getTile(z: int, x: int, y: int, npy_id: str | None = None):
+    params = {'npy_id': npy_id} if npy_id else {}
+    try:
+        response = backend.get(
+            f'/image/tiles/{z}/{x}/{y}',
+            params={**params, **renderParams()},
+            headers={**sessionHeaders(), **conditionalHeaders(), **renderHeaders()},
+            stream=True,
+            idempotent=False
+        )
+    except requests.RequestException as e:
+        return Response(f"Backend unavailable: {e}", status=502)
+    if response.status_code not in (200, 304):
+        response.close()
+        return Response("Tile fetch failed", status=response.status_code)
+
+    return streamResponse(response)
     
 def applyTransform(op: str, params: dict):
     """
@@ -178,9 +289,10 @@ def applyTransform(op: str, params: dict):
     Backend manages stack, state, and ImageOp routing.
     """
     try:
-        response = requests.put(
-            f"{BACKEND_URL}/transform",
+        response = backend.put(
+            "/transform",
             json={"op": op, "params": params},
+            headers=sessionHeaders(),
             timeout=60
         )
     except requests.RequestException as e:
@@ -197,3 +309,29 @@ def applyTransform(op: str, params: dict):
             "application/json"
         )
     )
+
+
+def getTransformJob(job_id: str):
+    response = backend.get(
+        f'/transform/jobs/{job_id}',
+        headers=sessionHeaders()
+    )
+
+    return (
+        response.content,
+        response.status_code,
+        response.headers.items()
+    )
+
+def cancelTransformJob(job_id: str):
+    response = backend.delete(
+        f'/transform/jobs/{job_id}',
+        headers=sessionHeaders(),
+        idempotent=True
+    )
+
+    return (
+        response.content,
+        response.status_code,
+        response.headers.items()
+    )
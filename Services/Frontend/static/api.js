@@ -79,6 +79,35 @@ registerUIAction('reset-btn', 'click', () => {
 });
 
 
+// Thumbnails are fetched as one sprite sheet per page of the image list
+const THUMB_PAGE_SIZE = 100;
+const THUMB_COLUMNS = 10;
+
+function loadThumbnailPage(uuids, canvases) {
+    const query = `uuids=${encodeURIComponent(uuids.join(','))}&columns=${THUMB_COLUMNS}`;
+    return fetch(`/image/thumbnails?${query}`)
+        .then(res => {
+            if (!res.ok) throw new Error("Thumbnail fetch failed");
+            const columns = parseInt(res.headers.get('X-Sprite-Columns'), 10) || THUMB_COLUMNS;
+            const cell = parseInt(res.headers.get('X-Sprite-Cell'), 10) || 64;
+            return res.blob().then(blob => createImageBitmap(blob)).then(sheet => ({ sheet, columns, cell }));
+        })
+        .then(({ sheet, columns, cell }) => {
+            // Cell i of the sheet belongs to uuids[i]
+            uuids.forEach((uuid, i) => {
+                const canvas = canvases[uuid];
+                if (!canvas) return;
+                canvas.width = cell;
+                canvas.height = cell;
+                const sx = (i % columns) * cell;
+                const sy = Math.floor(i / columns) * cell;
+                canvas.getContext('2d').drawImage(sheet, sx, sy, cell, cell, 0, 0, cell, cell);
+            });
+            sheet.close();
+        })
+        .catch(err => console.log(err.message));
+}
+
 // Fetch and render image list with thumbnails
 function fetchAndRenderImageList() {
     fetch('/api/images')
@@ -91,14 +120,14 @@ function fetchAndRenderImageList() {
                 imageListContainer.innerHTML = '<div style="color: #888;">No images uploaded.</div>';
                 return;
             }
+            const canvases = {};
             images.forEach(img => {
                 const thumbDiv = document.createElement('div');
                 thumbDiv.className = 'thumb-item';
-                // Fetch thumbnail from backend (returns Bytes Stream)
-                const imgEl = document.createElement('img');
-                imgEl.src = `/image/thumbnail?_uuid=${encodeURIComponent(img.uuid)}`;
-                imgEl.alt = 'thumb';
-                imgEl.loading = 'lazy';
+                // Drawn from the page sprite sheet once it arrives
+                const imgEl = document.createElement('canvas');
+                imgEl.className = 'thumb-canvas';
+                canvases[img.uuid] = imgEl;
 
                 const label = document.createElement('span');
                 label.className = 'thumb-label';
@@ -112,6 +141,11 @@ function fetchAndRenderImageList() {
                 // TODO: Add click handler to select image
                 imageListContainer.appendChild(thumbDiv);
             });
+
+            for (let start = 0; start < images.length; start += THUMB_PAGE_SIZE) {
+                const uuids = images.slice(start, start + THUMB_PAGE_SIZE).map(img => img.uuid);
+                loadThumbnailPage(uuids, canvases);
+            }
         });
 }
 
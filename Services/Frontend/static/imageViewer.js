@@ -1,12 +1,17 @@
 // imageViewer.js
 // Responsible ONLY for rendering, panning, zooming a single image
+// The image is drawn from tiles of an overview pyramid. Only tiles on screen are fetched.
 
 const ImageViewer = (function () {
-    let imageElement = null;
     let containerElement = null;
     let viewerElement = null;
+    let tileLayer = null;
 
-    let currentUUID = null;
+    // Tile grid of the current image -> GET /image/tiles/info
+    let tileInfo = null;
+    // Tiles currently placed in the layer. Key: "z/x/y"
+    let tiles = new Map();
+    let renderScheduled = false;
 
     // Transform state
     let scale = 1;
@@ -21,9 +26,9 @@ const ImageViewer = (function () {
     function init() {
         viewerElement = document.getElementById("image-viewer");
         containerElement = document.getElementById("image-container");
-        imageElement = document.getElementById("main-image");
+        tileLayer = document.getElementById("tile-layer");
 
-        if (!viewerElement || !containerElement || !imageElement) {
+        if (!viewerElement || !containerElement || !tileLayer) {
             console.error("ImageViewer init failed: DOM elements missing");
             return;
         }
@@ -31,24 +36,35 @@ const ImageViewer = (function () {
         attachInteractionHandlers();
     }
 
-    function loadImage(uuid) {
-        currentUUID = uuid;
-
-        imageElement.onload = () => fitImageToView();
-        imageElement.src = `/image?_uuid=${encodeURIComponent(uuid)}`;
+    function reload() {
+        return fetch("/image/tiles/info")
+            .then(res => res.ok ? res.json() : null)
+            .then(info => {
+                clearTiles();
+                tileInfo = info;
+                if (!tileInfo) {
+                    containerElement.style.width = "0px";
+                    containerElement.style.height = "0px";
+                    return;
+                }
+
+                containerElement.style.width = `${tileInfo.width}px`;
+                containerElement.style.height = `${tileInfo.height}px`;
+                fitImageToView();
+            });
     }
 
-    function reload() {
-        imageElement.onload = () => fitImageToView();
-        imageElement.src = `/image?ts=${Date.now()}`;
+    function clearTiles() {
+        tiles.forEach(tile => tile.remove());
+        tiles.clear();
     }
 
     function fitImageToView() {
         const viewWidth = viewerElement.clientWidth;
         const viewHeight = viewerElement.clientHeight;
 
-        const imgWidth = imageElement.naturalWidth;
-        const imgHeight = imageElement.naturalHeight;
+        const imgWidth = tileInfo.width;
+        const imgHeight = tileInfo.height;
 
         const scaleX = viewWidth / imgWidth;
         const scaleY = viewHeight / imgHeight;
@@ -64,6 +80,93 @@ const ImageViewer = (function () {
     function updateTransform() {
         containerElement.style.transform =
             `translate(${translateX}px, ${translateY}px) scale(${scale})`;
+        scheduleRender();
+    }
+
+    function scheduleRender() {
+        if (renderScheduled) return;
+        renderScheduled = true;
+        requestAnimationFrame(() => {
+            renderScheduled = false;
+            renderTiles();
+        });
+    }
+
+    // Zoom level at which one tile pixel is roughly one screen pixel
+    function currentZoom() {
+        const level = Math.floor(Math.log2(1 / scale));
+        const clamped = Math.min(Math.max(level, 0), tileInfo.max_zoom);
+        return tileInfo.max_zoom - clamped;
+    }
+
+    function tileKey(z, x, y) {
+        return `${z}/${x}/${y}`;
+    }
+
+    function placeTile(z, x, y) {
+        const key = tileKey(z, x, y);
+        if (tiles.has(key)) return;
+
+        // Full resolution pixels covered by one pixel of this level
+        const factor = Math.pow(2, tileInfo.max_zoom - z);
+        const size = tileInfo.tile_size;
+        const levelWidth = Math.ceil(tileInfo.width / factor);
+        const levelHeight = Math.ceil(tileInfo.height / factor);
+
+        const tile = document.createElement("img");
+        tile.className = "tile";
+        tile.draggable = false;
+        tile.style.left = `${x * size * factor}px`;
+        tile.style.top = `${y * size * factor}px`;
+        tile.style.width = `${Math.min(size, levelWidth - x * size) * factor}px`;
+        tile.style.height = `${Math.min(size, levelHeight - y * size) * factor}px`;
+        // Lower resolution tiles stay underneath as a backdrop while finer tiles load
+        tile.style.zIndex = z;
+        tile.src = `/image/tiles/${z}/${x}/${y}?npy_id=${encodeURIComponent(tileInfo.npy_id)}`;
+
+        tileLayer.appendChild(tile);
+        tiles.set(key, tile);
+    }
+
+    function renderTiles() {
+        if (!tileInfo) return;
+
+        const z = currentZoom();
+        const factor = Math.pow(2, tileInfo.max_zoom - z);
+        const span = tileInfo.tile_size * factor;
+
+        // Container origin sits at the centre of the viewer
+        const originX = viewerElement.clientWidth / 2 + translateX;
+        const originY = viewerElement.clientHeight / 2 + translateY;
+
+        // Visible region in full resolution pixels
+        const left = Math.max(0, -originX / scale);
+        const top = Math.max(0, -originY / scale);
+        const right = Math.min(tileInfo.width, (viewerElement.clientWidth - originX) / scale);
+        const bottom = Math.min(tileInfo.height, (viewerElement.clientHeight - originY) / scale);
+
+        const wanted = new Set();
+
+        // Whole image backdrop
+        placeTile(0, 0, 0);
+        wanted.add(tileKey(0, 0, 0));
+
+        if (right > left && bottom > top) {
+            for (let ty = Math.floor(top / span); ty * span < bottom; ty++) {
+                for (let tx = Math.floor(left / span); tx * span < right; tx++) {
+                    placeTile(z, tx, ty);
+                    wanted.add(tileKey(z, tx, ty));
+                }
+            }
+        }
+
+        // Drop tiles which are off screen or of another zoom level
+        tiles.forEach((tile, key) => {
+            if (!wanted.has(key)) {
+                tile.remove();
+                tiles.delete(key);
+            }
+        });
     }
 
     function attachInteractionHandlers() {
@@ -74,11 +177,10 @@ const ImageViewer = (function () {
         containerElement.addEventListener("mousedown", handleMouseDown);
         window.addEventListener("mousemove", handleMouseMove);
         window.addEventListener("mouseup", handleMouseUp);
+        window.addEventListener("resize", scheduleRender);
     }
 
     function handleZoom(event) {
-        // if (!currentUUID) return;
-
         event.preventDefault();
 
         const rect = containerElement.getBoundingClientRect();
@@ -99,8 +201,6 @@ const ImageViewer = (function () {
     }
 
     function handleMouseDown(event) {
-        // if (!currentUUID) return;
-
         isDragging = true;
         lastMouseX = event.clientX;
         lastMouseY = event.clientY;
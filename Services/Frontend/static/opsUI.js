@@ -8,6 +8,9 @@ const OpsUI = (function () {
     let operationSelect = null;
     let paramsContainer = null;
     let applyButton = null;
+    let runningJob = null;      // Job id of the transform in progress
+
+    const JOB_POLL_MS = 300;
 
     async function init() {
         categorySelect = document.getElementById("op-category");
@@ -97,6 +100,12 @@ const OpsUI = (function () {
     }
 
     async function applyTransform() {
+        // While a job runs the button cancels it
+        if (runningJob) {
+            await fetch(`/transform/jobs/${encodeURIComponent(runningJob)}`, { method: "DELETE" });
+            return;
+        }
+
         const category = categorySelect.value;
         const operation = operationSelect.value;
         const params = collectParams();
@@ -114,9 +123,34 @@ const OpsUI = (function () {
             alert("Transformation failed");
             return;
         }
+
+        // Transforms run as jobs, the stack is updated once the job is done
+        const job = await res.json();
+        runningJob = job.job_id;
+        const state = await waitForJob(job.job_id);
+        runningJob = null;
+        applyButton.textContent = "Apply";
+
+        if (state.status === "failed") {
+            alert(`Transformation failed: ${state.error}`);
+            return;
+        }
         await fetchStackState();
         // Re-render current image
-        ImageViewer.reload();
+        if (state.stack_updated) ImageViewer.reload();
+    }
+
+    async function waitForJob(jobId) {
+        while (true) {
+            const res = await fetch(`/transform/jobs/${encodeURIComponent(jobId)}`);
+            if (!res.ok) return { status: "failed", error: "Job status unavailable" };
+
+            const state = await res.json();
+            if (state.final) return state;
+
+            applyButton.textContent = `Cancel (${Math.round(state.progress * 100)}%)`;
+            await new Promise(resolve => setTimeout(resolve, JOB_POLL_MS));
+        }
     }
 
     function attachHandlers() {
@@ -3,6 +3,7 @@ print("Load ENV:", load_dotenv())
 
 from Helpers import common_helpers
 from Services.ImageOperations import helpers as imageOpHelpers
+from Services.ImageOperations import jobs as imageOpJobs
 from flask import Flask, send_file, Response, jsonify, request
 import os
 from io import BytesIO
@@ -20,31 +21,113 @@ DEBUG = bool(os.getenv("DEBUG", 0))
 
 # -------------------------------------------------------- #
 
+def transformErrors(submit) -> tuple[imageOpJobs.Job | str | None, Response | None]:
+    """Records a transformation with `submit()`. Returns its result or the error response"""
+    try:
+        return submit(), None
+    except NotImplementedError:
+        return None, Response(
+            "Invalid Transformation Operation", 400
+        )
+    except ValueError as e:
+        return None, Response(
+            f"Invalid Transformation Parameters: {e}", 400
+        )
+    except FileNotFoundError:
+        return None, Response(
+            "Input image not found in stack", 404
+        )
+
+def jobResponse(job: imageOpJobs.Job) -> dict:
+    job_dict = job.to_dict()
+    if job.status == imageOpJobs.DONE and job_dict["shared"] is None:
+        job_dict["shared"] = imageOpHelpers.sharedDescriptor(job.output_uuid)
+    return job_dict
+
 @imageOpApp.put("/transform")
 def transformImage():
+    """Records a transformation and waits for it. Pointwise ones stay lazy. See `POST /jobs` to not wait"""
     npy_id, op = common_helpers.get_requestArgs("_uuid", "op")
 
     body = request.get_json(silent=True) or {}
     params = body.get("params", {})
 
-    try:
-        new_id = imageOpHelpers.applyTransform(npy_id, op, params)
-    except NotImplementedError:
-        return Response(
-            "Invalid Transformation Operation"
-        ), 400
-    except FileNotFoundError:
-        return Response(
-            "Input image not found in stack"
-        ), 404
+    new_id, error = transformErrors(lambda: imageOpHelpers.transformationManager.record(op, npy_id, params))
+    if new_id is None:
+        return error
+    
+    if op not in imageOpHelpers.pointwise_transforms:
+        job = imageOpJobs.getJobManager().materialise(new_id)     # type: ignore
+        job.done.wait()
+        if job.status != imageOpJobs.DONE:
+            return Response(f"Transformation {job.status}: {job.error}"), 500
         
     return jsonify({
         "transformation": f"transform.{op}",
         "input_uuid": npy_id,
         "output_uuid": new_id,
-        "params": params
+        "params": params,
+        "shared": imageOpHelpers.sharedDescriptor(new_id)
     }), 201
 
+@imageOpApp.post("/jobs")
+def submitTransformJob():
+    """Queues a transformation and returns the job right away.
+    
+    Body: {"_uuid": str, "op": str, "params": dict}
+    """
+    body = request.get_json(silent=True) or {}
+    npy_id, op = body.get("_uuid"), body.get("op")
+    if not npy_id or not op:
+        return Response("Missing _uuid or op"), 400
+    
+    job, error = transformErrors(lambda: imageOpJobs.getJobManager().submit(op, npy_id, body.get("params", {})))
+    if job is None:
+        return error
+    return jsonify(jobResponse(job)), 202     # type: ignore
+
+@imageOpApp.get("/jobs")
+def listJobs():
+    return jsonify([job.to_dict() for job in imageOpJobs.getJobManager().list()]), 200
+
+@imageOpApp.get("/jobs/<job_id>")
+def getJob(job_id: str):
+    job = imageOpJobs.getJobManager().get(job_id)
+    if job is None:
+        return Response("Job not found"), 404
+    return jsonify(jobResponse(job)), 200
+
+@imageOpApp.delete("/jobs/<job_id>")
+def cancelJob(job_id: str):
+    job = imageOpJobs.getJobManager().cancel(job_id)
+    if job is None:
+        return Response("Job not found"), 404
+    return jsonify(jobResponse(job)), 200
+
+@imageOpApp.put("/materialise")
+def materialiseImage():
+    npy_id = common_helpers.get_requestArgs("_uuid")[0]
+
+    if not imageOpHelpers.transformationManager.exists(npy_id):
+        return Response(
+            "Input image not found in stack"
+        ), 404
+    
+    # Computed by a worker. Concurrent requests for the same entry wait for the same job
+    computed = not imageOpHelpers.transformationManager.isMaterialised(npy_id)
+    if computed:
+        job = imageOpJobs.getJobManager().materialise(npy_id)
+        job.done.wait()
+        if job.status != imageOpJobs.DONE:
+            return Response(f"Materialise {job.status}: {job.error}"), 500
+    
+    return jsonify({
+        "uuid": npy_id,
+        "computed": computed,
+        "shared": imageOpHelpers.sharedDescriptor(npy_id)
+    }), 200
 
 
-imageOpApp.run(port=PORT, debug=DEBUG)
\ No newline at end of file
+if __name__ == "__main__":
+    # Threaded so status and cancel requests are served while jobs run. Reloader off, it would start a second worker pool
+    imageOpApp.run(port=PORT, debug=DEBUG, threaded=True, use_reloader=False)
@@ -1,23 +1,135 @@
 import numpy as np
 
-def map_range(img: np.ndarray, outmin=0, outmax=255, outType=np.uint8) -> np.ndarray:
-    _min, _max = np.min(img), np.max(img)
-    normalised_img = (img - _min) / (_max - _min)
+def map_range(img: np.ndarray, outmin=0, outmax=255, outType=np.uint8, in_range: tuple[float, float] | None = None) -> np.ndarray:
+    """Maps the image linearly to [outmin, outmax]. Pass in_range (from the band stats) to skip the min / max scan"""
+    _min, _max = in_range if in_range is not None else (np.min(img), np.max(img))
+    normalised_img = (img - _min) / ((_max - _min) or 1)
     range_mapped = outType(normalised_img * (outmax - outmin) + outmin)
     return range_mapped # type: ignore
 
-def clip_normalise(img: np.ndarray, clip_percent: float = 2):
-    assert 0 < clip_percent < 50, "Clip percent should be between 0 ~ 50"
+# ---------------------- Percentiles -------------- #
+# Rows counted at once. Bounds the memory of the histogram passes
+PERCENTILE_STRIP_ROWS = 1024
+# Integer images with a value range up to this many values are counted exactly. Bounds the counts to 8 MB per band,
+# wider ranges use the float histogram
+EXACT_HIST_MAX_BINS = 1 << 20
+# Bins of the float histogram. The percentile error is at most (max - min) / FLOAT_HIST_BINS
+FLOAT_HIST_BINS = 1 << 16
+
+def _strips(img: np.ndarray, band: int):
+    for r in range(0, img.shape[0], PERCENTILE_STRIP_ROWS):
+        yield np.asarray(img[r:r + PERCENTILE_STRIP_ROWS, :, band])
+
+def _band_range(img: np.ndarray, band: int) -> tuple[float, float]:
+    _min, _max = np.inf, -np.inf
+    for strip in _strips(img, band):
+        if strip.size:
+            _min = min(_min, float(np.nanmin(strip)))
+            _max = max(_max, float(np.nanmax(strip)))
+    return _min, _max
+
+def _histogram_percentiles(counts: np.ndarray, percents: np.ndarray, lo: float, width: float, exact: bool) -> np.ndarray:
+    """Percentiles from a histogram with the same linear interpolation as np.percentile"""
+    cdf = np.cumsum(counts)
+    n = int(cdf[-1]) if len(cdf) else 0
+    if n == 0:
+        return np.full(len(percents), np.nan)
     
-    pixel_min, pixel_max = np.nanpercentile(img, (clip_percent, 100 - clip_percent))
-    # return np.clip((img - pixel_min) / (pixel_max - pixel_min), 0, 1)
-    return np.clip(img, pixel_min, pixel_max)
+    ranks = percents / 100 * (n - 1)
+    below, above = np.floor(ranks), np.ceil(ranks)
+    
+    def order_stat(k: np.ndarray) -> np.ndarray:
+        bins = np.searchsorted(cdf, k, side='right')
+        if exact:
+            return lo + bins.astype(np.float64)
+        # Ranks are spread evenly within a float bin
+        before = np.where(bins > 0, cdf[np.maximum(bins - 1, 0)], 0)
+        frac = (k - before + 0.5) / counts[bins]
+        return lo + (bins + frac) * width
+    
+    v_below, v_above = order_stat(below), order_stat(above)
+    return v_below + (ranks - below) * (v_above - v_below)
 
-def clip_normalise_bandwise(img: np.ndarray, clip_percent: float = 2):
+def band_percentiles(img: np.ndarray, percents, strip_rows: int | None = None, band_range: tuple[np.ndarray, np.ndarray] | None = None) -> np.ndarray:
+    """Per band percentiles in O(n), ignoring NaN. Returns shape (len(percents), D)
+    
+    1. Integer bands are counted with `np.bincount` and give the same result as `np.nanpercentile`.
+    2. Float bands (and integer bands with a very wide range) use a fixed bin histogram between the band min and max. The error is at most one bin width.
+    3. The image is read in row strips so memory mapped and chunked images are never copied whole.
+    4. Pass the exact per band (min, max) when known (recorded band stats) to skip the range pass.
+    """
     assert 2 <= len(img.shape) <= 3, "Invalid image shape"
     if len(img.shape) == 2:
         img = img[..., np.newaxis]
+    percents = np.atleast_1d(np.asarray(percents, dtype=np.float64))
+    assert np.all((0 <= percents) & (percents <= 100)), "Percentiles should be between 0 ~ 100"
+    
+    result = np.empty((len(percents), img.shape[2]), dtype=np.float64)
+    for band in range(img.shape[2]):
+        _min, _max = (float(band_range[0][band]), float(band_range[1][band])) if band_range is not None else _band_range(img, band)
+        if not np.isfinite(_min):
+            result[:, band] = np.nan
+            continue
         
-    bands = [clip_normalise(img[:, :, i], clip_percent=clip_percent) for i in range(img.shape[2])]
+        if np.issubdtype(img.dtype, np.integer) and _max - _min < EXACT_HIST_MAX_BINS:
+            lo, bins = int(_min), int(_max - _min) + 1
+            counts = np.zeros(bins, dtype=np.int64)
+            for strip in _strips(img, band):
+                counts += np.bincount((strip.astype(np.int64) - lo).ravel(), minlength=bins)
+            result[:, band] = _histogram_percentiles(counts, percents, lo, 1, exact=True)
+            continue
+        
+        width = (_max - _min) / FLOAT_HIST_BINS or 1
+        # The last edge is the max itself. _min + width * FLOAT_HIST_BINS can round below it and drop the max pixels
+        hist_range = (_min, _max) if _max > _min else (_min, _min + width * FLOAT_HIST_BINS)
+        counts = np.zeros(FLOAT_HIST_BINS, dtype=np.int64)
+        for strip in _strips(img, band):
+            # NaN lies outside the range and is not counted
+            counts += np.histogram(strip, bins=FLOAT_HIST_BINS, range=hist_range)[0]
+        result[:, band] = np.clip(_histogram_percentiles(counts, percents, _min, width, exact=False), _min, _max)
+    return result
 
-    return np.stack(bands, axis=2)
\ No newline at end of file
+def _clip_bounds(img: np.ndarray, clip_percent: float, band_range: tuple[np.ndarray, np.ndarray] | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Clip bounds in the image dtype so the dtype is preserved. Integer bounds are rounded to the nearest value"""
+    assert 0 < clip_percent < 50, "Clip percent should be between 0 ~ 50"
+    pixel_min, pixel_max = band_percentiles(img, (clip_percent, 100 - clip_percent), band_range=band_range)
+    if np.issubdtype(img.dtype, np.integer):
+        pixel_min, pixel_max = np.rint(pixel_min), np.rint(pixel_max)
+    return pixel_min.astype(img.dtype), pixel_max.astype(img.dtype)
+
+def clip_normalise(img: np.ndarray, clip_percent: float = 2, out: np.ndarray | None = None):
+    """Clips the whole image to its percentiles. Pass `out` (can be img itself) to write in place"""
+    pixel_min, pixel_max = _clip_bounds(img.reshape(img.shape[0], -1), clip_percent)
+    # return np.clip((img - pixel_min) / (pixel_max - pixel_min), 0, 1)
+    return np.clip(img, pixel_min[0], pixel_max[0], out=out)
+
+def clip_normalise_bandwise(img: np.ndarray, clip_percent: float = 2, out: np.ndarray | None = None):
+    """Clips each band to its own percentiles in a single pass. Pass `out` (can be img itself) to write in place"""
+    assert 2 <= len(img.shape) <= 3, "Invalid image shape"
+    if len(img.shape) == 2:
+        img = img[..., np.newaxis]
+        if out is not None:
+            out = out[..., np.newaxis]
+    
+    pixel_min, pixel_max = _clip_bounds(img, clip_percent)
+    # Bounds broadcast over the band axis, no per band copies
+    return np.clip(img, pixel_min, pixel_max, out=out)
+
+def gamma_correct(img: np.ndarray, gamma: float = 1, max_value: float | np.ndarray | None = None) -> np.ndarray:
+    """Applies `max * (img / max) ** (1 / gamma)`. gamma > 1 brightens the image.
+    
+    The dtype is preserved. max defaults to the dtype max for integer images and the band max for floats.
+    """
+    assert gamma > 0, "Gamma should be positive"
+    if max_value is None:
+        if np.issubdtype(img.dtype, np.integer):
+            max_value = np.iinfo(img.dtype).max
+        else:
+            max_value = np.nanmax(img, axis=(0, 1)) if img.ndim == 3 else np.nanmax(img)
+    max_value = np.where(max_value == 0, 1, max_value).astype(np.float32)
+    
+    corrected = np.clip(img, 0, None).astype(np.float32) / max_value
+    corrected = np.power(corrected, 1 / gamma, out=corrected) * max_value
+    if np.issubdtype(img.dtype, np.integer):
+        np.rint(corrected, out=corrected)
+    return corrected.astype(img.dtype, copy=False)
@@ -4,10 +4,13 @@ import rasterio.profiles as rioProfiles
 import rasterio.windows as rioWindows
 import rasterio.io as rioIO
 from affine import Affine
+import math
 import numpy as np
 from PIL import Image
 
 from Helpers import common_helpers
+from Helpers import shared_array
+from Helpers.TransformationClass.transformation import TransformationManager, PointwiseOp
 
 
 def loadRaster(filePath: str) -> rioIO.DatasetReader:
@@ -20,10 +23,39 @@ def saveNPY(img: np.ndarray, outFile: str) -> None:
     except Exception as e:
         print(f"Error saving {outFile}.npy", e)
     
-def savePNG(img: np.ndarray, outFile: str) -> None:
+def datasetStretch(img: np.ndarray, clip_percent: float = 2, sample_px: int = 4_000_000) -> tuple[np.ndarray, np.ndarray]:
+    """Per band clip percentiles of a whole image, computed once on a strided sample.
+    
+    Pass it to `savePNG` so every clip of the image is stretched the same way.
+    
+    :return: (low, high) arrays with a value per band
+    """
+    assert 0 < clip_percent < 50, "Clip percent should be between 0 ~ 50"
+    if len(img.shape) == 2:
+        img = img[..., np.newaxis]
+    
+    height, width = img.shape[:2]
+    step = max(1, math.ceil(math.sqrt(height * width / sample_px)))
+    sample = np.asarray(img[::step, ::step])
+    low, high = colorCorrection.band_percentiles(sample, (clip_percent, 100 - clip_percent))
+    return low, high
+
+def savePNG(img: np.ndarray, outFile: str, stretch: tuple[np.ndarray, np.ndarray] | None = None) -> None:
+    """Saves the first 3 bands as an 8 bit png.
+    
+    :param stretch: (low, high) per band from `datasetStretch`. Percentiles of the clip itself are used if not set.
+    :type stretch: tuple[np.ndarray, np.ndarray] | None
+    """
     # PNG Save
-    img = colorCorrection.clip_normalise_bandwise(img, clip_percent=2)
-    img = colorCorrection.map_range(img)
+    if stretch is None:
+        img = colorCorrection.clip_normalise_bandwise(img, clip_percent=2)
+        img = colorCorrection.map_range(img)
+    else:
+        # Same mapping as above with the dataset wide percentiles
+        low, high = stretch
+        img = np.clip(img, low, high).astype(np.float32)
+        _min, _max = float(np.min(low)), float(np.max(high))
+        img = np.uint8((img - _min) / ((_max - _min) or 1) * 255)
     img_file = Image.fromarray(img[:, :, :3], 'RGB')
     try:
         img_file.save(outFile+".png")
@@ -46,7 +78,8 @@ def saveTif(img: np.ndarray, y_start: int, x_start: int, src_profile:rioProfiles
         transform=src_transform
     )
     
-    profile = src_profile
+    # Copied, the source profile is shared by all clips
+    profile = src_profile.copy()
     
     profile.update({
         'height': height,
@@ -68,10 +101,8 @@ def rasterToNP(img: rioIO.DatasetReader) -> np.ndarray:
     
     Shape transposed from (D, H, W) -> (H, W, D)
     """
-    bands = [img.read(i+1) for i in range(img.count)]
-    img_bands = np.stack(bands)
-    img_bands = img_bands.transpose((1, 2, 0))
-    return img_bands
+    # Single read of all bands. moveaxis is a view, no extra copy
+    return np.moveaxis(img.read(), 0, -1)
 
 
 # =========================== Transformations ========================= #
@@ -80,26 +111,95 @@ def transformNormalise(npy, clip_percent:str="2"):
     """Transforms an image and returns the new ID in the stack"""    
     transformed = colorCorrection.clip_normalise_bandwise(npy, float(clip_percent))
     return transformed    
+
+def transformGamma(npy, gamma:str="1"):
+    return colorCorrection.gamma_correct(npy, float(gamma))
+
+def transformMapRange(npy, outmin:str="0", outmax:str="255"):
+    return colorCorrection.map_range(npy, float(outmin), float(outmax))
  
  
 def invalidTransform(*args, **kwargs):
     raise NotImplementedError
 
 
+# ---------------------- Pointwise (fusable) definitions -------------- #
+# prepare computes the data dependent constants of the op input, the same as the op run on the full image.
+#   min / max come from the recorded band stats (carried through the monotone ops before), else a strip pass.
+#   Percentiles are counted strip by strip by `band_percentiles`.
+# apply runs the op on a strip of rows with those constants
+
+def _bandRange(src, stats: dict | None) -> tuple[np.ndarray, np.ndarray]:
+    """Exact per band (min, max) of the op input. NaN ignored"""
+    if stats is not None:
+        return np.asarray(stats["min"], dtype=np.float64), np.asarray(stats["max"], dtype=np.float64)
+    ranges = np.array([colorCorrection._band_range(src, band) for band in range(src.shape[2])]).reshape(-1, 2)
+    return ranges[:, 0], ranges[:, 1]
+
+def _validateNormalise(clip_percent:str="2"):
+    if not 0 < float(clip_percent) < 50:
+        raise ValueError("Clip percent should be between 0 ~ 50")
+
+def _prepareNormalise(src, stats: dict | None, clip_percent:str="2"):
+    return colorCorrection._clip_bounds(src, float(clip_percent), band_range=_bandRange(src, stats) if stats is not None else None)
+
+def _applyNormalise(chunk: np.ndarray, ctx) -> np.ndarray:
+    pixel_min, pixel_max = ctx
+    return np.clip(chunk, pixel_min, pixel_max)
+
+def _validateGamma(gamma:str="1"):
+    if not float(gamma) > 0:
+        raise ValueError("Gamma should be positive")
+
+def _prepareGamma(src, stats: dict | None, gamma:str="1"):
+    if np.issubdtype(src.dtype, np.integer):
+        max_value = np.iinfo(src.dtype).max
+    else:
+        max_value = _bandRange(src, stats)[1]
+    return float(gamma), max_value
+
+def _applyGamma(chunk: np.ndarray, ctx) -> np.ndarray:
+    gamma, max_value = ctx
+    return colorCorrection.gamma_correct(chunk, gamma, max_value)
+
+def _prepareMapRange(src, stats: dict | None, outmin:str="0", outmax:str="255"):
+    mins, maxs = _bandRange(src, stats)
+    return float(np.nanmin(mins)), float(np.nanmax(maxs)), float(outmin), float(outmax)
+
+def _applyMapRange(chunk: np.ndarray, ctx) -> np.ndarray:
+    _min, _max, outmin, outmax = ctx
+    normalised_img = (chunk.astype(np.float32) - _min) / ((_max - _min) or 1)
+    range_mapped = np.clip(normalised_img * (outmax - outmin) + outmin, outmin, outmax)
+    return np.uint8(range_mapped)   # type: ignore
+
+
 # Add all transformation defintion above this
 # Map transform string to its function definition
 transforms = {
     "normalise": transformNormalise,
+    "gamma": transformGamma,
+    "map_range": transformMapRange,
 }
-    
-def applyTransform(npy_id, op, params):
-    npy = common_helpers.read_stack_npy(npy_id)
-    if npy is None:
-        raise FileNotFoundError
 
-    transformed = transforms.get(op, invalidTransform)(npy, **params)
-    new_id = common_helpers.generate_uuid()
-    
-    # Save the new transformed to stack
-    common_helpers.save_stack_npy(new_id, transformed)
-    return new_id
\ No newline at end of file
+# Transformations that only depend on the pixel itself. These are recorded lazily and fused.
+pointwise_transforms = {
+    "normalise": PointwiseOp(_applyNormalise, _prepareNormalise, _validateNormalise, monotone=True),
+    "gamma": PointwiseOp(_applyGamma, _prepareGamma, _validateGamma, monotone=True),
+    "map_range": PointwiseOp(_applyMapRange, _prepareMapRange, monotone=True),
+}
+
+transformationManager = TransformationManager(transforms, pointwise_transforms)
+
+# Transformations are recorded and computed as jobs, see `jobs.JobManager`.
+# Pointwise transformations stay lazy until their pixels are needed. Others are computed right away.
+
+def materialise(npy_id, progress=None) -> bool:
+    """Computes the pending transformations of a stack entry. False if there was nothing to compute"""
+    return transformationManager.materialise(npy_id, handoff=True, progress=progress)
+
+def sharedDescriptor(npy_id) -> dict | None:
+    """Shared memory descriptor of a stack entry not yet persisted. Readers map it instead of reading the stack"""
+    # Entries computed by a worker process are mapped here first
+    if shared_array.get(npy_id) is None:
+        return None
+    return shared_array.descriptor(npy_id)
@@ -1,10 +1,140 @@
 import rasterio.io as rioIO
+from affine import Affine
 import numpy as np
 import os
-from ImageOperations import helpers
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, Iterator, NamedTuple
+from Services.ImageOperations import helpers
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Writer threads per export format
+EXPORT_WORKERS = int(os.getenv("export_workers", os.cpu_count() or 4))
+# Clip writes waiting per format. Bounds memory of clips not yet written
+EXPORT_QUEUE = int(os.getenv("export_queue", 64))
+# -------------------------------------------------------- #
+
+def clipOffsets(height: int, width: int, clip_size: int, overlap: float=0) -> tuple[np.ndarray, np.ndarray]:
+    """Returns the (y, x) upper left offsets of the clips covering an image, row major.
+    
+    Clips are `clip_size` square and step by `clip_size * (1 - overlap)`. Clips on the right and bottom edge may extend past the image.
+    """
+    assert 0 <= overlap <= 1, "Define Overlap as float between 0~1"
+    
+    step_size = max(1, int(clip_size * (1 - overlap)))      # Step Size to account for overlapping of clips. Clips overlap horizontally and vertically
+    ys, xs = np.meshgrid(np.arange(0, height, step_size), np.arange(0, width, step_size), indexing='ij')
+    return ys.ravel(), xs.ravel()
+
+class Clip(NamedTuple):
+    """A single clip yielded by `iterClips`"""
+    y: int
+    x: int
+    data: np.ndarray                # (clip_size, clip_size, D). Read only view, padded copy on the right and bottom edge
+    transform: Affine | None        # Affine of the clip when the source transform is given
+
+def iterClips(img: np.ndarray, clip_size: int, overlap: float=0, transform: Affine | None=None) -> Iterator[Clip]:
+    """Lazily yields square clips of a larger image with their (y, x) offsets.
+    
+    Interior clips are read only views of `img` and cost no memory. Only clips crossing the right or bottom edge are copied to be zero padded.
+    
+    :param img: The image with shape as (H, W) or (H, W, D). Memory mapped and chunked arrays are only read where clipped.
+    :type img: np.ndarray
+    :param clip_size: The length of clip side in pixels
+    :type clip_size: int
+    :param overlap: How much should each clip overlap with any of its neighbouring clip.
+    :type overlap: float 0~1
+    :param transform: Affine transform of the image. Each clip gets the transform of its own window.
+    :type transform: Affine | None
+    """
+    assert 2 <= len(img.shape) <= 3, "Invalid image shape"
+    
+    # Fix shape to have all 3 values -> if grayscale, explicitly defines the layer as 1
+    if len(img.shape) == 2:
+        img = img[..., np.newaxis]
+    (height, width, depth) = img.shape       # (h, w, d)
+    
+    for y, x in zip(*clipOffsets(height, width, clip_size, overlap)):
+        y, x = int(y), int(x)
+        clip = np.asarray(img[y:y+clip_size, x:x+clip_size])
+        
+        if clip.shape[0] < clip_size or clip.shape[1] < clip_size:
+            padded = np.zeros((clip_size, clip_size, depth), dtype=clip.dtype)
+            padded[:clip.shape[0], :clip.shape[1]] = clip
+            clip = padded
+        
+        clip.flags.writeable = False
+        clip_transform = transform * Affine.translation(x, y) if transform is not None else None
+        yield Clip(y, x, clip, clip_transform)
+
+def exportClips(clips: Iterable[Clip], clip_name: str, dir: str, saveTypes: list[str], src: rioIO.DatasetReader | None=None, stretch: tuple[np.ndarray, np.ndarray] | None=None, total: int | None=None, workers: int=EXPORT_WORKERS, queue_size: int=EXPORT_QUEUE) -> int:
+    """Writes clips to disk in parallel. Returns the number of clips exported.
+    
+    1. Each format has its own pool of `workers` threads. npy, png and tif writes of a clip run side by side.
+    2. At most `queue_size` writes wait per format. Reading clips pauses until the writers catch up.
+    3. Progress is printed every 10% when `total` is given.
+    
+    :param clips: Clips from `iterClips`
+    :type clips: Iterable[Clip]
+    :param stretch: Dataset wide (low, high) from `helpers.datasetStretch` used for all png clips
+    :type stretch: tuple[np.ndarray, np.ndarray] | None
+    :param total: Expected number of clips, only used for progress
+    :type total: int | None
+    """
+    assert src is not None or 'tif' not in saveTypes, "Source src required to save as .tif"
+    # Read once, the dataset is not shared with the writer threads
+    profile, transform = (src.profile, src.transform) if src is not None else (None, None)
+    
+    writers = {
+        'npy': lambda clip, prefix: helpers.saveNPY(clip.data, prefix),
+        'png': lambda clip, prefix: helpers.savePNG(clip.data, prefix, stretch),
+        'tif': lambda clip, prefix: helpers.saveTif(clip.data, clip.y, clip.x, profile, transform, prefix),   # type: ignore
+    }
+    saveTypes = [t for t in saveTypes if t in writers]
+    pools = {t: ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"export_{t}") for t in saveTypes}
+    slots = {t: threading.BoundedSemaphore(queue_size) for t in saveTypes}
+    
+    lock = threading.Lock()
+    pending: dict[tuple[int, int], int] = {}      # clip offset -> formats not yet written
+    done = [0]
+    step = max(1, (total or 0) // 10)
+    
+    def onWritten(saveType: str, clip: Clip, future: Future):
+        slots[saveType].release()
+        if future.exception() is not None:
+            print(f"Error exporting {saveType} clip {clip.y}_{clip.x}", future.exception())
+        with lock:
+            pending[(clip.y, clip.x)] -= 1
+            if pending[(clip.y, clip.x)]:
+                return
+            del pending[(clip.y, clip.x)]
+            done[0] += 1
+            if total and (done[0] % step == 0 or done[0] == total):
+                print(f"Exported {done[0]}/{total} clips")
+    
+    count = 0
+    try:
+        for clip in clips:
+            count += 1
+            file_prefix = os.path.join(dir, f"{clip_name}_{clip.y}_{clip.x}")
+            with lock:
+                pending[(clip.y, clip.x)] = len(saveTypes)
+            for saveType in saveTypes:
+                slots[saveType].acquire()
+                future = pools[saveType].submit(writers[saveType], clip, file_prefix)
+                future.add_done_callback(lambda f, t=saveType, c=clip: onWritten(t, c, f))
+    finally:
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+    
+    return count
 
 def makeClips(img: np.ndarray, clip_size: int, overlap:float=0, save:bool=False, clip_name:str="", dir:str="", saveTypes:list[str]=["npy", "png", "tif"], src: rioIO.DatasetReader | None=None) -> list[np.ndarray]:
-    """Generates square image clips from a larger image.
+    """Generates square image clips from a larger image. Wraps `iterClips`, use it directly to not hold all clips at once.
+    
+    Returned clips are writable copies, editing one does not change `img`. Clips of `iterClips` are read only views.
     
     :param img: The image with shape as (H, W) or (H, W, D)
     :type img: np.ndarray
@@ -23,60 +153,33 @@ def makeClips(img: np.ndarray, clip_size: int, overlap:float=0, save:bool=False,
     :param src: Dataset Reader when opening raster via rasterio
     :type src: rioIO.DatasetReader | None
     """
-    assert 2 <= len(img.shape) <= 3, "Invalid image shape"
     assert 0 <= overlap <= 1, "Define Overlap as float between 0~1"
     
     # Clip saving validation.
     can_save = save and clip_name != "" and saveTypes
     if save and not can_save:
         print("Please provide clip name prefix and saveTypes for saving. Skipping Save")
-
-    # Fix shape to have all 3 values -> if grayscale, explicitly defines the layer as 1
-    if len(img.shape) == 2:
-        img = img[..., np.newaxis]
-    (height, width, _) = img.shape       # (h, w, d)
+    if can_save and 'tif' in saveTypes:
+        assert src != None, "Source src required to save as .tif"
     
     print("Starting")
     
-    step_size = int(clip_size * (1 - overlap))      # Step Size to account for overlapping of clips. Clips overlap horizontally and vertically
     clips = []
-    for y in range(0, height, step_size):
-        for x in range(0, width, step_size):
-            x_lim = x+clip_size
-            y_lim = y+clip_size
-            
-            pad_x = max(0, x_lim-width)
-            pad_y = max(0, y_lim-height)
-            
-            x_bound = min(x_lim, width)
-            y_bound = min(y_lim, height)
+    def collect() -> Iterator[Clip]:
+        for clip in iterClips(img, clip_size, overlap):
+            # Copied as callers may edit clips in place. Views would write into img
+            clips.append(np.array(clip.data))
+            yield clip
 
-            clip = img[y:y_bound, x:x_bound, :]
-            
-            if pad_x or pad_y:
-                padding = (
-                    (0, pad_y),
-                    (0, pad_x),
-                    (0, 0)
-                )
-                clip = np.pad(clip, padding, mode='constant', constant_values=0)
-            
-            # clip = img[y:y+clip_size, x:x+clip_size, :]
-            clips.append(clip)
-
-            if can_save:
-                file_prefix = os.path.join(dir, f"{clip_name}_{y}_{x}")
-                # NP file save
-                if 'npy' in saveTypes:
-                    helpers.saveNPY(clip, file_prefix)
-                
-                if 'png' in saveTypes:
-                    helpers.savePNG(clip, file_prefix)
+    if can_save:
+        # One stretch for the whole image so all png clips look the same
+        stretch = helpers.datasetStretch(img) if 'png' in saveTypes else None
+        total = len(clipOffsets(img.shape[0], img.shape[1], clip_size, overlap)[0])
+        exportClips(collect(), clip_name, dir, saveTypes, src=src, stretch=stretch, total=total)
+    else:
+        for _ in collect():
+            pass
                 
-                if 'tif' in saveTypes:
-                    assert src != None, "Source src required to save as .tif"
-                    helpers.saveTif(clip, y, x, src.profile, src.transform, file_prefix)
-                    
     print("Total Clips", len(clips))
 
     return clips
@@ -0,0 +1,229 @@
+import os
+import time
+import threading
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, Future
+from Helpers import common_helpers
+from Helpers import shared_array
+from Helpers.TransformationClass.transformation import Transformation
+from Services.ImageOperations import helpers as imageOpHelpers
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Worker processes running transformations. 0 uses every core
+IMAGEOP_WORKERS = int(os.getenv("imageOp_workers", 0)) or os.cpu_count() or 1
+# Finished jobs kept for status queries
+JOB_HISTORY = int(os.getenv("imageOp_job_history", 256))
+# -------------------------------------------------------- #
+
+"""
+Transformation jobs run in a pool of worker processes.
+---
+1. `submit` records the transformation right away and returns a job. A worker then materialises the output off the request path,
+   so the job progress and cancel cover the actual compute. Pending pointwise ops before it are fused into the same pass.
+2. Workers report progress through a dict shared with this process.
+3. `cancel` drops a queued job. A running job is told to stop and stops at its next progress report.
+4. The output is handed over in shared memory, `Job.shared` holds its descriptor once the job is done.
+
+JOB::
+{
+    "job_id": str, "op": str, "input_uuid": str, "output_uuid": str, "params": dict,
+    "status": "queued" | "running" | "done" | "failed" | "cancelled",
+    "progress": 0 ~ 1, "error": str | None, "shared": dict | None,
+    "created": float, "finished": float | None
+}
+"""
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINAL = (DONE, FAILED, CANCELLED)
+# Progress value asking a running job to stop
+_CANCEL_FLAG = -1.0
+
+
+class JobCancelled(Exception):
+    pass
+
+
+# ----------------------- Worker side ----------------------- #
+
+_progress = None
+
+def _initWorker(progress):
+    global _progress
+    _progress = progress
+
+def _report(job_id: str, done: float):
+    if _progress.get(job_id) == _CANCEL_FLAG:     # type: ignore
+        raise JobCancelled(job_id)
+    _progress[job_id] = float(done)     # type: ignore
+
+def _runMaterialise(job_id: str, npy_id: str) -> tuple[bool, dict | None]:
+    """Materialises a stack entry in a worker. Returns whether anything was computed and the shared memory descriptor"""
+    _report(job_id, 0.0)
+    computed = imageOpHelpers.materialise(npy_id, progress=lambda done: _report(job_id, done))
+    return computed, shared_array.descriptor(npy_id)
+
+
+# ----------------------- Service side ---------------------- #
+
+class Job:
+    def __init__(self, op: str, input_uuid: str, output_uuid: str, params: dict):
+        self.id = common_helpers.generate_uuid()
+        self.op = op
+        self.input_uuid = input_uuid
+        self.output_uuid = output_uuid
+        self.params = params
+        self.status = QUEUED
+        self.progress = 0.0
+        self.error: str | None = None
+        self.shared: dict | None = None
+        self.created = time.time()
+        self.finished: float | None = None
+        self.future: Future | None = None
+        self.done = threading.Event()
+
+    def finish(self, status: str, error: str | None = None):
+        self.status = status
+        self.error = error
+        if status == DONE:
+            self.progress = 1.0
+        self.finished = time.time()
+        self.done.set()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "op": self.op,
+            "input_uuid": self.input_uuid,
+            "output_uuid": self.output_uuid,
+            "params": self.params,
+            "status": self.status,
+            "progress": round(self.progress, 3),
+            "error": self.error,
+            "shared": self.shared,
+            "created": self.created,
+            "finished": self.finished,
+        }
+
+
+class JobManager:
+    """Queue of transformation jobs over a process pool sized to the cores
+
+    :param workers: Worker processes
+    :type workers: int
+    """
+    def __init__(self, workers: int = IMAGEOP_WORKERS):
+        self.workers = workers
+        self.__sync = multiprocessing.Manager()
+        self.__progress = self.__sync.dict()
+        self.__pool = ProcessPoolExecutor(max_workers=workers, initializer=_initWorker, initargs=(self.__progress,))
+        self.__jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.__materialising: dict[str, Job] = {}      # Output id -> running job, a stack entry is only computed once
+        self.__lock = threading.Lock()
+        print(f"Transformation pool with {workers} workers")
+
+    def submit(self, op: str, npy_id: str, params: dict) -> Job:
+        """Records a transformation and queues its computation
+
+        :raises NotImplementedError: Unknown op
+        :raises ValueError: Invalid params
+        :raises FileNotFoundError: Input not in the stack
+        """
+        output_uuid = imageOpHelpers.transformationManager.record(op, npy_id, params)
+        job = Job(op, npy_id, output_uuid, params)
+        with self.__lock:
+            self.__jobs[job.id] = job
+            self.__prune()
+        self.__start(job)
+        return job
+
+    def materialise(self, npy_id: str) -> Job:
+        """Job computing a stack entry. Joins the running job of the same entry if there is one"""
+        with self.__lock:
+            running = self.__materialising.get(npy_id)
+            if running is not None:
+                return running
+            job = Job("materialise", npy_id, npy_id, {})
+            self.__jobs[job.id] = job
+            self.__prune()
+        self.__start(job)
+        return job
+
+    def __start(self, job: Job):
+        with self.__lock:
+            self.__materialising[job.output_uuid] = job
+        self.__progress[job.id] = None
+        job.future = self.__pool.submit(_runMaterialise, job.id, job.output_uuid)
+        job.future.add_done_callback(lambda future: self.__finished(job, future))
+
+    def __finished(self, job: Job, future: Future):
+        with self.__lock:
+            self.__materialising.pop(job.output_uuid, None)
+        self.__progress.pop(job.id, None)
+
+        if future.cancelled():
+            status, error = CANCELLED, None
+        elif isinstance(future.exception(), JobCancelled):
+            status, error = CANCELLED, None
+        elif future.exception() is not None:
+            status, error = FAILED, f"{type(future.exception()).__name__}: {future.exception()}"
+        else:
+            _, job.shared = future.result()
+            status, error = DONE, None
+
+        # The node of an output that was never computed is dropped so nothing reads it later.
+        # A job cancelled after its output was written has its pixels removed too
+        if status != DONE and job.op != "materialise":
+            common_helpers.remove_stack_npy(job.output_uuid)
+            Transformation.remove(job.output_uuid)
+        print(f"Job {job.id} ({job.op}) {status}" + (f": {error}" if error else ""))
+        job.finish(status, error)
+
+    def get(self, job_id: str) -> Job | None:
+        with self.__lock:
+            job = self.__jobs.get(job_id)
+        if job is not None and job.status not in FINAL:
+            progress = self.__progress.get(job.id)
+            if progress is not None and progress != _CANCEL_FLAG and job.status not in FINAL:
+                job.status = RUNNING
+                job.progress = progress
+        return job
+
+    def list(self) -> list[Job]:
+        with self.__lock:
+            job_ids = list(self.__jobs)
+        return [job for job_id in job_ids if (job := self.get(job_id)) is not None]
+
+    def cancel(self, job_id: str) -> Job | None:
+        job = self.get(job_id)
+        if job is None or job.status in FINAL:
+            return job
+        # Queued jobs are dropped by the pool. Running ones stop at their next progress report
+        if job.future is not None and not job.future.cancel():
+            self.__progress[job.id] = _CANCEL_FLAG
+        return job
+
+    def __prune(self):
+        """Forgets the oldest finished jobs beyond JOB_HISTORY"""
+        finished = [job_id for job_id, job in self.__jobs.items() if job.status in FINAL]
+        for job_id in finished[:max(0, len(self.__jobs) - JOB_HISTORY)]:
+            del self.__jobs[job_id]
+
+    def shutdown(self):
+        self.__pool.shutdown(wait=True, cancel_futures=True)
+        self.__sync.shutdown()
+
+
+_manager: JobManager | None = None
+_manager_lock = threading.Lock()
+
+def getJobManager() -> JobManager:
+    """The job manager of the service. Created on first use so worker processes never start their own pool"""
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = JobManager()
+        return _manager
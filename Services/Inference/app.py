@@ -1,7 +1,10 @@
 from dotenv import load_dotenv
 print("Load ENV:", load_dotenv())
 
-from flask import Flask
+from flask import Flask, Response, jsonify, request
+from Services.Inference import helpers as inferenceHelpers
+from Helpers import http_client
+import requests
 import os
 
 inferenceApp = Flask("Inference App")
@@ -22,5 +25,50 @@ DEBUG = bool(os.getenv("DEBUG", 0))
 def health():
     return {"status": "OK"}, 200
 
+@inferenceApp.get("/metrics/upstreams")
+def upstreamMetrics():
+    """Latency histograms of the calls this service made to other services"""
+    return jsonify(http_client.metrics())
 
-inferenceApp.run(debug=DEBUG, port=PORT)
\ No newline at end of file
+@inferenceApp.post("/detect")
+def detect():
+    """Tiled detection over a full stack entry or upload.
+    
+    Body: {"_uuid": str, "source": "stack" | "upload", "clip_size": int, "overlap": float, "conf": float, "iou": float}
+    """
+    body = request.get_json(silent=True) or {}
+    _uuid = body.get("_uuid")
+    if not _uuid:
+        return Response("Missing _uuid"), 400
+    
+    source = body.get("source", "stack")
+    if source not in ("stack", "upload"):
+        return Response("source should be stack or upload"), 400
+    
+    try:
+        params = inferenceHelpers.detectParams(body)
+    except ValueError as e:
+        return Response(f"Invalid detection parameters: {e}"), 400
+    
+    try:
+        img = inferenceHelpers.openImage(_uuid, source)
+    except requests.RequestException as e:
+        return Response(f"Could not compute image: {e}"), 502
+    if img is None:
+        return Response("Image not found"), 404
+    
+    tiles = inferenceHelpers.tileCount(img.shape[0], img.shape[1], params["clip_size"], params["overlap"])
+    if tiles > inferenceHelpers.MAX_TILES:
+        return Response(f"{tiles} tiles, at most {inferenceHelpers.MAX_TILES} are run. Use a larger clip_size or a smaller overlap"), 400
+    
+    result = inferenceHelpers.detect(img, **params, stats=inferenceHelpers.imageStats(_uuid, source))
+    
+    return jsonify({
+        "_uuid": _uuid,
+        "source": source,
+        **result
+    }), 200
+
+
+if __name__ == "__main__":
+    inferenceApp.run(debug=DEBUG, port=PORT)
\ No newline at end of file
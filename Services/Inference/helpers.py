@@ -0,0 +1,207 @@
+import os
+import math
+import itertools
+import numpy as np
+from Helpers import common_helpers
+from Helpers import array_access
+from Helpers import band_stats
+from Helpers import render_kernel
+from Helpers import http_client
+from Helpers import catalogue
+from Services.ImageOperations import imageOp
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+MODEL_PATH = os.getenv("inference_model", r"Services\Inference\models\yolov8n.pt")
+DEVICE = os.getenv("inference_device", "cpu")
+# Tiles sent to the model in a single predict call
+BATCH_SIZE = int(os.getenv("inference_batch", 8))
+CLIP_SIZE = int(os.getenv("inference_clip_size", 640))
+CLIP_OVERLAP = float(os.getenv("inference_overlap", 0.2))
+# Tiles a single detect request may run through the model. Small clips or a large overlap on a large image are refused
+MAX_TILES = int(os.getenv("inference_max_tiles", 10000))
+
+UPLOADS_DIR = common_helpers.UPLOADS_DIR
+
+_baseUrl=os.getenv('base_url')
+IMAGEOP_URL = f'{_baseUrl}:{os.getenv("imageOp_port")}'
+del _baseUrl
+# -------------------------------------------------------- #
+
+imageOpClient = http_client.upstream("imageOp", IMAGEOP_URL)
+
+_model = None
+
+def getModel():
+    """Loads the model once on first use"""
+    global _model
+    if _model is None:
+        from ultralytics import YOLO # pyright: ignore[reportPrivateImportUsage]
+        _model = YOLO(MODEL_PATH)
+        _model.to(DEVICE)
+    return _model
+
+
+# Side of the clips sent to the model
+MIN_CLIP_SIZE, MAX_CLIP_SIZE = 32, 4096
+
+def detectParams(body: dict) -> dict:
+    """clip_size, overlap, conf and iou of a detect request, defaults for those not set
+
+    :raises ValueError: Not a number or out of range
+    """
+    try:
+        params = {
+            "clip_size": int(body.get("clip_size", CLIP_SIZE)),
+            "overlap": float(body.get("overlap", CLIP_OVERLAP)),
+            "conf": float(body.get("conf", 0.25)),
+            "iou": float(body.get("iou", 0.5)),
+        }
+    except (TypeError, ValueError):
+        raise ValueError("clip_size should be an integer, overlap, conf and iou numbers")
+
+    if not MIN_CLIP_SIZE <= params["clip_size"] <= MAX_CLIP_SIZE:
+        raise ValueError(f"clip_size should be between {MIN_CLIP_SIZE} ~ {MAX_CLIP_SIZE}")
+    if not 0 <= params["overlap"] < 1:
+        raise ValueError("overlap should be between 0 ~ 1, 1 excluded")
+    if not (0 <= params["conf"] <= 1 and 0 <= params["iou"] <= 1):
+        raise ValueError("conf and iou should be between 0 ~ 1")
+    return params
+
+def tileCount(height: int, width: int, clip_size: int, overlap: float) -> int:
+    """Clips `imageOp.iterClips` cuts an image into, without computing their offsets"""
+    step_size = max(1, int(clip_size * (1 - overlap)))
+    return math.ceil(height / step_size) * math.ceil(width / step_size)
+
+
+def openImage(_uuid: str, source: str = "stack") -> np.ndarray | None:
+    """Returns the lazily read render bands of a stack entry or an upload. None if not found
+
+    :raises requests.RequestException: A pending stack entry could not be computed
+    """
+    if source == "stack":
+        # Stack entries can be lazy, ImageOperations computes them first. Not retried, a timed out call would only queue the same compute again
+        if not common_helpers.stack_npy_exists(_uuid):
+            response = imageOpClient.put("/materialise", params={"_uuid": _uuid}, timeout=600)
+            if response.status_code == 404:
+                return None
+            response.raise_for_status()
+        return common_helpers.open_stack_npy(_uuid, bands=slice(0, 3))  # type: ignore
+
+    npy_file = os.path.join(UPLOADS_DIR, _uuid + ".npy")
+    if not os.path.exists(npy_file):
+        return None
+    return array_access.load_npy(npy_file, bands=slice(0, 3), mmap=True)
+
+
+def imageStats(_uuid: str, source: str = "stack") -> dict | None:
+    """Band stats recorded when the stack entry was written or the upload was read"""
+    if source == "stack":
+        return common_helpers.stack_npy_stats(_uuid)
+
+    record = catalogue.get_upload(_uuid)
+    return record["stats"] if record is not None else None
+
+
+def renderRange(img: np.ndarray, strip_rows: int = 1024) -> tuple[float, float]:
+    """Global min and max so every tile is stretched the same way"""
+    _min, _max = np.inf, -np.inf
+    for r in range(0, img.shape[0], strip_rows):
+        strip = img[r:r + strip_rows]
+        _min = min(_min, float(np.min(strip)))
+        _max = max(_max, float(np.max(strip)))
+    return _min, _max
+
+
+def toModelInput(clip: np.ndarray, _min: float, _max: float) -> np.ndarray:
+    """uint8, 3 band copy of a clip"""
+    clip = render_kernel.to_uint8(clip, _min, _max)
+    if clip.shape[2] < 3:
+        clip = np.repeat(clip[:, :, :1], 3, axis=2)
+    return np.ascontiguousarray(clip[:, :, :3])
+
+
+def nms(boxes: np.ndarray, scores: np.ndarray, classes: np.ndarray, iou_threshold: float) -> np.ndarray:
+    """Class aware greedy non max suppression over all tiles at once. Returns the kept indices.
+
+    Boxes are offset by class so boxes of different classes never overlap.
+
+    :param boxes: (N, 4) boxes as x1, y1, x2, y2
+    :type boxes: np.ndarray
+    """
+    if len(boxes) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    offset = classes.astype(np.float64)[:, None] * (boxes.max() + 1)
+    b = boxes.astype(np.float64) + offset
+    areas = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+
+    order = np.argsort(-scores, kind="stable")
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+
+        xx1 = np.maximum(b[i, 0], b[rest, 0])
+        yy1 = np.maximum(b[i, 1], b[rest, 1])
+        xx2 = np.minimum(b[i, 2], b[rest, 2])
+        yy2 = np.minimum(b[i, 3], b[rest, 3])
+        inter = np.clip(xx2 - xx1, 0, None) * np.clip(yy2 - yy1, 0, None)
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def detect(img: np.ndarray, clip_size: int = CLIP_SIZE, overlap: float = CLIP_OVERLAP, conf: float = 0.25, iou: float = 0.5, stats: dict | None = None) -> dict:
+    """Runs the model tile by tile over the full image and merges detections across tiles.
+
+    Returns boxes in full image pixel coordinates as x1, y1, x2, y2. The stretch is read from stats when given.
+    """
+    model = getModel()
+    height, width = img.shape[:2]
+    _min, _max = band_stats.render_range(stats) or renderRange(img)
+    clips = imageOp.iterClips(img, clip_size, overlap)
+
+    boxes, scores, classes = [], [], []
+    tiles = 0
+    while batch_clips := list(itertools.islice(clips, BATCH_SIZE)):
+        tiles += len(batch_clips)
+        batch = [toModelInput(clip.data, _min, _max) for clip in batch_clips]
+
+        results = model.predict(batch, imgsz=clip_size, conf=conf, iou=iou, device=DEVICE, verbose=False)
+        for (y, x, _, _), result in zip(batch_clips, results):
+            result_boxes = result.boxes.cpu().numpy()
+            boxes.append(result_boxes.xyxy + np.array([x, y, x, y], dtype=np.float32))
+            scores.append(result_boxes.conf)
+            classes.append(result_boxes.cls.astype(np.int64))
+
+    boxes = np.concatenate(boxes) if boxes else np.empty((0, 4), dtype=np.float32)
+    scores = np.concatenate(scores) if scores else np.empty(0, dtype=np.float32)
+    classes = np.concatenate(classes) if classes else np.empty(0, dtype=np.int64)
+
+    # Padding of border tiles lies outside the image
+    np.clip(boxes, 0, [width, height, width, height], out=boxes)
+
+    keep = nms(boxes, scores, classes, iou)
+    boxes, scores, classes = boxes[keep], scores[keep], classes[keep]
+
+    names = model.names
+    return {
+        "width": width,
+        "height": height,
+        "tiles": tiles,
+        "count": len(keep),
+        "detections": [
+            {
+                "box": [round(float(v), 2) for v in box],
+                "conf": round(float(score), 4),
+                "class_id": int(cls),
+                "name": names[int(cls)],
+            }
+            for box, score, cls in zip(boxes, scores, classes)
+        ]
+    }
@@ -1,7 +1,10 @@
 from dotenv import load_dotenv
 print("Load ENV:", load_dotenv())
 
-from flask import Flask
+from flask import Flask, Response, jsonify, request
+from Services.ShapeOperations import helpers as shapeOpHelpers
+from Helpers import common_helpers
+import numpy as np
 import os
 
 shapeOpApp = Flask("Shape Operations App")
@@ -17,5 +20,108 @@ DEBUG = bool(os.getenv("DEBUG", 0))
 
 # -------------------------------------------------------- #
 
+def parseBBox(bbox: str) -> tuple[float, float, float, float]:
+    minx, miny, maxx, maxy = map(float, bbox.split(","))
+    return minx, miny, maxx, maxy
 
-shapeOpApp.run(port=PORT, debug=DEBUG)
\ No newline at end of file
+
+@shapeOpApp.get("/health")
+def health():
+    return {"status": "OK"}, 200
+
+@shapeOpApp.get("/layers")
+def listLayers():
+    return jsonify([layer.info for layer in shapeOpHelpers.layers.values()]), 200
+
+@shapeOpApp.put("/layers")
+def loadLayer():
+    """Loads a vector file once and indexes it. Params: name, file"""
+    try:
+        name, file = common_helpers.get_requestArgs("name", "file")
+    except ValueError as e:
+        return Response(str(e)), 400
+    
+    try:
+        layer = shapeOpHelpers.loadLayer(name, file)
+    except FileNotFoundError:
+        return Response("Layer file not found"), 404
+    
+    return jsonify(layer.info), 200
+
+@shapeOpApp.get("/layers/<name>/query")
+def queryLayer(name: str):
+    """Features whose bounds intersect a bbox. Params: bbox=minx,miny,maxx,maxy, limit, fields=a,b, geometry=1"""
+    layer = shapeOpHelpers.getLayer(name)
+    if layer is None:
+        return Response("Layer not loaded"), 404
+    
+    try:
+        bbox = parseBBox(common_helpers.get_requestArgs("bbox")[0])
+    except ValueError:
+        return Response("bbox should be minx,miny,maxx,maxy"), 400
+    
+    limit = int(request.args.get("limit", 1000))
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else None
+    geometry = request.args.get("geometry", "0") == "1"
+    
+    ids = layer.queryBBox(bbox)
+    return jsonify({
+        "count": len(ids),
+        "features": [layer.feature(i, fields, geometry) for i in ids[:limit]]
+    }), 200
+
+@shapeOpApp.get("/layers/<name>/point")
+def queryPoint(name: str):
+    """Features under a point. Params: x, y, fields=a,b, geometry=1"""
+    layer = shapeOpHelpers.getLayer(name)
+    if layer is None:
+        return Response("Layer not loaded"), 404
+    
+    try:
+        x, y = map(float, common_helpers.get_requestArgs("x", "y"))
+    except ValueError:
+        return Response("x and y are required numbers"), 400
+    
+    fields = request.args.get("fields")
+    fields = fields.split(",") if fields else None
+    geometry = request.args.get("geometry", "0") == "1"
+    
+    ids = layer.queryPoint(x, y)
+    return jsonify({
+        "count": len(ids),
+        "features": [layer.feature(i, fields, geometry) for i in ids]
+    }), 200
+
+@shapeOpApp.post("/layers/<name>/join")
+def joinLayer(name: str):
+    """Attributes of the layer under each detection, answered from the index.
+    
+    Body: {"boxes": [[minx, miny, maxx, maxy], ...], "predicate": "bbox" | "center", "fields": [str]}
+    Boxes are in the layer CRS.
+    """
+    layer = shapeOpHelpers.getLayer(name)
+    if layer is None:
+        return Response("Layer not loaded"), 404
+    
+    body = request.get_json(silent=True) or {}
+    predicate = body.get("predicate", "bbox")
+    if predicate not in ("bbox", "center"):
+        return Response("predicate should be bbox or center"), 400
+    try:
+        boxes = np.asarray(body.get("boxes", []), dtype=np.float64).reshape(-1, 4)
+    except ValueError:
+        return Response("boxes should be a list of [minx, miny, maxx, maxy]"), 400
+    
+    fields = body.get("fields")
+    matches = layer.join(boxes, predicate)
+    return jsonify({
+        "count": len(boxes),
+        "matches": [[layer.feature(i, fields)["properties"] | {"id": int(i)} for i in ids] for ids in matches]
+    }), 200
+
+
+shapeOpHelpers.loadEnvLayers()
+
+if __name__ == "__main__":
+    shapeOpApp.run(port=PORT, debug=DEBUG)
\ No newline at end of file
@@ -0,0 +1,157 @@
+import os
+import time
+import threading
+import fiona
+import numpy as np
+from Services.ShapeOperations.spatialIndex import STRIndex
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Layers loaded when the service starts. Comma separated `name=path/to/file.shp`
+SHAPE_LAYERS = os.getenv("shape_layers", "")
+# -------------------------------------------------------- #
+
+# Never intersects any query
+_EMPTY_BOUNDS = (np.inf, np.inf, -np.inf, -np.inf)
+
+
+class Layer:
+    """A vector layer held in memory with a packed spatial index over its feature bounds.
+    ---
+    Features are read once. Queries only touch the index and the features it returns.
+
+    :param name: Name the layer is queried by
+    :type name: str
+    :param file: Any vector file fiona can open
+    :type file: str
+    """
+    def __init__(self, name: str, file: str):
+        self.name = name
+        self.file = file
+
+        start = time.time()
+        self.properties: list[dict] = []
+        self.geometries: list[dict | None] = []
+        bounds = []
+        with fiona.open(file) as shape:
+            self.profile = shape.profile
+            for feature in shape:
+                geometry = feature['geometry']
+                self.properties.append(dict(feature['properties']))
+                if geometry is None:
+                    self.geometries.append(None)
+                    bounds.append(_EMPTY_BOUNDS)
+                    continue
+                self.geometries.append({'type': geometry['type'], 'coordinates': geometry['coordinates']})
+                bounds.append(fiona.bounds(geometry))
+
+        self.index = STRIndex(np.asarray(bounds, dtype=np.float64).reshape(-1, 4))
+        self.load_time = time.time() - start
+        print(f"Loaded layer {name} with {len(self.index)} features in {self.load_time:.2f}s")
+
+    @property
+    def info(self) -> dict:
+        return {
+            "name": self.name,
+            "file": self.file,
+            "count": len(self.index),
+            "bounds": self.index.bounds,
+            "geometry": self.profile['schema']['geometry'],
+            "fields": list(self.profile['schema']['properties']),
+            "load_time": round(self.load_time, 3),
+        }
+
+    def feature(self, i: int, fields: list[str] | None = None, geometry: bool = False) -> dict:
+        properties = self.properties[i]
+        if fields:
+            properties = {field: properties.get(field) for field in fields}
+
+        feature = {"id": int(i), "properties": properties}
+        if geometry:
+            feature["geometry"] = self.geometries[i]
+        return feature
+
+    def queryBBox(self, bbox: tuple[float, float, float, float]) -> np.ndarray:
+        """Ids of features whose bounds intersect the bbox"""
+        return self.index.query(bbox)
+
+    def queryPoint(self, x: float, y: float) -> np.ndarray:
+        """Ids of features under a point. Polygons are tested exactly, other geometries by their bounds"""
+        candidates = self.index.query((x, y, x, y))
+        return np.array([i for i in candidates if contains(self.geometries[i], x, y)], dtype=np.int64)
+
+    def join(self, boxes: np.ndarray, predicate: str = "bbox") -> list[np.ndarray]:
+        """Bulk lookup of the features under each box in a single index pass.
+
+        :param boxes: (N, 4) boxes as minx, miny, maxx, maxy in the layer CRS
+        :type boxes: np.ndarray
+        :param predicate: `bbox` matches features whose bounds intersect the box. `center` matches features under the box center
+        :type predicate: str
+        :return: Feature ids per box
+        """
+        assert predicate in ("bbox", "center"), "Predicate should be bbox or center"
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        if predicate == "center":
+            centers = np.column_stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2])
+            boxes = np.hstack([centers, centers])
+
+        q, ids = self.index.queryMany(boxes)
+        if predicate == "center":
+            keep = np.array([contains(self.geometries[i], *boxes[j, :2]) for j, i in zip(q, ids)], dtype=bool)
+            q, ids = q[keep], ids[keep]
+
+        # Pairs are grouped by box
+        splits = np.searchsorted(q, np.arange(1, len(boxes)))
+        return np.split(ids, splits)
+
+
+def _ringsContain(rings: list, x: float, y: float) -> bool:
+    """Even odd ray casting over all rings, holes included"""
+    inside = False
+    for ring in rings:
+        ring = np.asarray(ring, dtype=np.float64)[:, :2]
+        x1, y1 = ring[:-1].T
+        x2, y2 = ring[1:].T
+        with np.errstate(divide='ignore', invalid='ignore'):
+            crosses = ((y1 > y) != (y2 > y)) & (x < (x2 - x1) * (y - y1) / (y2 - y1) + x1)
+        inside ^= bool(np.count_nonzero(crosses) % 2)
+    return inside
+
+
+def contains(geometry: dict | None, x: float, y: float) -> bool:
+    """Whether the point lies inside a polygon. Geometries without an area match on their bounds"""
+    if geometry is None:
+        return False
+    if geometry['type'] == 'Polygon':
+        return _ringsContain(geometry['coordinates'], x, y)
+    if geometry['type'] == 'MultiPolygon':
+        return any(_ringsContain(polygon, x, y) for polygon in geometry['coordinates'])
+    return True
+
+
+# ====================== Layers ====================== #
+
+layers: dict[str, Layer] = {}
+_layers_lock = threading.Lock()
+
+def loadLayer(name: str, file: str) -> Layer:
+    """Loads (or reloads) a layer and builds its index. Queries keep using the old layer until it is replaced"""
+    if not os.path.exists(file):
+        raise FileNotFoundError(file)
+    layer = Layer(name, file)
+    with _layers_lock:
+        layers[name] = layer
+    return layer
+
+def getLayer(name: str) -> Layer | None:
+    return layers.get(name)
+
+def loadEnvLayers():
+    for entry in filter(None, SHAPE_LAYERS.split(",")):
+        name, file = entry.split("=", 1)
+        try:
+            loadLayer(name.strip(), file.strip())
+        except Exception as e:
+            print(f"Error loading layer {name}", e)
@@ -4,8 +4,12 @@ import fiona
 from fiona.collection import Collection as FionaFile
 from affine import Affine
 import numpy as np
+from typing import Iterator, NamedTuple
 from ultralytics.engine.results import Boxes as uResultBoxes
 
+# Pixel corner used for each offset, as (row, col) added to the pixel index. Same as rasterio.transform.xy
+_OFFSETS = {'ul': (0, 0), 'ur': (0, 1), 'll': (1, 0), 'lr': (1, 1)}
+
 
 # type GEOJSON = dict # type: ignore
 def boxTensorTo_xywh(box: uResultBoxes) -> tuple[int, int, int, int]:
@@ -15,6 +19,18 @@ def boxTensorTo_xywh(box: uResultBoxes) -> tuple[int, int, int, int]:
     ytl = int(np.round(max(0, y-h/2)))
     
     return ytl, xtl, int(h), int(w)
+
+def boxesTo_yxhw(xywh: np.ndarray) -> np.ndarray:
+    """Batch `boxTensorTo_xywh`. Converts (N, 4) center x, y, width, height boxes to (N, 4) int y, x, height, width of the TL corner"""
+    xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
+    x, y, w, h = xywh.T
+    
+    yxhw = np.empty((len(xywh), 4), dtype=np.int64)
+    yxhw[:, 0] = np.round(np.maximum(0, y - h / 2))
+    yxhw[:, 1] = np.round(np.maximum(0, x - w / 2))
+    yxhw[:, 2] = h      # Truncated like int()
+    yxhw[:, 3] = w
+    return yxhw
     
 
 def makeBoxFeature(y: int, x: int, height: int, width: int, crs: rioCRS.CRS, transform: Affine, properties: dict={}, offset: str='ul') -> dict:
@@ -61,6 +77,87 @@ def makeBoxFeature(y: int, x: int, height: int, width: int, crs: rioCRS.CRS, tra
     
     return feature
 
+class BoxFeatures(NamedTuple):
+    """Box polygons of a whole scene kept as arrays instead of a list of GEOJSON dicts"""
+    coords: np.ndarray                  # (N, 5, 2) closed ring of x, y map coordinates per box
+    properties: dict[str, np.ndarray]   # property name -> (N,) values
+    
+    def __len__(self):
+        return len(self.coords)
+    
+    def records(self) -> Iterator[dict]:
+        """GEOJSON features, built one at a time while writing"""
+        coords = self.coords.tolist()
+        properties = {name: np.asarray(values).tolist() for name, values in self.properties.items()}
+        for i, ring in enumerate(coords):
+            feature = {
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[tuple(point) for point in ring]]
+                },
+            }
+            if properties:
+                feature['properties'] = {name: values[i] for name, values in properties.items()}
+            yield feature
+
+def makeBoxFeatures(boxes: np.ndarray, transform: Affine, properties: dict[str, np.ndarray] = {}, offset: str='ul') -> BoxFeatures:
+    """
+    Batch `makeBoxFeature`. Maps all box corners to map coordinates in a single affine multiply.
+    
+    :param boxes: (N, 4) boxes as y, x, height, width in pixels. See `boxesTo_yxhw`
+    :type boxes: np.ndarray
+    :param transform: Transform from raster
+    :type transform: Affine
+    :param properties: property name -> (N,) values
+    :type properties: dict[str, np.ndarray]
+    """
+    assert offset in _OFFSETS
+    boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+    row_off, col_off = _OFFSETS[offset]
+    
+    rows = np.stack([boxes[:, 0], boxes[:, 0] + boxes[:, 2]], axis=1) + row_off      # (N, 2) top, bottom
+    cols = np.stack([boxes[:, 1], boxes[:, 1] + boxes[:, 3]], axis=1) + col_off      # (N, 2) left, right
+    
+    # Same ring order as makeBoxFeature: tl, tr, br, bl, tl
+    ring_rows = rows[:, [0, 0, 1, 1, 0]]
+    ring_cols = cols[:, [0, 1, 1, 0, 0]]
+    
+    a, b, c, d, e, f = transform.a, transform.b, transform.c, transform.d, transform.e, transform.f
+    coords = np.empty(ring_rows.shape + (2,), dtype=np.float64)
+    coords[..., 0] = a * ring_cols + b * ring_rows + c
+    coords[..., 1] = d * ring_cols + e * ring_rows + f
+    
+    return BoxFeatures(coords, dict(properties))
+
+def writeBoxFeatures(features: BoxFeatures, crs: rioCRS.CRS, outFile: str, schema_properties: dict={}):
+    """
+    Batch `makeShapeFile`. Writes all box features with a single bulk write
+    
+    :param features: Output of `makeBoxFeatures`
+    :type features: BoxFeatures
+    :param crs: CRS from raster
+    :type crs: rioCRS.CRS
+    :param outFile: Shape file path
+    :type outFile: str
+    :param schema_properties: Fiona schema of the properties
+    :type schema_properties: dict
+    """
+    schema = {
+        'geometry': 'Polygon',
+    }
+    
+    if schema_properties:
+        schema['properties'] = schema_properties
+    
+    profile = {
+        'driver': 'ESRI Shapefile',
+        'crs': crs,
+        'schema': schema
+    }
+    
+    with fiona.open(outFile, 'w', **profile) as out:
+        out.writerecords(features.records())
+
 def makeShapeFile(*features:dict, crs: rioCRS.CRS, outFile: str, schema_properties: dict={}):
     """
     Builds a shape file from the features
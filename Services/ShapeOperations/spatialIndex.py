@@ -0,0 +1,139 @@
+import os
+import math
+import numpy as np
+
+# ------------------ Load ENV Variables ------------------ #
+import dotenv
+# dotenv.load_dotenv()      -> Should Ideally be loaded via app.py
+
+# Children per node of the packed tree
+SPATIAL_NODE_CAPACITY = int(os.getenv("spatial_node_capacity", 16))
+# -------------------------------------------------------- #
+
+
+def _strOrder(bounds: np.ndarray, capacity: int) -> np.ndarray:
+    """Sort Tile Recursive order of boxes. Sorted by center x into vertical slices, each slice sorted by center y"""
+    n = len(bounds)
+    # Empty bounds (inf, -inf) have nan centers and are sorted last
+    with np.errstate(invalid='ignore'):
+        cx = (bounds[:, 0] + bounds[:, 2]) / 2
+        cy = (bounds[:, 1] + bounds[:, 3]) / 2
+
+    slices = max(1, math.ceil(math.sqrt(n / capacity)))
+    slice_len = slices * capacity
+
+    by_x = np.argsort(cx, kind="stable")
+    slice_id = np.empty(n, dtype=np.int64)
+    slice_id[by_x] = np.arange(n) // slice_len
+    # Slice first, then y within the slice
+    return np.lexsort((cy, slice_id))
+
+
+def _intersects(bounds: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """Row wise bbox intersection of two (N, 4) arrays as minx, miny, maxx, maxy"""
+    return (
+        (bounds[:, 0] <= boxes[:, 2]) & (bounds[:, 2] >= boxes[:, 0]) &
+        (bounds[:, 1] <= boxes[:, 3]) & (bounds[:, 3] >= boxes[:, 1])
+    )
+
+
+def _expand(starts: np.ndarray, counts: np.ndarray) -> np.ndarray:
+    """Concatenation of `arange(start, start + count)` for each pair, without a python loop"""
+    total = int(counts.sum())
+    if total == 0:
+        return np.empty(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + np.arange(total) - offsets
+
+
+class STRIndex:
+    """Static R-tree packed with Sort Tile Recursive, stored as flat numpy arrays.
+    ---
+    1. Items are sorted in STR order and grouped `capacity` at a time into leaf nodes. Nodes are packed the same way level by level up to a single root.
+    2. Children of a node are contiguous in the level below, a node only keeps the start and count of its children.
+    3. Queries descend all levels at once for every query box, so a bulk query is a few vectorised steps per level.
+
+    :param bounds: (N, 4) item bounds as minx, miny, maxx, maxy
+    :type bounds: np.ndarray
+    :param capacity: Children per node
+    :type capacity: int
+    """
+    def __init__(self, bounds: np.ndarray, capacity: int = SPATIAL_NODE_CAPACITY):
+        assert capacity >= 2, "Node capacity should be at least 2"
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        self.capacity = capacity
+
+        # Item ids in leaf order
+        self.order = _strOrder(bounds, capacity) if len(bounds) else np.empty(0, dtype=np.int64)
+        self.item_bounds = bounds[self.order]
+
+        # levels[0] is the leaf level, levels[-1] the root. Each level: (bounds, child start, child count)
+        self.levels: list[tuple[np.ndarray, np.ndarray, np.ndarray]] = []
+        level_bounds = self.item_bounds
+        while len(level_bounds):
+            level_bounds = self.__packLevel(level_bounds)
+            if len(level_bounds) == 1:
+                break
+
+    def __packLevel(self, child_bounds: np.ndarray) -> np.ndarray:
+        """Groups a level of children into parent nodes and returns the parent bounds"""
+        n = len(child_bounds)
+        starts = np.arange(0, n, self.capacity)
+        counts = np.minimum(self.capacity, n - starts)
+        node_bounds = np.empty((len(starts), 4), dtype=np.float64)
+        node_bounds[:, :2] = np.minimum.reduceat(child_bounds[:, :2], starts, axis=0)
+        node_bounds[:, 2:] = np.maximum.reduceat(child_bounds[:, 2:], starts, axis=0)
+
+        # STR order of the parents for the next level. Children stay where they are, only the pointers move
+        if len(starts) > 1:
+            order = _strOrder(node_bounds, self.capacity)
+            node_bounds, starts, counts = node_bounds[order], starts[order], counts[order]
+
+        self.levels.append((node_bounds, starts, counts))
+        return node_bounds
+
+    def __len__(self):
+        return len(self.order)
+
+    @property
+    def bounds(self) -> tuple[float, float, float, float] | None:
+        if not len(self.order):
+            return None
+        root_bounds = self.levels[-1][0]
+        return tuple(float(v) for v in (root_bounds[:, 0].min(), root_bounds[:, 1].min(), root_bounds[:, 2].max(), root_bounds[:, 3].max()))  # type: ignore
+
+    def queryMany(self, boxes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Bulk bbox query.
+
+        :param boxes: (Q, 4) query boxes as minx, miny, maxx, maxy. A point is a box with min == max
+        :type boxes: np.ndarray
+        :return: (query index, item id) pairs of every intersecting item, grouped by query
+        """
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        empty = np.empty(0, dtype=np.int64)
+        if not len(self.order) or not len(boxes):
+            return empty, empty
+
+        # Frontier of (query, node) pairs, starting with every root node for every query
+        root_bounds = self.levels[-1][0]
+        q = np.repeat(np.arange(len(boxes)), len(root_bounds))
+        node = np.tile(np.arange(len(root_bounds)), len(boxes))
+
+        for depth in range(len(self.levels) - 1, -1, -1):
+            node_bounds, starts, counts = self.levels[depth]
+            hit = _intersects(node_bounds[node], boxes[q])
+            q, node = q[hit], node[hit]
+            # Children are nodes of the level below, or items at the leaf level
+            node_counts = counts[node]
+            q = np.repeat(q, node_counts)
+            node = _expand(starts[node], node_counts)
+
+        hit = _intersects(self.item_bounds[node], boxes[q])
+        q, item = q[hit], self.order[node[hit]]
+
+        group = np.lexsort((item, q))
+        return q[group], item[group]
+
+    def query(self, box: tuple[float, float, float, float]) -> np.ndarray:
+        """Ids of items intersecting a single bbox"""
+        return self.queryMany(np.asarray([box]))[1]
@@ -41,27 +41,25 @@ def modelPredict(images:list[np.ndarray]) -> list[uResults]:
 
 def makeShapeFiles(inference: list[uResults], raster_prop: list[dict], files: list[str], schema_properties: dict = {}):
     names = inference[0].names
+    name_lut = np.array([names[i] for i in range(len(names))])
     for i, result in enumerate(inference):
-        features = []
         r_prop = raster_prop[i]
         
         raster_crs = r_prop['crs']
         raster_transform = r_prop['transform']
         filename = files[i] + '.shp'
         
-        for box in result.boxes:
-            box = box.cpu().numpy()
-            y, x, height, width = shapeOp.boxTensorTo_xywh(box)
-            properties = {
-            'id': int(box.cls[0]),
-            'conf': box.conf[0],
-            }
-            
-            properties['name'] = names[properties['id']]
-            
-            feature = shapeOp.makeBoxFeature(y, x, height, width, raster_crs, raster_transform, properties=properties)
-            features.append(feature)
-        shapeOp.makeShapeFile(*features, outFile=filename, crs=raster_crs, schema_properties=schema_properties)
+        # All boxes of a result moved to numpy at once
+        boxes = result.boxes.cpu().numpy()
+        classes = boxes.cls.astype(np.int64)
+        properties = {
+            'id': classes,
+            'conf': boxes.conf,
+            'name': name_lut[classes],
+        }
+        
+        features = shapeOp.makeBoxFeatures(shapeOp.boxesTo_yxhw(boxes.xywh), raster_transform, properties=properties)
+        shapeOp.writeBoxFeatures(features, outFile=filename, crs=raster_crs, schema_properties=schema_properties)
     
     
 def main():
@@ -0,0 +1,17 @@
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+# Services read their directories and ports when imported. Tests run against a throwaway stack and shared memory dir
+_DATA_DIR = tempfile.mkdtemp(prefix="image-processing-tests-")
+atexit.register(shutil.rmtree, _DATA_DIR, ignore_errors=True)
+os.environ["uploads_dir"] = os.path.join(_DATA_DIR, "Uploads")
+os.environ["stack_dir"] = os.path.join(_DATA_DIR, "Stack")
+os.environ["shm_dir"] = os.path.join(_DATA_DIR, "shm")
+os.environ.setdefault("base_url", "http://127.0.0.1")
+os.environ.setdefault("backend_port", "8000")
+os.environ.setdefault("imageOp_port", "8002")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,76 @@
+import threading
+import numpy as np
+import pytest
+import requests
+
+pytest.importorskip("rasterio")
+
+from Helpers import common_helpers
+from Helpers.StackManager import sessions
+import Services.Backend.app as backendApp
+
+
+@pytest.fixture
+def session_id():
+    session_id = common_helpers.generate_uuid()
+    with sessions.session(session_id) as stackManager:
+        stackManager.addImage("pending")
+    return session_id
+
+@pytest.fixture
+def client(session_id):
+    client = backendApp.backendApp.test_client()
+    client.environ_base["HTTP_X_SESSION_ID"] = common_helpers.sign_session(session_id)
+    return client
+
+
+def test_pending_image_computed_without_session_lock(client, session_id, monkeypatch):
+    computed: list[str] = []
+
+    def materialise(npy_id: str):
+        # Another request of the session gets through while the image is computed
+        def useSession():
+            with sessions.session(session_id):
+                computed.append(npy_id)
+        other = threading.Thread(target=useSession)
+        other.start()
+        other.join(5)
+        assert not other.is_alive(), "Session held while the image is computed"
+        raise requests.HTTPError("500 Server Error")
+
+    monkeypatch.setattr(backendApp.backendHelpers, "materialise", materialise)
+
+    response = client.get("/image/tiles/info")
+
+    assert response.status_code == 502
+    assert computed == ["pending.npy"]
+
+def test_unavailable_image_service_is_502(client, monkeypatch):
+    calls: list[str] = []
+
+    def materialise(npy_id: str):
+        calls.append(npy_id)
+        raise requests.ReadTimeout("read timed out")
+
+    monkeypatch.setattr(backendApp.backendHelpers, "materialise", materialise)
+
+    assert client.get("/image").status_code == 502
+    assert client.get("/image/current").status_code == 502
+    assert client.get("/image/tiles/0/0/0").status_code == 502
+    assert calls == ["pending.npy"] * 3
+
+def test_session_renders_not_shared(client, session_id):
+    npy_id = common_helpers.generate_uuid()
+    common_helpers.save_stack_npy(npy_id, np.arange(64 * 48 * 3, dtype=np.uint16).reshape(64, 48, 3))
+    with sessions.session(session_id) as stackManager:
+        stackManager.addImage(npy_id)
+
+    redirect = client.get("/image")
+    assert redirect.status_code == 303
+    render = client.get(redirect.headers["Location"])
+    tile = client.get(f"/image/tiles/0/0/0?npy_id={npy_id}.npy")
+
+    for response in (render, tile):
+        assert response.status_code == 200
+        assert response.cache_control.private and not response.cache_control.public
+        assert response.cache_control.immutable
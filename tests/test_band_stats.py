@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from Helpers import band_stats, common_helpers
+from Helpers.band_stats import BandStats, STATS_HIST_BINS
+
+
+def image(dtype, low: float, high: float, shape=(97, 61, 3), seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.uniform(low, high, size=shape).astype(dtype)
+
+def streamed(npy: np.ndarray, rows: int, nodata: float | None = None) -> dict:
+    stats = BandStats(npy.shape, npy.dtype, nodata)
+    for r in range(0, npy.shape[0], rows):
+        stats.update(npy[r:r + rows])
+    return stats.to_dict()
+
+
+@pytest.mark.parametrize("dtype, low, high", [
+    (np.uint8, 0, 255),
+    (np.int16, -30000, 30000),
+    (np.uint32, 0, 2**32 - 1),
+    (np.float32, -5, 5),
+])
+def test_streamed_stats_match_whole_image(dtype, low, high):
+    npy = image(dtype, low, high)
+
+    stats = streamed(npy, rows=10)
+
+    assert stats["bands"] == 3
+    assert stats["min"] == np.min(npy, axis=(0, 1)).astype(np.float64).tolist()
+    assert stats["max"] == np.max(npy, axis=(0, 1)).astype(np.float64).tolist()
+    assert np.allclose(stats["mean"], np.mean(npy, axis=(0, 1), dtype=np.float64))
+    assert stats["count"] == [npy.shape[0] * npy.shape[1]] * 3
+    assert stats == streamed(npy, rows=npy.shape[0])
+
+def test_exact_histogram_for_16_bit():
+    npy = image(np.uint16, 0, 65535)
+
+    stats = streamed(npy, rows=7)
+
+    assert stats["hist_exact"] and stats["hist_range"][0] == [0, 65536]
+    for b in range(3):
+        expected = np.histogram(npy[:, :, b], bins=STATS_HIST_BINS, range=(0, 65536))[0]
+        assert stats["hist"][b] == expected.tolist()
+
+def test_sampled_histogram_for_floats(monkeypatch):
+    monkeypatch.setattr(band_stats, "STATS_SAMPLE_PX", 1000)
+    npy = image(np.float64, 0, 1, shape=(200, 150, 1))
+
+    stats = streamed(npy, rows=33)
+
+    assert not stats["hist_exact"]
+    assert stats["hist_range"][0] == [stats["min"][0], stats["max"][0]]
+    # Counts of the sample scaled back to the full image
+    assert abs(sum(stats["hist"][0]) - npy.size) <= 0.1 * npy.size
+
+def test_blocks_with_offsets_match_strips():
+    npy = image(np.float32, 0, 100, shape=(64, 48, 2))
+    stats = BandStats(npy.shape, npy.dtype)
+    for y in range(0, 64, 16):
+        for x in range(0, 48, 24):
+            stats.update(npy[y:y + 16, x:x + 24], offset=(y, x))
+
+    blocks = stats.to_dict()
+    strips = streamed(npy, rows=64)
+    assert {k: v for k, v in blocks.items() if k != "hist"} == {k: v for k, v in strips.items() if k != "hist"}
+
+def test_nan_and_nodata():
+    npy = image(np.float32, 1, 2, shape=(20, 10, 2))
+    npy[:5, :, 0] = np.nan
+    npy[5:7, :, 0] = 0
+    npy[:, :, 1] = np.nan
+
+    stats = streamed(npy, rows=3, nodata=0)
+
+    assert stats["nodata"] == [70, 200]
+    assert stats["count"] == [150, 0]
+    assert stats["min"][0] == 0 and np.isnan(stats["min"][1]) and np.isnan(stats["mean"][1])
+    assert band_stats.render_range(stats) == (0, float(np.nanmax(npy)))
+    assert band_stats.render_range(None) is None
+
+def test_recorded_on_stack_writes():
+    npy = image(np.int16, -500, 500)
+    npy_id = common_helpers.generate_uuid()
+    common_helpers.save_stack_npy(npy_id, npy)
+
+    assert common_helpers.stack_npy_stats(npy_id) == band_stats.compute_stats(npy)
+    assert common_helpers.stack_npy_stats(common_helpers.generate_uuid()) is None
@@ -0,0 +1,113 @@
+import os
+import pickle
+import threading
+import types
+import numpy as np
+import pytest
+
+from Helpers import catalogue
+
+
+@pytest.fixture(autouse=True)
+def db(tmp_path, monkeypatch):
+    """Empty catalogue per test. Connections of the previous database are dropped"""
+    monkeypatch.setattr(catalogue, "UPLOADS_DIR", str(tmp_path))
+    monkeypatch.setattr(catalogue, "CATALOGUE_DB", str(tmp_path / "catalogue.sqlite3"))
+    monkeypatch.setattr(catalogue, "_initialised", None)
+    monkeypatch.setattr(catalogue, "_local", threading.local())
+    return tmp_path
+
+
+def test_upload_meta_round_trip():
+    stats = {"bands": 1, "min": [0.0], "max": [255.0]}
+    catalogue.add_upload("a", "Scene.tif")
+
+    catalogue.set_upload_meta("a", "Scene.tif", dtype="|u1", height=10, width=20, bands=1, crs="EPSG:4326", stats=stats)
+
+    upload = catalogue.get_upload("a")
+    assert {k: upload[k] for k in ("filename", "ext", "dtype", "height", "width", "bands", "crs", "stats")} == {
+        "filename": "Scene.tif", "ext": ".tif", "dtype": "|u1", "height": 10, "width": 20, "bands": 1, "crs": "EPSG:4326", "stats": stats
+    }
+    assert catalogue.get_upload("missing") is None
+    with pytest.raises(ValueError):
+        catalogue.set_upload_meta("a", "Scene.tif", path="/etc")
+
+def test_meta_before_add_keeps_meta():
+    # The file is read before Frontend records the upload
+    catalogue.set_upload_meta("a", "a.png", height=5)
+    catalogue.add_upload("a", "a.png")
+
+    assert catalogue.get_upload("a")["height"] == 5
+    assert catalogue.list_uploads()[1] == 1
+
+def test_list_pages_and_sorts(monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(catalogue.time, "time", lambda: float(next(clock)))
+    for _uuid, filename in (("1", "b.tif"), ("2", "A.png"), ("3", "c.jpg"), ("4", "a.tif")):
+        catalogue.add_upload(_uuid, filename)
+    catalogue.set_upload_meta("1", "b.tif", stats={"bands": 1})
+
+    def uuids(**kwargs):
+        uploads, total = catalogue.list_uploads(**kwargs)
+        assert total == 4 and all("stats" not in upload for upload in uploads)
+        return [upload["uuid"] for upload in uploads]
+
+    assert uuids() == ["1", "2", "3", "4"]
+    assert uuids(descending=True) == ["4", "3", "2", "1"]
+    assert uuids(sort="filename") == ["2", "4", "1", "3"]
+    assert uuids(offset=1, limit=2) == ["2", "3"]
+    assert uuids(offset=3, limit=5) == ["4"]
+    with pytest.raises(ValueError):
+        catalogue.list_uploads(sort="uuid")
+
+def test_remove_upload():
+    catalogue.add_upload("a", "a.tif")
+
+    assert catalogue.remove_upload("a")
+    assert not catalogue.remove_upload("a")
+    assert catalogue.get_upload("a") is None
+
+def test_concurrent_uploads_are_all_recorded():
+    def upload(worker: int):
+        for i in range(25):
+            catalogue.add_upload(f"{worker}-{i}", f"{worker}-{i}.tif")
+
+    threads = [threading.Thread(target=upload, args=(worker,)) for worker in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert catalogue.list_uploads(limit=0) == ([], 200)
+
+def test_stack_entries_follow_the_stack(monkeypatch):
+    clock = iter(range(100))
+    monkeypatch.setattr(catalogue.time, "time", lambda: float(next(clock)))
+    catalogue.set_stack_entries("s1", ["a.npy", "b.npy"], "up1")
+    catalogue.set_stack_entries("s2", ["x.npy"], "up2")
+
+    catalogue.set_stack_entries("s1", ["a.npy", "c.npy"], "up1")
+
+    entries = catalogue.stack_entries("s1")
+    assert [(e["npy_id"], e["position"]) for e in entries] == [("a.npy", 0), ("c.npy", 1)]
+    # Kept entries keep their creation time
+    assert [e["created"] for e in entries] == [0, 2]
+    assert [e["npy_id"] for e in catalogue.stack_entries(parent_uuid="up2")] == ["x.npy"]
+    catalogue.set_stack_entries("s1", [], None)
+    assert catalogue.stack_entries("s1") == [] and len(catalogue.stack_entries()) == 1
+
+def test_older_pickles_imported_once(db):
+    mapping = {"old1": "first.tif", "old2": "second.png"}
+    with open(db / "mapping.pkl", "wb") as f:
+        pickle.dump(mapping, f)
+    with open(db / "old1.pkl", "wb") as f:
+        pickle.dump(types.SimpleNamespace(band_stats={"bands": 2}), f)
+    np.save(db / "old1.npy", np.zeros((6, 4, 2), dtype=np.uint16))
+
+    uploads, total = catalogue.list_uploads()
+
+    assert total == 2 and [u["filename"] for u in uploads] == ["first.tif", "second.png"]
+    old1 = catalogue.get_upload("old1")
+    assert (old1["dtype"], old1["height"], old1["width"], old1["bands"], old1["stats"]) == ("<u2", 6, 4, 2, {"bands": 2})
+    assert catalogue.get_upload("old2")["dtype"] is None
+    assert not os.path.exists(db / "mapping.pkl") and os.path.exists(db / "mapping.pkl.imported")
@@ -0,0 +1,110 @@
+import os
+import numpy as np
+import pytest
+
+from Helpers.ChunkStore import chunkStore
+from Helpers.ChunkStore.chunkStore import ChunkStore, PENDING_EXT
+
+
+@pytest.fixture
+def store(tmp_path):
+    return ChunkStore(str(tmp_path), chunk_size=16)
+
+def image(shape=(70, 45, 3), dtype=np.uint16, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 1000, size=shape).astype(dtype)
+
+def chunk_files(store: ChunkStore) -> set[str]:
+    if not os.path.exists(store.chunk_dir):
+        return set()
+    return {f for prefix in os.listdir(store.chunk_dir) for f in os.listdir(os.path.join(store.chunk_dir, prefix))}
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.int16, np.float32, np.float64])
+def test_round_trip(store, dtype):
+    npy = image(dtype=dtype)
+    store.save("a.npy", npy)
+
+    assert store.header("a") == (npy.shape, np.dtype(dtype))
+    assert np.array_equal(store.read("a"), npy)
+    # Windows across chunk borders and past the image, band subsets
+    assert np.array_equal(store.read("a", (10, 5, 30, 100)), npy[10:40, 5:])
+    assert np.array_equal(store.read("a", (60, 40, 16, 16), bands=[2, 0]), npy[60:, 40:][:, :, [2, 0]])
+
+def test_chunked_array_slicing(store):
+    npy = image()
+    store.save("a", npy)
+    chunked = store.open("a", bands=slice(1, 3))
+
+    assert chunked.shape == (70, 45, 2) and chunked.dtype == npy.dtype
+    assert np.array_equal(np.asarray(chunked), npy[:, :, 1:3])
+    assert np.array_equal(chunked[5:50:3, ::2, 0], npy[5:50:3, ::2, 1])
+    with pytest.raises(TypeError):
+        chunked[3]
+
+def test_writer_strips_of_any_height(store):
+    npy = image(shape=(70, 45))
+    writer = store.writer("a", npy.shape, npy.dtype)
+    for r0, r1 in ((0, 5), (5, 37), (37, 70)):
+        writer.write(npy[r0:r1])
+    writer.close()
+
+    assert np.array_equal(store.read("a")[:, :, 0], npy)
+    assert store.band_stats("a")["max"] == [float(npy.max())]
+
+def test_same_chunks_stored_once(store):
+    npy = image()
+    edited = npy.copy()
+    edited[:16, :16] = 0        # Changes a single chunk
+    store.save("a", npy)
+    store.save("b", edited)
+
+    chunks_per_array = 5 * 3
+    stats = store.stats
+    assert stats["arrays"] == 2
+    assert stats["chunks"] == len(chunk_files(store)) == chunks_per_array + 1
+    assert stats["logical_bytes"] == 2 * npy.nbytes
+    assert np.array_equal(store.read("b"), edited)
+
+def test_gc_removes_only_unreferenced_chunks(store):
+    npy = image()
+    store.save("a", npy)
+    store.save("b", npy + 1)
+
+    store.delete("b")
+    assert not store.exists("b")
+    assert store.gc() == 15
+    assert store.gc() == 0
+
+    assert chunk_files(store) == set(store.manifest("a")["sizes"])
+    assert store.stats["chunks"] == 15
+    assert np.array_equal(store.read("a"), npy)
+
+def test_gc_keeps_chunks_of_open_writers(store):
+    npy = image()
+    writer = store.writer("a", npy.shape, npy.dtype)
+    writer.write(npy[:40])
+
+    assert store.gc() == 0
+    writer.write(npy[40:])
+    writer.close()
+
+    assert not [f for f in os.listdir(store.directory) if f.endswith(PENDING_EXT)]
+    assert store.gc() == 0
+    assert np.array_equal(store.read("a"), npy)
+
+def test_gc_collects_aborted_and_dead_writers(store, monkeypatch):
+    npy = image()
+    aborted = store.writer("a", npy.shape, npy.dtype)
+    aborted.write(npy[:32])
+    aborted.abort()
+
+    # A writer of a process that died before closing
+    dead = store.writer("b", npy.shape, npy.dtype)
+    dead.write(npy[32:64] + 1)
+    pending_file = [f for f in os.listdir(store.directory) if f.startswith("b.")][0]
+    monkeypatch.setattr(chunkStore, "_alive", lambda pid: False)
+
+    assert store.gc() == 2 * 3 + 2 * 3
+    assert not chunk_files(store)
+    assert not os.path.exists(os.path.join(store.directory, pending_file))
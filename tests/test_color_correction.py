@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+
+from Services.ImageOperations import colorCorrection
+
+PERCENTS = (0, 1, 2.5, 50, 97.5, 99, 100)
+
+
+def image(dtype, low: float, high: float, shape=(157, 83, 3), seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.uniform(low, high, size=shape).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype, low, high", [
+    (np.uint8, 0, 255),
+    (np.uint16, 0, 65535),
+    (np.int16, -32768, 32767),
+    (np.int32, -100_000, 100_000),
+])
+def test_integer_percentiles_are_exact(dtype, low, high):
+    npy = image(dtype, low, high)
+
+    assert np.array_equal(colorCorrection.band_percentiles(npy, PERCENTS), np.nanpercentile(npy, PERCENTS, axis=(0, 1)))
+
+@pytest.mark.parametrize("dtype, low, high", [
+    (np.float32, -1, 1),
+    (np.float64, 1e6, 1e6 + 3),
+    # Range too wide to count exactly, goes through the float histogram
+    (np.int64, -2**40, 2**40),
+])
+def test_float_percentiles_within_a_bin(dtype, low, high):
+    npy = image(dtype, low, high)
+    npy_range = np.ptp(npy, axis=(0, 1)).astype(np.float64)
+
+    error = np.abs(colorCorrection.band_percentiles(npy, PERCENTS) - np.nanpercentile(npy, PERCENTS, axis=(0, 1)))
+    assert np.all(error <= npy_range / colorCorrection.FLOAT_HIST_BINS)
+
+@pytest.mark.filterwarnings("ignore:All-NaN slice")
+def test_nan_ignored():
+    npy = image(np.float32, 0, 1)
+    npy[::3, ::2, 1] = np.nan
+    npy[:, :, 2] = np.nan
+
+    result = colorCorrection.band_percentiles(npy, PERCENTS)
+    expected = np.nanpercentile(npy[:, :, :2], PERCENTS, axis=(0, 1))
+
+    assert np.all(np.abs(result[:, :2] - expected) <= 1 / colorCorrection.FLOAT_HIST_BINS)
+    assert np.all(np.isnan(result[:, 2]))
+
+def test_max_pixels_counted_with_mixed_magnitudes():
+    # _min + width * bins rounds below the max for this range
+    _min, _max = -128.83614637495543, 4.2986369482223e-15
+    npy = np.array([[_min, _max, _max]])
+
+    assert abs(colorCorrection.band_percentiles(npy, 100)[0, 0] - _max) <= (_max - _min) / colorCorrection.FLOAT_HIST_BINS
+
+def test_clip_bounds_rounded_for_integers():
+    npy = image(np.uint16, 0, 1000, shape=(101, 7, 2))
+    bounds = np.nanpercentile(npy, (2, 98), axis=(0, 1))
+
+    pixel_min, pixel_max = colorCorrection._clip_bounds(npy, 2)
+
+    assert pixel_min.dtype == np.uint16
+    assert np.array_equal(pixel_min, np.rint(bounds[0])) and np.array_equal(pixel_max, np.rint(bounds[1]))
+    # Within half a level of clipping to the float percentiles
+    clipped = colorCorrection.clip_normalise_bandwise(npy, 2)
+    assert clipped.dtype == np.uint16
+    assert np.all(np.abs(clipped - np.clip(npy, bounds[0], bounds[1])) <= 0.5)
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("rasterio")
+
+from Services.ImageOperations import imageOp
+
+
+def image(shape=(70, 90, 3)) -> np.ndarray:
+    return np.arange(np.prod(shape), dtype=np.uint16).reshape(shape)
+
+
+def test_iter_clips_are_read_only_views():
+    npy = image()
+    clips = list(imageOp.iterClips(npy, 32, 0.5))
+
+    assert len(clips) == len(imageOp.clipOffsets(70, 90, 32, 0.5)[0])
+    for y, x, data, _ in clips:
+        assert data.shape == (32, 32, 3) and not data.flags.writeable
+        window = npy[y:y+32, x:x+32]
+        assert np.array_equal(data[:window.shape[0], :window.shape[1]], window)
+        assert not data[window.shape[0]:].any() and not data[:, window.shape[1]:].any()
+    assert np.shares_memory(clips[0].data, npy)
+
+def test_make_clips_are_writable_copies():
+    npy = image()
+    source = npy.copy()
+
+    clips = imageOp.makeClips(npy, 32, 0.5)
+
+    assert len(clips) == len(imageOp.clipOffsets(70, 90, 32, 0.5)[0])
+    for clip in clips:
+        assert clip.flags.writeable and not np.shares_memory(clip, npy)
+        clip[:] = 0
+    assert np.array_equal(npy, source)
@@ -0,0 +1,78 @@
+import numpy as np
+import pytest
+import requests
+
+pytest.importorskip("rasterio")
+
+from Services.Inference import app as inferenceApp
+from Services.Inference import helpers as inferenceHelpers
+from Services.ImageOperations import imageOp
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(inferenceHelpers, "detect", lambda img, **params: pytest.fail("Model run"))
+    return inferenceApp.inferenceApp.test_client()
+
+@pytest.fixture
+def image(monkeypatch):
+    # Zeros of a large image without allocating it
+    img = np.broadcast_to(np.zeros(1, dtype=np.uint8), (20_000, 20_000, 3))
+    monkeypatch.setattr(inferenceHelpers, "openImage", lambda _uuid, source: img)
+    return img
+
+
+@pytest.mark.parametrize("params", [
+    {"clip_size": "abc"},
+    {"clip_size": [640]},
+    {"clip_size": 0},
+    {"clip_size": -640},
+    {"clip_size": 100_000},
+    {"overlap": 1},
+    {"overlap": -0.1},
+    {"overlap": "nan"},
+    {"conf": 2},
+    {"iou": "x"},
+])
+def test_invalid_params_refused(client, monkeypatch, params):
+    monkeypatch.setattr(inferenceHelpers, "openImage", lambda _uuid, source: pytest.fail("Image opened"))
+
+    response = client.post("/detect", json={"_uuid": "image", **params})
+
+    assert response.status_code == 400
+
+def test_too_many_tiles_refused(client, image):
+    response = client.post("/detect", json={"_uuid": "image", "clip_size": 32, "overlap": 0.9})
+
+    assert response.status_code == 400
+    assert b"tiles" in response.data
+
+def test_tile_count_matches_clips():
+    for height, width, clip_size, overlap in [(100, 70, 32, 0), (641, 640, 640, 0.2), (1000, 3, 64, 0.5), (5, 5, 32, 0.99)]:
+        ys, _ = imageOp.clipOffsets(height, width, clip_size, overlap)
+        assert inferenceHelpers.tileCount(height, width, clip_size, overlap) == len(ys)
+
+def test_valid_params_passed_to_the_model(monkeypatch, image):
+    seen = {}
+    monkeypatch.setattr(inferenceHelpers, "detect", lambda img, **params: seen.update(params) or {"count": 0})
+    monkeypatch.setattr(inferenceHelpers, "imageStats", lambda _uuid, source: None)
+    client = inferenceApp.inferenceApp.test_client()
+
+    response = client.post("/detect", json={"_uuid": "image", "clip_size": "1024", "overlap": 0.5, "conf": 0.4})
+
+    assert response.status_code == 200
+    assert seen == {"clip_size": 1024, "overlap": 0.5, "conf": 0.4, "iou": 0.5, "stats": None}
+
+def test_pending_image_not_retried(client, monkeypatch):
+    calls = []
+
+    def put(path, **kwargs):
+        calls.append(kwargs)
+        raise requests.ReadTimeout("read timed out")
+
+    monkeypatch.setattr(inferenceHelpers.imageOpClient, "put", put)
+
+    response = client.post("/detect", json={"_uuid": "pending"})
+
+    assert response.status_code == 502
+    assert len(calls) == 1 and not calls[0].get("idempotent")
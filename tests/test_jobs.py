@@ -0,0 +1,164 @@
+import os
+import time
+import threading
+import multiprocessing
+import numpy as np
+import pytest
+
+pytest.importorskip("rasterio")
+
+from Helpers import common_helpers
+from Helpers.TransformationClass import transformation
+from Helpers.TransformationClass.transformation import Transformation, PointwiseOp
+from Services.ImageOperations import helpers as imageOpHelpers
+from Services.ImageOperations import jobs
+from Services.ImageOperations.jobs import JobManager, DONE, RUNNING, FAILED, CANCELLED
+
+# Test ops are registered before the pool starts, workers get them by fork
+pytestmark = pytest.mark.skipif(multiprocessing.get_start_method() != "fork", reason="Test ops reach workers by fork")
+
+TIMEOUT = 20
+
+
+def _slowOp(npy, seconds="0"):
+    time.sleep(float(seconds))
+    return np.asarray(npy) + 1
+
+def _failingOp(npy):
+    raise ValueError("bad pixels")
+
+def _slowStrip(chunk: np.ndarray, ctx) -> np.ndarray:
+    time.sleep(0.05)
+    return chunk
+
+
+@pytest.fixture
+def manager(monkeypatch):
+    monkeypatch.setitem(imageOpHelpers.transforms, "test_slow", _slowOp)
+    monkeypatch.setitem(imageOpHelpers.transforms, "test_fail", _failingOp)
+    monkeypatch.setitem(imageOpHelpers.pointwise_transforms, "test_slow_strips", PointwiseOp(_slowStrip))
+    monkeypatch.setattr(transformation, "FUSION_STRIP_ROWS", 4)
+    manager = JobManager(workers=1)
+    yield manager
+    manager.shutdown()
+
+@pytest.fixture
+def base_id():
+    npy_id = common_helpers.generate_uuid()
+    common_helpers.save_stack_npy(npy_id, np.arange(64 * 64, dtype=np.uint16).reshape(64, 64, 1))
+    yield npy_id
+    common_helpers.remove_stack_npy(npy_id)
+
+
+def waitFor(check, timeout: float = TIMEOUT):
+    deadline = time.time() + timeout
+    while not check():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.02)
+
+def waitRunning(manager: JobManager, job: jobs.Job):
+    waitFor(lambda: manager.get(job.id).status == RUNNING)     # type: ignore
+
+def finished(job: jobs.Job) -> jobs.Job:
+    assert job.done.wait(TIMEOUT), f"Job {job.id} did not finish"
+    return job
+
+def removed(npy_id: str) -> bool:
+    return not common_helpers.stack_npy_exists(npy_id) and not common_helpers.stack_store.exists(npy_id)
+
+
+def test_submit_computes_output(manager, base_id):
+    job = finished(manager.submit("test_slow", base_id, {}))
+
+    assert job.status == DONE and job.progress == 1.0
+    assert np.array_equal(np.asarray(common_helpers.open_stack_npy(job.output_uuid)), np.asarray(common_helpers.open_stack_npy(base_id)) + 1)
+
+def test_pointwise_submit_computes_pending_run(manager, base_id):
+    # Recorded without a job, as ImageOperations PUT /transform does
+    pending = imageOpHelpers.transformationManager.record("test_slow_strips", base_id, {})
+    job = manager.submit("test_slow_strips", pending, {})
+    waitRunning(manager, job)
+
+    assert finished(job).status == DONE
+    assert imageOpHelpers.transformationManager.isMaterialised(job.output_uuid)
+    # Fused into a single pass, the pending entry is never computed on its own
+    assert not imageOpHelpers.transformationManager.isMaterialised(pending)
+
+def test_cancel_queued_job(manager, base_id):
+    running = manager.submit("test_slow", base_id, {"seconds": "1"})
+    # The pool takes a few calls ahead of its workers, the last one is still queued
+    queued = [manager.submit("test_slow", base_id, {"seconds": "1"}) for _ in range(3)]
+    job = queued[-1]
+
+    manager.cancel(job.id)
+
+    assert finished(job).status == CANCELLED
+    assert job.future.cancelled()     # type: ignore
+    assert not os.path.exists(Transformation.node_file(job.output_uuid))
+    assert removed(job.output_uuid)
+    assert finished(running).status == DONE
+
+def test_cancel_running_job(manager, base_id):
+    job = manager.submit("test_slow", base_id, {"seconds": "1"})
+    waitRunning(manager, job)
+
+    manager.cancel(job.id)
+
+    assert finished(job).status == CANCELLED
+    assert not os.path.exists(Transformation.node_file(job.output_uuid))
+    # The output was written before the job saw the cancel, it is removed with its node
+    waitFor(lambda: removed(job.output_uuid))
+
+def test_cancel_running_materialise_keeps_node(manager, base_id):
+    lazy = imageOpHelpers.transformationManager.record("test_slow_strips", base_id, {})
+    job = manager.materialise(lazy)
+    waitRunning(manager, job)
+
+    manager.cancel(job.id)
+
+    assert finished(job).status == CANCELLED
+    # The entry is in the stack already, it is computed again when needed
+    assert Transformation.load(lazy) is not None
+    assert removed(lazy)
+
+def test_failed_job_removes_node(manager, base_id):
+    job = finished(manager.submit("test_fail", base_id, {}))
+
+    assert job.status == FAILED
+    assert job.error == "ValueError: bad pixels"
+    assert not os.path.exists(Transformation.node_file(job.output_uuid))
+    assert removed(job.output_uuid)
+    # The worker is still usable
+    assert finished(manager.submit("test_slow", base_id, {})).status == DONE
+
+def test_materialise_joins_running_job(manager, base_id):
+    lazy = imageOpHelpers.transformationManager.record("test_slow_strips", base_id, {})
+
+    job = manager.materialise(lazy)
+    assert manager.materialise(lazy) is job
+
+    assert finished(job).status == DONE
+    assert imageOpHelpers.transformationManager.isMaterialised(lazy)
+
+def test_concurrent_submits(manager, base_id):
+    submitted: list[jobs.Job] = []
+    lock = threading.Lock()
+
+    def submit():
+        job = manager.submit("test_slow", base_id, {})
+        with lock:
+            submitted.append(job)
+
+    threads = [threading.Thread(target=submit) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len({job.id for job in submitted}) == 8
+    assert len({job.output_uuid for job in submitted}) == 8
+    expected = np.asarray(common_helpers.open_stack_npy(base_id)) + 1
+    for job in submitted:
+        assert finished(job).status == DONE
+        assert np.array_equal(np.asarray(common_helpers.open_stack_npy(job.output_uuid)), expected)
+    assert {job.id for job in manager.list()} >= {job.id for job in submitted}
@@ -0,0 +1,98 @@
+import numpy as np
+import pytest
+from io import BytesIO
+from PIL import Image as pilImage
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+from Helpers import render_encoder
+from Helpers.render_encoder import RenderEncoding, Formats, Tiers
+
+
+def accept(header: str) -> MIMEAccept:
+    return parse_accept_header(header, MIMEAccept)
+
+def render(shape=(48, 64, 3), seed: int = 0) -> np.ndarray:
+    # Smooth gradient with noise, so lossy formats stay close
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    img = np.stack([x * 3, y * 4, x + y], axis=-1)[:, :, :shape[2]]
+    noise = np.random.default_rng(seed).integers(0, 4, size=img.shape)
+    return (img + noise).clip(0, 255).astype(np.uint8)
+
+def decode(data: bytes, encoding: RenderEncoding) -> np.ndarray:
+    if encoding.format == Formats.RAW:
+        return np.load(BytesIO(data))
+    with pilImage.open(BytesIO(data)) as img:
+        assert img.format == {"jpeg": "JPEG", "png": "PNG", "webp": "WEBP"}[encoding.format.value]
+        return np.asarray(img)
+
+
+@pytest.mark.parametrize("format, tier", [
+    ("png", "fast"), ("png", "exact"), ("webp", "exact"), ("raw", "fast"), ("raw", "exact"),
+])
+def test_lossless_encodings(format, tier):
+    img = render()
+    encoding = RenderEncoding(format, tier)
+
+    assert np.array_equal(decode(encoding.encode(img), encoding), img)
+
+@pytest.mark.parametrize("format, tier", [("jpeg", "fast"), ("jpeg", "exact"), ("webp", "fast")])
+def test_lossy_encodings_stay_close(format, tier):
+    img = render()
+    encoding = RenderEncoding(format, tier)
+
+    error = np.abs(decode(encoding.encode(img), encoding).astype(np.int16) - img)
+    assert error.mean() < 8
+
+def test_exact_png_not_larger_than_fast():
+    img = render(shape=(256, 256, 3))
+
+    assert len(RenderEncoding("png", "exact").encode(img)) <= len(RenderEncoding("png", "fast").encode(img))
+
+def test_single_band_encoded_as_grayscale():
+    img = render(shape=(20, 30, 1))
+    encoding = RenderEncoding("png", "exact")
+
+    assert np.array_equal(decode(encoding.encode(img), encoding), img[:, :, 0])
+
+def test_encoding_names():
+    encoding = RenderEncoding("JPG", "Exact")
+
+    assert (encoding.format, encoding.tier) == (Formats.JPEG, Tiers.EXACT)
+    assert (encoding.key, encoding.ext, encoding.mimetype) == (("jpeg", "exact"), "jpg", "image/jpeg")
+    assert render_encoder.FORMAT_BY_EXT == {"png": "png", "jpg": "jpeg", "webp": "webp", "npy": "raw"}
+    for format, tier in (("gif", "fast"), ("png", "slow")):
+        with pytest.raises(ValueError):
+            RenderEncoding(format, tier)
+
+def test_negotiate(monkeypatch):
+    monkeypatch.setattr(render_encoder, "RENDER_FORMAT", "png")
+    monkeypatch.setattr(render_encoder, "RENDER_TIER", "fast")
+
+    def key(args: dict, header: str | None = None) -> tuple[str, str]:
+        return render_encoder.negotiate(args, accept(header) if header is not None else None).key
+
+    # Params over Accept
+    assert key({"format": "webp", "tier": "exact"}, "image/jpeg") == ("webp", "exact")
+    # Highest quality wins, ties go to the default then png, webp, jpeg
+    assert key({}, "image/webp,image/*;q=0.8") == ("webp", "fast")
+    assert key({"tier": "exact"}, "image/jpeg,image/webp") == ("webp", "exact")
+    assert key({}, "image/*") == ("png", "fast")
+    assert key({}, "image/jpeg") == ("jpeg", "fast")
+    # Nothing acceptable or no header, the defaults
+    assert key({}, "text/html") == ("png", "fast")
+    assert key({}) == ("png", "fast")
+    monkeypatch.setattr(render_encoder, "RENDER_FORMAT", "webp")
+    assert key({}, "*/*") == ("webp", "fast")
+    with pytest.raises(ValueError):
+        key({"format": "bmp"})
+
+def test_timing_per_thread():
+    encoding = RenderEncoding("raw", "fast")
+    render_encoder.reset_timing()
+    assert render_encoder.timing() == {"ms": 0.0, "bytes": 0, "count": 0}
+
+    sizes = [len(encoding.encode(render())) for _ in range(2)]
+
+    timing = render_encoder.timing()
+    assert timing["count"] == 2 and timing["bytes"] == sum(sizes) and timing["ms"] >= 0
@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from Helpers import render_kernel
+from Helpers import common_helpers
+from Helpers.StackManager import sessions
+
+
+def baseline(npy: np.ndarray, _min: float, _max: float) -> np.ndarray:
+    """Whole image float64 conversion the kernel replaced"""
+    return np.uint8(np.clip((npy.astype(np.float64) - _min) / ((_max - _min) or 1), 0, 1) * 255)     # type: ignore
+
+def image(dtype, low: float, high: float, shape=(131, 97, 3), seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    return rng.uniform(low, high, size=shape).astype(dtype)
+
+
+@pytest.mark.parametrize("dtype, low, high", [
+    (np.uint16, 0, 65535),
+    (np.int16, -32768, 32767),
+    (np.int32, -2**31, 2**31 - 1),
+    (np.uint32, 0, 2**32 - 1),
+    (np.int64, -2**40, 2**40),
+    (np.float32, -1e3, 1e3),
+    (np.float64, 0, 1),
+])
+def test_matches_float64_path(dtype, low, high):
+    npy = image(dtype, low, high)
+    # Range inside the data, so values outside it are clipped too
+    _min, _max = float(np.percentile(npy, 2)), float(np.percentile(npy, 98))
+
+    assert np.array_equal(render_kernel.to_uint8(npy, _min, _max), baseline(npy, _min, _max))
+
+def test_large_offset_keeps_levels():
+    npy = (np.uint32(4_000_000_000) + np.arange(201, dtype=np.uint32)).reshape(1, 201)
+
+    rendered = render_kernel.to_uint8(npy, 4_000_000_000, 4_000_000_200)
+
+    assert np.array_equal(rendered, baseline(npy, 4_000_000_000, 4_000_000_200))
+    assert len(np.unique(rendered)) > 190
+
+def test_strips_and_out(monkeypatch):
+    monkeypatch.setattr(render_kernel, "RENDER_STRIP_ROWS", 7)
+    npy = image(np.float32, 0, 500, shape=(50, 20))
+    out = np.full(npy.shape, 7, dtype=np.uint8)
+
+    assert render_kernel.to_uint8(npy, 10, 400, out=out) is out
+    assert np.array_equal(out, baseline(npy, 10, 400))
+
+def test_nan_and_flat_range():
+    npy = np.array([[np.nan, 1.0, 2.0]], dtype=np.float32)
+
+    assert render_kernel.to_uint8(npy, 0, 2).tolist() == [[0, 127, 255]]
+    # A flat range maps everything above it to 255 without dividing by 0
+    assert render_kernel.to_uint8(npy, 1, 1).tolist() == [[0, 0, 255]]
+
+def test_uint8_passthrough():
+    npy = image(np.uint8, 0, 255)
+
+    assert render_kernel.to_uint8(npy, 10, 20) is npy
+    out = np.empty_like(npy)
+    assert np.array_equal(render_kernel.to_uint8(npy, 10, 20, out=out), npy)
+
+def test_full_render_reads_the_entry_lazily(monkeypatch):
+    npy_id = common_helpers.generate_uuid()
+    npy = image(np.uint32, 0, 2**32 - 1, shape=(300, 40, 4))
+    common_helpers.save_stack_npy(npy_id, npy)
+    monkeypatch.setattr(common_helpers, "read_stack_npy", lambda *args, **kwargs: pytest.fail("Entry decoded whole"))
+    monkeypatch.setattr(render_kernel, "RENDER_STRIP_ROWS", 16)
+
+    with sessions.session(common_helpers.generate_uuid()) as stackManager:
+        stackManager.addImage(npy_id)
+        rendered = stackManager.getCurrentImage()
+
+    assert rendered is not None and rendered.startswith(b"\x89PNG")
@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+import numpy as np
+import pytest
+
+from Helpers import common_helpers
+from Helpers.StackManager import sessions, stackManager
+from Helpers.StackManager.sessions import SessionRegistry, DEFAULT_SESSION, SESSIONS_DIR
+
+
+@pytest.fixture
+def registry():
+    return SessionRegistry(idle_seconds=0, ttl_seconds=3600)
+
+def addEntry(registry: SessionRegistry, session_id: str) -> str:
+    npy_id = common_helpers.generate_uuid()
+    common_helpers.save_stack_npy(npy_id, np.zeros((4, 4, 1), dtype=np.uint8))
+    with registry.session(session_id) as stack:
+        stack.addImage(npy_id)
+    return npy_id + ".npy"
+
+def expire(session_id: str, hours: float = 2):
+    old = time.time() - hours * 3600
+    os.utime(os.path.join(SESSIONS_DIR, session_id), (old, old))
+
+
+def test_signed_ids_only():
+    session_id = common_helpers.generate_uuid()
+    token = common_helpers.sign_session(session_id)
+
+    assert SessionRegistry.validate(token) == session_id
+    assert SessionRegistry.validate(None) == DEFAULT_SESSION
+    for forged in (session_id, f"{session_id}.{'A' * 43}", token[:-1] + ("A" if token[-1] != "A" else "B"), "../x." + token.split(".")[1]):
+        with pytest.raises(ValueError):
+            SessionRegistry.validate(forged)
+
+def test_idle_session_unloaded_and_reloaded(registry):
+    session_id = common_helpers.generate_uuid()
+    npy_id = addEntry(registry, session_id)
+
+    assert registry.stats["loaded"] == 0 and registry.evictions == 1
+    with registry.session(session_id) as stack:
+        assert stack.npy_stack == [npy_id]
+
+def test_purge_deletes_expired_sessions(registry):
+    expired, recent = common_helpers.generate_uuid(), common_helpers.generate_uuid()
+    expired_entry = addEntry(registry, expired)
+    addEntry(registry, recent)
+    with registry.session(DEFAULT_SESSION):
+        pass
+    expire(expired)
+    expire(DEFAULT_SESSION)
+
+    assert registry.purge() == 1
+
+    assert not os.path.exists(os.path.join(SESSIONS_DIR, expired))
+    assert not common_helpers.stack_npy_exists(expired_entry)
+    assert os.path.exists(os.path.join(SESSIONS_DIR, recent))
+    assert os.path.exists(os.path.join(SESSIONS_DIR, DEFAULT_SESSION))
+    with registry.session(expired) as stack:
+        assert stack.npy_stack == []
+
+def test_purge_blocks_only_the_deleted_session(registry, monkeypatch):
+    expired, other = common_helpers.generate_uuid(), common_helpers.generate_uuid()
+    addEntry(registry, expired)
+    expire(expired)
+    deleting, release = threading.Event(), threading.Event()
+    delete = stackManager.StackManager.delete
+
+    def slowDelete(self):
+        deleting.set()
+        release.wait(10)
+        delete(self)
+
+    monkeypatch.setattr(stackManager.StackManager, "delete", slowDelete)
+    purge = threading.Thread(target=registry.purge)
+    purge.start()
+    assert deleting.wait(10)
+
+    # Other sessions are served while the expired one is deleted
+    with registry.session(other) as stack:
+        assert stack.npy_stack == []
+    # A request of the deleted session waits for the delete, then gets an empty stack
+    seen = []
+    def useExpired():
+        with registry.session(expired) as stack:
+            seen.append(stack.npy_stack)
+    waiting = threading.Thread(target=useExpired)
+    waiting.start()
+    waiting.join(0.2)
+    assert waiting.is_alive()
+
+    release.set()
+    purge.join(10)
+    waiting.join(10)
+    assert seen == [[]]
+
+def test_loading_a_session_does_not_block_others(registry, monkeypatch):
+    slow, other = common_helpers.generate_uuid(), common_helpers.generate_uuid()
+    loading, release = threading.Event(), threading.Event()
+    init = stackManager.StackManager.__init__
+
+    def slowInit(self, session_id=DEFAULT_SESSION, *args, **kwargs):
+        if session_id == slow:
+            loading.set()
+            release.wait(10)
+        init(self, session_id, *args, **kwargs)
+
+    monkeypatch.setattr(sessions.StackManager, "__init__", slowInit)
+    def useSlow():
+        with registry.session(slow):
+            pass
+    load = threading.Thread(target=useSlow)
+    load.start()
+    assert loading.wait(10)
+
+    served = []
+    def useOther():
+        with registry.session(other) as stack:
+            served.append(stack.session_id)
+    other_request = threading.Thread(target=useOther)
+    other_request.start()
+    other_request.join(5)
+    loaded_meanwhile = served == [other]
+
+    release.set()
+    load.join(10)
+    other_request.join(10)
+    assert loaded_meanwhile
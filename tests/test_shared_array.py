@@ -0,0 +1,129 @@
+import os
+import json
+import threading
+import numpy as np
+import pytest
+
+from Helpers import shared_array, common_helpers
+
+
+@pytest.fixture(autouse=True)
+def shm_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(shared_array, "SHM_DIR", str(tmp_path))
+    monkeypatch.setattr(shared_array, "SHM_HANDOFF", True)
+    return tmp_path
+
+@pytest.fixture
+def blocked():
+    """Holds the persist thread until set, so entries stay in shared memory"""
+    release = threading.Event()
+    shared_array._persist_pool.submit(release.wait, 10)
+    yield release
+    release.set()
+    drain()
+
+def drain():
+    # Persists run one at a time, a no-op queued last runs after all of them
+    shared_array._persist_pool.submit(lambda: None).result(10)
+
+def image(shape=(40, 30, 3)) -> np.ndarray:
+    return np.arange(np.prod(shape), dtype=np.float32).reshape(shape)
+
+
+def test_published_until_persisted(blocked):
+    npy, persisted = image(), []
+    npy_id = common_helpers.generate_uuid() + ".npy"
+
+    desc = shared_array.publish(npy_id, npy, None, persist=lambda arr: persisted.append(np.array(arr)), strip_rows=7)
+
+    assert desc == {"npy_id": npy_id, "file": os.path.basename(shared_array.array_file(npy_id)), "shape": [40, 30, 3], "dtype": npy.dtype.str, "offset": desc["offset"]}
+    assert shared_array.exists(npy_id) and np.array_equal(shared_array.get(npy_id), npy)
+    assert shared_array.stats(npy_id)["max"] == [float(npy[:, :, b].max()) for b in range(3)]
+
+    blocked.set()
+    drain()
+    assert len(persisted) == 1 and np.array_equal(persisted[0], npy)
+    assert not shared_array.exists(npy_id) and shared_array.get(npy_id) is None
+    assert not os.path.exists(shared_array.array_file(npy_id)) and not os.path.exists(shared_array.stats_file(npy_id))
+
+def test_reader_attaches_descriptor(blocked):
+    npy = image()
+    npy_id = common_helpers.generate_uuid()
+    desc = shared_array.publish(npy_id, npy, None, persist=lambda arr: None)
+    # As the reading service gets it over HTTP, without the writer's mapping
+    shared_array._arrays.clear()
+
+    attached = shared_array.attach(json.loads(json.dumps(desc)))
+
+    assert attached is not None and not attached.flags.writeable
+    assert np.array_equal(attached, npy)
+    assert shared_array.stats(npy_id)["count"] == [40 * 30] * 3
+
+    blocked.set()
+    drain()
+    assert shared_array.attach(desc) is None
+
+def test_discarded_before_persist_never_persisted(blocked):
+    persisted = []
+    npy_id = common_helpers.generate_uuid()
+    shared_array.publish(npy_id, image(), None, persist=persisted.append)
+
+    shared_array.discard(npy_id)
+    blocked.set()
+    drain()
+
+    assert persisted == [] and not shared_array.exists(npy_id)
+
+def test_discarded_while_persisted_is_unpersisted():
+    persisting, release = threading.Event(), threading.Event()
+    unpersisted = []
+    npy_id = common_helpers.generate_uuid()
+
+    def persist(arr):
+        persisting.set()
+        release.wait(10)
+
+    shared_array.publish(npy_id, image(), None, persist=persist, unpersist=lambda: unpersisted.append(npy_id))
+    assert persisting.wait(10)
+    shared_array.discard(npy_id)
+    release.set()
+    drain()
+
+    assert unpersisted == [npy_id]
+
+def test_failed_persist_keeps_the_only_copy():
+    npy = image()
+    npy_id = common_helpers.generate_uuid()
+
+    def persist(arr):
+        raise OSError("disk full")
+
+    shared_array.publish(npy_id, npy, None, persist=persist)
+    drain()
+
+    assert shared_array.exists(npy_id) and np.array_equal(shared_array.get(npy_id), npy)
+    shared_array.discard(npy_id)
+    assert not shared_array.exists(npy_id)
+
+def test_aborted_writer_leaves_nothing(shm_dir):
+    writer = shared_array.SharedWriter(common_helpers.generate_uuid(), (40, 30), np.uint16, None, persist=lambda arr: None)
+    writer.write(np.ones((10, 30), dtype=np.uint16))
+    writer.abort()
+
+    assert os.listdir(shm_dir) == []
+
+def test_stack_entry_handoff(blocked):
+    npy = image()
+    npy_id = common_helpers.generate_uuid() + ".npy"
+
+    common_helpers.save_stack_npy(npy_id, npy, handoff=True)
+
+    assert np.array_equal(common_helpers.read_stack_npy(npy_id, window=(5, 3, 10, 10), bands=1), npy[5:15, 3:13, 1:2])
+    assert common_helpers.stack_npy_stats(npy_id)["min"] == [0.0, 1.0, 2.0]
+    assert not common_helpers.stack_store.exists(npy_id)
+
+    blocked.set()
+    drain()
+    assert common_helpers.stack_store.exists(npy_id) and not shared_array.exists(npy_id)
+    assert np.array_equal(np.asarray(common_helpers.open_stack_npy(npy_id)), npy)
+    common_helpers.remove_stack_npy(npy_id)
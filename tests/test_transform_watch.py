@@ -0,0 +1,51 @@
+import pytest
+
+pytest.importorskip("rasterio")
+
+from Helpers import common_helpers
+from Helpers.StackManager import sessions
+import Services.Backend.app as backendApp
+
+
+@pytest.fixture
+def session_id():
+    session_id = common_helpers.generate_uuid()
+    with sessions.session(session_id) as stackManager:
+        stackManager.addImage("input")
+    return session_id
+
+@pytest.fixture
+def finishedJob(monkeypatch):
+    """Makes the job watched by Backend finish right away. Returns the outputs discarded"""
+    discarded: list[str] = []
+    state = {"job_id": "job", "status": "done", "output_uuid": "output", "shared": None, "progress": 1.0}
+    monkeypatch.setattr(backendApp.backendHelpers, "waitTransformJob", lambda job_id, on_update=None: state)
+    monkeypatch.setattr(backendApp.backendHelpers, "discardOutput", discarded.append)
+    return discarded
+
+
+def test_output_added_to_stack(session_id, finishedJob):
+    backendApp.pendingJobs[session_id] = "job"
+
+    backendApp.watchTransformJob("job", "input.npy", session_id)
+
+    with sessions.session(session_id) as stackManager:
+        assert stackManager.npy_stack[stackManager.current_pointer] == "output.npy"
+    assert backendApp.transformJobs["job"]["stack_updated"]
+    assert backendApp.transformJobs["job"]["final"]
+    assert session_id not in backendApp.pendingJobs
+    assert finishedJob == []
+
+def test_output_dropped_after_image_changed(session_id, finishedJob):
+    backendApp.pendingJobs[session_id] = "job"
+    with sessions.session(session_id) as stackManager:
+        stackManager.addImage("other")
+
+    backendApp.watchTransformJob("job", "input.npy", session_id)
+
+    with sessions.session(session_id) as stackManager:
+        assert stackManager.npy_stack == ["input.npy", "other.npy"]
+    assert not backendApp.transformJobs["job"]["stack_updated"]
+    assert backendApp.transformJobs["job"]["final"]
+    assert session_id not in backendApp.pendingJobs
+    assert finishedJob == ["output"]
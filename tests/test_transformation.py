@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("rasterio")
+
+from Helpers import common_helpers
+from Helpers.TransformationClass import transformation
+from Services.ImageOperations import helpers as imageOpHelpers
+from Services.ImageOperations import colorCorrection
+
+CHAIN = [
+    ("gamma", {"gamma": "1.7"}),
+    ("normalise", {"clip_percent": "3"}),
+    ("gamma", {"gamma": "0.6"}),
+    ("normalise", {"clip_percent": "1"}),
+    ("map_range", {"outmin": "10", "outmax": "240"}),
+]
+
+
+@pytest.fixture(params=[np.uint16, np.float32])
+def base(request):
+    rng = np.random.default_rng(1)
+    npy = rng.gamma(2, 3000, size=(203, 57, 3)).clip(0, 65535).astype(request.param)
+    npy_id = common_helpers.generate_uuid()
+    common_helpers.save_stack_npy(npy_id, npy)
+    yield npy_id, npy
+    common_helpers.remove_stack_npy(npy_id)
+
+@pytest.fixture(autouse=True)
+def strips(monkeypatch):
+    monkeypatch.setattr(transformation, "FUSION_STRIP_ROWS", 32)
+
+
+def record(npy_id: str, chain) -> str:
+    for op, params in chain:
+        npy_id = imageOpHelpers.transformationManager.record(op, npy_id, params)
+    return npy_id
+
+def eager(npy: np.ndarray, chain) -> np.ndarray:
+    for op, params in chain:
+        npy = imageOpHelpers.transforms[op](npy, **params)
+    return npy
+
+def materialised(npy_id: str) -> np.ndarray:
+    assert imageOpHelpers.transformationManager.materialise(npy_id)
+    return np.asarray(common_helpers.open_stack_npy(npy_id))
+
+
+@pytest.mark.parametrize("length", range(1, len(CHAIN) + 1))
+def test_fused_matches_eager(base, length):
+    npy_id, npy = base
+    chain = CHAIN[:length]
+
+    assert np.array_equal(materialised(record(npy_id, chain)), eager(npy, chain))
+
+def test_split_runs_match_eager(base, monkeypatch):
+    monkeypatch.setattr(transformation, "FUSION_MAX_OPS", 2)
+    npy_id, npy = base
+
+    assert np.array_equal(materialised(record(npy_id, CHAIN)), eager(npy, CHAIN))
+
+def test_min_max_carried_through_run(base, monkeypatch):
+    npy_id, npy = base
+    expected = eager(npy, CHAIN)
+    monkeypatch.setattr(colorCorrection, "_band_range", lambda *args: pytest.fail("Band range read from the data"))
+
+    assert np.array_equal(materialised(record(npy_id, CHAIN)), expected)
+
+def test_run_input_read_once_per_percentile_op(base, monkeypatch):
+    npy_id, npy = base
+    rows_read = []
+    open_stack_npy = common_helpers.open_stack_npy
+
+    class CountingArray:
+        def __init__(self, array):
+            self.array, self.shape, self.dtype = array, array.shape, array.dtype
+        def __getitem__(self, key):
+            rows = key[0] if isinstance(key, tuple) else key
+            rows_read.append(len(range(*rows.indices(self.shape[0]))))
+            return self.array[key]
+
+    def counting(id, *args, **kwargs):
+        array = open_stack_npy(id, *args, **kwargs)
+        return CountingArray(array) if id == npy_id else array
+
+    monkeypatch.setattr(common_helpers, "open_stack_npy", counting)
+    assert np.array_equal(materialised(record(npy_id, CHAIN)), eager(npy, CHAIN))
+
+    # The output pass and one histogram pass per band of each normalise. The view of each op reads a row for its dtype
+    passes = 1 + 2 * npy.shape[2]
+    assert passes * npy.shape[0] <= sum(rows_read) <= passes * npy.shape[0] + len(CHAIN) + 1